@@ -0,0 +1,39 @@
+"""
+Bootstraps Django for the benchmark scripts.
+
+Benchmarks run against a throwaway sqlite database unless DATABASE_URL is
+set, and never talk to the real Slack or AWS APIs.
+"""
+import os
+import tempfile
+
+BENCHMARK_ENV = {
+    "MEGATRON_DJANGO_SECRET": "benchmark",
+    "CHANNEL_PREFIX": "zz-bench-",
+    "MEGATRON_APP_MODE": "megatron-benchmark",
+    "MEGATRON_VERIFICATION_TOKEN": "benchmark",
+    "REDIS_URL": "redis://localhost:6379",
+    "S3_AWS_ACCESS_KEY_ID": "benchmark",
+    "S3_AWS_SECRET_ACCESS_KEY": "benchmark",
+    "AWS_S3_BUCKET": "benchmark",
+    "DATABASE_URL": "sqlite:///{}".format(
+        os.path.join(tempfile.gettempdir(), "megatron-benchmark.sqlite3")
+    ),
+}
+
+
+def setup(**env):
+    for key, value in {**BENCHMARK_ENV, **env}.items():
+        os.environ.setdefault(key, value)
+    os.environ.setdefault("DJANGO_SETTINGS_MODULE", "megatron.settings")
+
+    import django
+
+    django.setup()
+
+
+def create_test_db():
+    from django.db import connection
+
+    connection.creation.create_test_db(verbosity=0, autoclobber=True)
+    return connection
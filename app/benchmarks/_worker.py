@@ -0,0 +1,21 @@
+"""
+Celery app of the benchmark workers, see green_workers.py: the production
+app on a filesystem broker, so the benchmarks need no redis.
+"""
+import os
+
+if os.environ.get("BENCHMARK_POOL") == "gevent":
+    from megatron.green import app
+else:
+    from megatron.celery import app
+
+app.conf.update(
+    broker_url="filesystem://",
+    broker_transport_options={
+        "data_folder_in": os.environ["BENCHMARK_BROKER_DIR"],
+        "data_folder_out": os.environ["BENCHMARK_BROKER_DIR"],
+        "polling_interval": 0.1,
+    },
+    result_backend=None,
+    accept_content=["json"],
+)
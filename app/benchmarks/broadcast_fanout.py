@@ -0,0 +1,74 @@
+"""
+Broadcast throughput against a local fake Slack server.
+
+    cd app && python -m benchmarks.broadcast_fanout --latency 0.02
+
+Rate limiting is switched off so the numbers show what the fan-out engine
+itself can push; in production Slack's tiers are the ceiling. The serial
+baseline (the old one-user-at-a-time loop) is only run for sizes up to
+--baseline-max because it gets slow quickly.
+"""
+import argparse
+import os
+import time
+
+from benchmarks import _django
+from benchmarks.fake_slack import FakeSlack
+
+
+def serial_broadcast(connection, broadcast, user_ids):
+    for slack_id in user_ids:
+        channel_id = connection.open_im(slack_id)["channel"]["id"]
+        connection._post_to_channel(channel_id, dict(broadcast))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--sizes", default="1000,10000,50000")
+    parser.add_argument("--latency", type=float, default=0.02)
+    parser.add_argument("--workers", type=int, default=16)
+    parser.add_argument("--baseline-max", type=int, default=1000)
+    args = parser.parse_args()
+
+    with FakeSlack(latency=args.latency) as fake_slack:
+        _django.setup(
+            SLACK_API_URL=fake_slack.url,
+            SLACK_RATE_LIMIT_ENABLED="false",
+            SLACK_BROADCAST_WORKERS=str(args.workers),
+            HTTP_POOL_MAXSIZE=str(args.workers),
+        )
+        from megatron.connections.slack import SlackConnection
+
+        connection = SlackConnection("xoxb-benchmark")
+        broadcast = {"text": "Benchmark", "attachments": [{"text": "hello"}]}
+
+        print(
+            "latency={}s workers={} pid={}".format(
+                args.latency, args.workers, os.getpid()
+            )
+        )
+        print(
+            "{:>8} {:>12} {:>12} {:>12}".format("users", "mode", "seconds", "users/s")
+        )
+        for size in [int(s) for s in args.sizes.split(",")]:
+            user_ids = ["U{:07d}".format(i) for i in range(size)]
+            modes = ["engine"]
+            if size <= args.baseline_max:
+                modes.insert(0, "serial")
+            for mode in modes:
+                start = time.perf_counter()
+                if mode == "serial":
+                    serial_broadcast(connection, broadcast, user_ids)
+                else:
+                    response = connection._broadcast(dict(broadcast), user_ids, False)
+                    assert response["ok"], response
+                elapsed = time.perf_counter() - start
+                print(
+                    "{:>8} {:>12} {:>12.2f} {:>12.0f}".format(
+                        size, mode, elapsed, size / elapsed
+                    )
+                )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,98 @@
+"""
+CPU spent building each recipient's chat.postMessage body in a broadcast.
+
+    cd app && python -m benchmarks.broadcast_payloads --recipients 10000
+
+"before" is what every post used to do: copy the message, serialize its
+attachments and form-encode the whole body. "after" encodes the message
+once into a PreparedMessage and only appends each recipient's channel.
+Nothing is sent, the numbers are the payload work alone.
+"""
+import argparse
+import json
+import time
+
+from requests.models import RequestEncodingMixin
+
+from benchmarks import _django
+
+
+def build_message(attachments):
+    return {
+        "text": "Scheduled maintenance tonight",
+        "attachments": [
+            {
+                "fallback": "Maintenance window {}".format(i),
+                "color": "#36a64f",
+                "title": "Maintenance window {}".format(i),
+                "text": "The service will be unavailable from 02:00 to 03:00 UTC. " * 4,
+                "fields": [
+                    {"title": "Region", "value": "us-east-1", "short": True},
+                    {"title": "Impact", "value": "Read only", "short": True},
+                ],
+                "footer": "sent by Megatron",
+            }
+            for i in range(attachments)
+        ],
+    }
+
+
+def before(token, message, channels):
+    for channel in channels:
+        msg = dict(message)
+        msg["attachments"] = json.dumps(msg.get("attachments", []))
+        data = {
+            "token": token,
+            "channel": channel,
+            "as_user": True,
+            "text": "",
+            "attachments": [],
+        }
+        data.update(msg)
+        RequestEncodingMixin._encode_params(data)
+
+
+def after(token, message, channels):
+    from megatron.connections.slack import PreparedMessage
+
+    prepared = PreparedMessage.prepare(message, True)
+    for channel in channels:
+        prepared.for_channel(channel)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--recipients", type=int, default=10000)
+    parser.add_argument("--attachments", type=int, default=3)
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    _django.setup()
+    from megatron.connections.slack import PreparedMessage
+
+    message = build_message(args.attachments)
+    channels = ["D{:08d}".format(i) for i in range(args.recipients)]
+    print(
+        "recipients={} attachments={} body={} bytes".format(
+            args.recipients,
+            args.attachments,
+            len(PreparedMessage.prepare(message, True).body),
+        )
+    )
+    print("{:>8} {:>12} {:>16}".format("mode", "cpu seconds", "us/recipient"))
+    for name, build in [("before", before), ("after", after)]:
+        best = None
+        for _ in range(args.repeat):
+            start = time.process_time()
+            build("xoxb-benchmark", message, channels)
+            elapsed = time.process_time() - start
+            best = elapsed if best is None else min(best, elapsed)
+        print(
+            "{:>8} {:>12.3f} {:>16.2f}".format(
+                name, best, best / args.recipients * 1000000
+            )
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,125 @@
+"""
+A local stand-in for the Slack Web API, good enough for load tests.
+
+Every method answers `ok` after an optional artificial latency. Point
+Megatron at it with SLACK_API_URL=http://127.0.0.1:<port>/api. Files of
+any size can be downloaded from /files/<size in bytes>/<name>.
+"""
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from itertools import count
+from socketserver import ThreadingMixIn
+from urllib.parse import parse_qs, urlsplit
+
+
+class _ThreadingServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+    request_queue_size = 1024
+
+
+class FakeSlackHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    server: "FakeSlack"  # type: ignore
+
+    def do_GET(self):
+        path = urlsplit(self.path).path
+        if path.startswith("/files/"):
+            self._stream_file(int(path.split("/")[2]))
+        else:
+            self._respond(parse_qs(urlsplit(self.path).query))
+
+    def do_POST(self):
+        length = int(self.headers.get("Content-Length") or 0)
+        body = self.rfile.read(length).decode()
+        if self.headers.get("Content-Type", "").startswith("application/json"):
+            params = json.loads(body or "{}")
+        else:
+            params = {k: v[0] for k, v in parse_qs(body).items()}
+        self._respond(params)
+
+    def _respond(self, params):
+        method = urlsplit(self.path).path.rsplit("/", 1)[-1]
+        self.server.record(method)
+        if self.server.latency:
+            self.server.enter()
+            time.sleep(self.server.latency)
+            self.server.leave()
+        data = self.server.payload_for(method, params)
+        body = json.dumps(data).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _stream_file(self, size: int):
+        """
+        Serves /files/<size>/<name> as `size` generated bytes, written in
+        chunks so the server itself never holds the whole file.
+        """
+        self.server.record("files")
+        self.send_response(200)
+        self.send_header("Content-Type", "application/octet-stream")
+        self.send_header("Content-Length", str(size))
+        self.end_headers()
+        chunk = bytes(range(256)) * 256
+        while size > 0:
+            self.wfile.write(chunk[:size])
+            size -= len(chunk)
+
+    def log_message(self, *args):
+        pass
+
+
+class FakeSlack(_ThreadingServer):
+    def __init__(self, latency: float = 0.0) -> None:
+        super().__init__(("127.0.0.1", 0), FakeSlackHandler)
+        self.latency = latency
+        self.calls: dict = {}
+        self.in_flight = 0
+        self.peak_in_flight = 0
+        self._lock = threading.Lock()
+        self._ts = count(1)
+        self._thread = threading.Thread(target=self.serve_forever, daemon=True)
+
+    @property
+    def url(self) -> str:
+        return "http://127.0.0.1:{}/api".format(self.server_address[1])
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.shutdown()
+        self.server_close()
+
+    def record(self, method: str) -> None:
+        with self._lock:
+            self.calls[method] = self.calls.get(method, 0) + 1
+
+    def enter(self) -> None:
+        with self._lock:
+            self.in_flight += 1
+            self.peak_in_flight = max(self.peak_in_flight, self.in_flight)
+
+    def leave(self) -> None:
+        with self._lock:
+            self.in_flight -= 1
+
+    def payload_for(self, method: str, params: dict) -> dict:
+        ts = "1600000000.{:06d}".format(next(self._ts))
+        if method in ("im.open", "conversations.open"):
+            return {"ok": True, "channel": {"id": "D" + str(params.get("user"))}}
+        if method == "users.info":
+            user = params.get("user")
+            profile = {
+                "real_name": "User {}".format(user),
+                "display_name": "user{}".format(user),
+                "image_24": "https://example.com/24.png",
+                "image_72": "https://example.com/72.png",
+            }
+            return {"ok": True, "user": {"id": user, "name": user, "profile": profile}}
+        return {"ok": True, "ts": ts, "channel": params.get("channel")}
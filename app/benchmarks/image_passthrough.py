@@ -0,0 +1,175 @@
+"""
+Peak memory and time of passing Slack images through to S3.
+
+    pip install "moto[server]<4"
+    cd app && python -m benchmarks.image_passthrough --sizes 10,50,200 --files 4
+
+S3 is a moto server running in its own process, so the objects it stores
+don't count towards the measured memory. Each run happens in a fresh
+process; "rss delta" is its peak resident memory minus what it used after
+Django was set up. The serial baseline is the previous implementation:
+download each file into memory, then put it in one request. It is only run
+for sizes up to --baseline-max because it gets slow quickly.
+"""
+import argparse
+import resource
+import socket
+import subprocess
+import sys
+import time
+import urllib.request
+
+import boto3
+
+from benchmarks import _django
+from benchmarks.fake_slack import FakeSlack
+
+MB = 1024 * 1024
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def current_rss() -> int:
+    with open("/proc/self/statm") as statm:
+        return int(statm.read().split()[1]) * resource.getpagesize()
+
+
+def peak_rss() -> int:
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def serial_passthrough(connection, msg):
+    from megatron import aws
+    from megatron.connections.slack import safe_requests
+
+    urls = []
+    for file_data in msg["files"]:
+        response = safe_requests.get(
+            file_data["url_private"],
+            headers={"Authorization": f"Bearer {connection.token}"},
+        )
+        image = response.content
+        key = "temp/{}.png".format(len(urls))
+        aws.S3_CLIENTS._build_client().put_object(
+            Bucket=aws.settings.AWS_S3_BUCKET, Key=key, Body=image
+        )
+        urls.append(aws.generate_presigned_url(key))
+    return urls
+
+
+def run(mode, size, files, s3_url):
+    with FakeSlack() as fake_slack:
+        _django.setup(
+            SLACK_API_URL=fake_slack.url,
+            AWS_S3_ENDPOINT_URL=s3_url,
+            S3_UPLOAD_CONCURRENCY=str(files),
+        )
+        from django.conf import settings
+
+        from megatron import aws
+        from megatron.connections.slack import SlackConnection
+
+        settings.CACHES = {
+            "default": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache"}
+        }
+
+        connection = SlackConnection("xoxb-benchmark")
+        base_url = fake_slack.url.rsplit("/", 1)[0]
+        msg = {
+            "ts": "1600000000.000001",
+            "files": [
+                {"url_private": "{}/files/{}/image{}.png".format(base_url, size, i)}
+                for i in range(files)
+            ],
+        }
+        user = type("User", (), {"username": "bench", "profile_image": ""})()
+
+        start_rss = current_rss()
+        start = time.perf_counter()
+        if mode == "serial":
+            uploaded = len(serial_passthrough(connection, msg))
+        else:
+            uploaded = len(connection.build_img_attach(msg, user)["attachments"])
+        elapsed = time.perf_counter() - start
+        assert uploaded == files, uploaded
+        print("{} {}".format(elapsed, peak_rss() - start_rss))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--sizes", default="10,50,200", help="file sizes in MB")
+    parser.add_argument("--files", type=int, default=4)
+    parser.add_argument("--baseline-max", type=int, default=50)
+    parser.add_argument("--run", nargs=4, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.run:
+        mode, size, files, s3_url = args.run
+        run(mode, int(size), int(files), s3_url)
+        return
+
+    port = free_port()
+    s3_url = "http://127.0.0.1:{}".format(port)
+    moto = subprocess.Popen(
+        ["moto_server", "-p", str(port)],
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+    )
+    try:
+        for _ in range(100):
+            try:
+                urllib.request.urlopen(s3_url)
+                break
+            except OSError:
+                time.sleep(0.1)
+        boto3.client(
+            "s3",
+            endpoint_url=s3_url,
+            region_name="us-east-2",
+            aws_access_key_id="benchmark",
+            aws_secret_access_key="benchmark",
+        ).create_bucket(
+            Bucket=_django.BENCHMARK_ENV["AWS_S3_BUCKET"],
+            CreateBucketConfiguration={"LocationConstraint": "us-east-2"},
+        )
+
+        print("files per message={}".format(args.files))
+        print(
+            "{:>8} {:>10} {:>10} {:>14}".format(
+                "file MB", "mode", "seconds", "rss delta MB"
+            )
+        )
+        for size in [int(s) for s in args.sizes.split(",")]:
+            modes = ["streaming"]
+            if size <= args.baseline_max:
+                modes.insert(0, "serial")
+            for mode in modes:
+                output = subprocess.check_output(
+                    [
+                        sys.executable,
+                        "-m",
+                        "benchmarks.image_passthrough",
+                        "--run",
+                        mode,
+                        str(size * MB),
+                        str(args.files),
+                        s3_url,
+                    ]
+                )
+                elapsed, rss = output.split()[-2:]
+                print(
+                    "{:>8} {:>10} {:>10.2f} {:>14.1f}".format(
+                        size, mode, float(elapsed), int(rss) / MB
+                    )
+                )
+    finally:
+        moto.terminate()
+        moto.wait()
+
+
+if __name__ == "__main__":
+    main()
@@ -5,3 +5,6 @@ from megatron.celery import app as celery_app
 # This will make sure the app is always imported when
 # Django starts so that shared_task will use this app.
 __all__ = ["celery_app"]
+
+# Times the tasks of every process publishing them, see megatron.lanes.
+from megatron import lanes  # noqa: E402,F401
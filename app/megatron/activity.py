@@ -0,0 +1,191 @@
+import logging
+import time
+import uuid
+from datetime import datetime
+from typing import Dict, Iterable, List, Optional
+
+from celery import shared_task
+from django.conf import settings
+from django.core.cache import cache
+from django.db.models import Case, DateTimeField, Value, When
+from django.db.models.functions import Greatest
+from django.utils import timezone
+
+from megatron import metrics
+from megatron.models import MegatronChannel
+
+
+LOGGER = logging.getLogger(__name__)
+STATS = metrics.counters("channel_activity")
+
+SEQ_KEY = "activity:seq"
+FLUSHED_KEY = "activity:flushed"
+LOCK_KEY = "activity:flush_lock"
+# Most journal entries a single flush goes through, the rest wait for the
+# next one.
+MAX_FLUSH_ENTRIES = 10000
+UPDATE_BATCH_SIZE = 500
+
+
+def _activity_key(channel_id: int) -> str:
+    return f"activity:{channel_id}"
+
+
+def _queued_key(channel_id: int) -> str:
+    return f"activity:{channel_id}:queued"
+
+
+def _log_key(seq: int) -> str:
+    return f"activity:log:{seq}"
+
+
+def _gap_key(seq: int) -> str:
+    return f"activity:log:{seq}:gap"
+
+
+def _as_datetime(timestamp: float) -> datetime:
+    moment = datetime.fromtimestamp(timestamp, timezone.utc)
+    return moment if settings.USE_TZ else timezone.make_naive(moment)
+
+
+def _next_sequence() -> Optional[int]:
+    cache.add(SEQ_KEY, 0, None)
+    try:
+        return cache.incr(SEQ_KEY)
+    except ValueError:
+        return None
+
+
+def touch(channel: MegatronChannel) -> None:
+    """
+    Records that a message was just sent in the channel.
+
+    The time goes to redis, and the channel to a journal the first time it
+    is touched since the last flush. `flush_activity` then writes all of
+    them to the database in batched UPDATEs, so a busy channel costs one
+    write per flush instead of one per message. Without redis the time is
+    written through.
+    """
+    now = time.time()
+    channel.last_message_sent = _as_datetime(now)
+    cache.set(_activity_key(channel.id), now, settings.ACTIVITY_TTL)
+    queued = cache.add(
+        _queued_key(channel.id), 1, settings.ACTIVITY_FLUSH_INTERVAL * 10
+    )
+    if queued is False:
+        STATS.incr("coalesced")
+        return
+    seq = _next_sequence() if queued else None
+    if seq is None:
+        STATS.incr("written_through")
+        _write({channel.id: now})
+        return
+    cache.set(_log_key(seq), channel.id, settings.ACTIVITY_TTL)
+    STATS.incr("queued")
+
+
+def pending_timestamps(channel_ids: Iterable[int]) -> Dict[int, float]:
+    """
+    The last activity redis knows of for each channel, as a unix timestamp.
+    It can be newer than `last_message_sent` until the next flush.
+    """
+    keys = {_activity_key(channel_id): channel_id for channel_id in channel_ids}
+    found = cache.get_many(list(keys))
+    return {keys[key]: timestamp for key, timestamp in found.items()}
+
+
+def last_active(channel: MegatronChannel, pending: Dict[int, float] = None) -> datetime:
+    """
+    The channel's `last_message_sent`, or its pending activity if newer.
+    Pass `pending_timestamps` of many channels to look them up at once.
+    """
+    if pending is None:
+        pending = pending_timestamps([channel.id])
+    stored = channel.last_message_sent
+    if channel.id not in pending:
+        return stored
+    latest = datetime.fromtimestamp(pending[channel.id], timezone.utc)
+    if not timezone.is_aware(stored):
+        latest = timezone.make_naive(latest)
+    return max(stored, latest)
+
+
+def _journal() -> range:
+    flushed = cache.get(FLUSHED_KEY) or 0
+    last = min(cache.get(SEQ_KEY) or 0, flushed + MAX_FLUSH_ENTRIES)
+    return range(flushed + 1, last + 1)
+
+
+def pending_channel_ids() -> List[int]:
+    """
+    Channels touched since the last flush.
+    """
+    logged = cache.get_many([_log_key(seq) for seq in _journal()])
+    return list(set(logged.values()))
+
+
+def _write(timestamps: Dict[int, float]) -> None:
+    # Greatest, as the database may already hold a newer time, e.g. from
+    # unarchiving the channel.
+    items = sorted(timestamps.items())
+    for start in range(0, len(items), UPDATE_BATCH_SIZE):
+        batch = items[start : start + UPDATE_BATCH_SIZE]
+        latest = Case(
+            *[
+                When(id=channel_id, then=Value(_as_datetime(timestamp)))
+                for channel_id, timestamp in batch
+            ],
+            output_field=DateTimeField(),
+        )
+        MegatronChannel.objects.filter(
+            id__in=[channel_id for channel_id, _ in batch]
+        ).update(last_message_sent=Greatest("last_message_sent", latest))
+
+
+def _flush() -> int:
+    journal = _journal()
+    logged = cache.get_many([_log_key(seq) for seq in journal])
+    channel_ids = set()
+    flushed = journal.start - 1
+    for seq in journal:
+        channel_id = logged.get(_log_key(seq))
+        if channel_id is None:
+            # Either a touch between its incr and set, wait for it, or one
+            # whose worker died in between, skip it the second time round.
+            if cache.add(_gap_key(seq), 1, settings.ACTIVITY_TTL) is not False:
+                break
+            STATS.incr("lost")
+        else:
+            channel_ids.add(channel_id)
+        flushed = seq
+    if flushed < journal.start:
+        return 0
+
+    # Unmarked first: a touch from here on is journaled again, and one
+    # before the timestamps are read is part of this flush anyway.
+    if channel_ids:
+        cache.delete_many([_queued_key(channel_id) for channel_id in channel_ids])
+    timestamps = pending_timestamps(channel_ids)
+    _write(timestamps)
+    cache.set(FLUSHED_KEY, flushed, None)
+    cache.delete_many([_log_key(seq) for seq in range(journal.start, flushed + 1)])
+    STATS.incr("flushed", len(timestamps))
+    return len(timestamps)
+
+
+@shared_task
+def flush_activity() -> int:
+    """
+    Writes the activity touched since the last flush to the database.
+    Returns the number of channels updated.
+    """
+    token = uuid.uuid4().hex
+    if cache.add(LOCK_KEY, token, settings.ACTIVITY_FLUSH_INTERVAL * 10) is False:
+        return 0
+    started = time.monotonic()
+    try:
+        return _flush()
+    finally:
+        STATS.timing("flush_seconds", time.monotonic() - started)
+        if cache.get(LOCK_KEY) == token:
+            cache.delete(LOCK_KEY)
@@ -2,3 +2,4 @@ from django.contrib import admin
 from megatron import models
 
 admin.site.register(models.MegatronUser)
+admin.site.register(models.DeadLetter)
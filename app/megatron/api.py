@@ -1,6 +1,6 @@
 import logging
 import json
-from copy import deepcopy
+from typing import Dict, Optional, Tuple
 
 from django.conf import settings
 from django.contrib.auth.models import User
@@ -9,10 +9,13 @@ from rest_framework.decorators import api_view, permission_classes
 from rest_framework.permissions import IsAuthenticated
 from rest_framework import status
 
+from megatron import broadcasts, metrics
 from megatron.connections.actions import ActionType, Action
+from megatron.deduplication import first_delivery, forget_delivery
 from megatron.statics import RequestData, NotificationChannels
 from megatron.responses import MegatronResponse, OK_RESPONSE
 from megatron.models import (
+    Broadcast,
     MegatronChannel,
     MegatronIntegration,
     MegatronMessage,
@@ -21,76 +24,201 @@ from megatron.models import (
 )
 from megatron.services import IntegrationService
 from megatron.bot_types import BotType
-from megatron.errors import raise_error, BroadcastError
+from megatron.errors import raise_error, BroadcastError, MegatronTransientError
 
 
 LOGGER = logging.getLogger(__name__)
+STATS = metrics.counters("relay")
 BOT_TYPE = BotType.slack
 
 
+def _channels_by_user(user_ids) -> Dict[str, MegatronChannel]:
+    """
+    The channel of each user, in a single query. Users with several
+    channels get their oldest one, like `filter(...).first()` would.
+    """
+    channels: Dict[str, MegatronChannel] = {}
+    queryset = (
+        MegatronChannel.objects.with_related()
+        .filter(platform_user_id__in=set(user_ids))
+        .order_by("id")
+    )
+    for channel in queryset:
+        channels.setdefault(channel.platform_user_id, channel)
+    return channels
+
+
+def _relay_incoming(
+    msg: dict, channel: Optional[MegatronChannel]
+) -> Tuple[dict, Optional[MegatronMessage]]:
+    """
+    Posts a customer's message to the agents' channel. Returns the result in
+    the `{"ok", "track"}` shape and, for watched channels, the message link
+    to store.
+    """
+    if not channel or channel.is_archived:
+        return {"ok": True, "track": False}, None
+    if not first_delivery("incoming", channel.platform_channel_id, msg.get("ts")):
+        return {"ok": True, "track": True}, None
+    interpreter = IntegrationService(channel.megatron_integration).get_interpreter()
+    try:
+        response = interpreter.incoming(msg, channel) or {}
+    except Exception:
+        forget_delivery("incoming", channel.platform_channel_id, msg.get("ts"))
+        raise
+    if not response.get("ok"):
+        forget_delivery("incoming", channel.platform_channel_id, msg.get("ts"))
+        return {"ok": False, "track": False, "error": response.get("error")}, None
+    link = None
+    if response.get("watched_channel"):
+        link = MegatronMessage(
+            integration_msg_id=response["ts"],
+            customer_msg_id=msg["ts"],
+            megatron_channel=channel,
+        )
+    return {"ok": True, "track": True}, link
+
+
+def _relay_outgoing(
+    data: dict, channel: Optional[MegatronChannel]
+) -> Tuple[dict, Optional[MegatronMessage]]:
+    """
+    Posts the bot's answer to the agents' channel, see `_relay_incoming`.
+    """
+    message = data["message"]
+    try:
+        message["attachments"] = json.loads(message.get("attachments"))
+    except TypeError:
+        pass
+    if not channel or channel.is_archived:
+        return {"ok": True, "track": False}, None
+    if not first_delivery("outgoing", channel.platform_channel_id, data.get("ts")):
+        return {"ok": True, "track": True}, None
+
+    interpreter = IntegrationService(channel.megatron_integration).get_interpreter()
+    try:
+        response = interpreter.outgoing(message, channel)
+    except Exception:
+        forget_delivery("outgoing", channel.platform_channel_id, data.get("ts"))
+        raise
+    if not response.get("ok"):
+        forget_delivery("outgoing", channel.platform_channel_id, data.get("ts"))
+        return {"ok": False, "track": False, "error": response.get("error")}, None
+    link = None
+    if response.get("watched_channel"):
+        link = MegatronMessage(
+            integration_msg_id=response["ts"],
+            customer_msg_id=data["ts"],
+            megatron_channel=channel,
+        )
+    return {"ok": True, "track": True}, link
+
+
+def _relay_batch(request, relay) -> MegatronResponse:
+    """
+    Relays every item of `messages` in the order given, which keeps each
+    channel's messages in order, and stores the message links of the whole
+    batch at once. One failed item doesn't stop the others.
+    """
+    items = request.data.get("messages")
+    if not isinstance(items, list) or not all(isinstance(i, dict) for i in items):
+        return MegatronResponse({"error": "Missing required param 'messages'."}, 400)
+    if len(items) > settings.RELAY_BATCH_SIZE:
+        return MegatronResponse(
+            {"error": f"At most {settings.RELAY_BATCH_SIZE} messages per batch."}, 400
+        )
+
+    results, links = [], []
+    for result, link in relay(items):
+        results.append(result)
+        if link:
+            links.append(link)
+    # Everything was delivered by now; a link stored by an earlier attempt
+    # mustn't turn the whole batch into an error.
+    MegatronMessage.objects.bulk_create(links, ignore_conflicts=True)
+    STATS.incr("batches")
+    STATS.incr("batch_messages", len(items))
+    return MegatronResponse({"ok": True, "results": results}, 200)
+
+
+def _safe_relay(relay, *args) -> Tuple[dict, Optional[MegatronMessage]]:
+    try:
+        return relay(*args)
+    except Exception as ex:
+        LOGGER.exception("Failed to relay message in batch.")
+        return {"ok": False, "track": False, "error": str(ex)}, None
+
+
 @api_view(http_method_names=["POST"])
 @permission_classes((IsAuthenticated,))
 def incoming(request) -> MegatronResponse:
     msg = request.data["message"]
-    megatron_user = request.user
-    integration = megatron_user.megatronintegration_set.first()
-    team_interpreter = IntegrationService(integration).get_interpreter()
-    channel = MegatronChannel.objects.filter(platform_user_id=msg["user"]).first()
-    if not channel or channel.is_archived:
-        return MegatronResponse({"ok": True, "track": False}, 200)
-    response = team_interpreter.incoming(msg, channel)
-    if response.get("ok"):
+    channel = (
+        MegatronChannel.objects.with_related()
+        .filter(platform_user_id=msg["user"])
+        .first()
+    )
+    result, link = _relay_incoming(msg, channel)
+    if link:
+        link.save()
+    if not result["ok"]:
+        return MegatronResponse(result["error"], 500)
+    if not result["track"]:
+        return MegatronResponse(result, 200)
+    return OK_RESPONSE
 
-        if response.get("watched_channel"):
-            channel = MegatronChannel.objects.filter(
-                platform_user_id=request.data["message"]["user"]
-            ).first()
-            MegatronMessage.objects.create(
-                integration_msg_id=response["ts"],
-                customer_msg_id=request.data["message"]["ts"],
-                megatron_channel=channel,
-            )
 
-        return OK_RESPONSE
-    return MegatronResponse(response.get("error"), 500)
+@api_view(http_method_names=["POST"])
+@permission_classes((IsAuthenticated,))
+def incoming_batch(request) -> MegatronResponse:
+    def relay(messages):
+        channels = _channels_by_user(msg.get("user") for msg in messages)
+        for msg in messages:
+            channel = channels.get(msg.get("user"))
+            yield _safe_relay(_relay_incoming, msg, channel)
+
+    return _relay_batch(request, relay)
 
 
 @api_view(http_method_names=["POST"])
 @permission_classes((IsAuthenticated,))
 def outgoing(request) -> MegatronResponse:
-    user_id = request.data["user"]
-    message = request.data["message"]
     try:
-        message["attachments"] = json.loads(message["attachments"])
-    except TypeError:
-        pass
-    try:
-        megatron_channel = MegatronChannel.objects.get(platform_user_id=user_id)
+        megatron_channel = MegatronChannel.objects.with_related().get(
+            platform_user_id=request.data["user"]
+        )
     except MegatronChannel.DoesNotExist:
-        return MegatronResponse({"ok": True, "track": False}, 200)
-    if megatron_channel.is_archived:
-        return MegatronResponse({"ok": True, "track": False}, 200)
+        megatron_channel = None
+    result, link = _relay_outgoing(request.data, megatron_channel)
+    if link:
+        link.save()
+    if not result["ok"]:
+        return MegatronResponse({"error": result["error"], "track": False}, 500)
+    return MegatronResponse(result, 200)
 
-    megatron_integration = megatron_channel.megatron_integration
-    interpreter = IntegrationService(megatron_integration).get_interpreter()
-    response = interpreter.outgoing(message, megatron_channel)
-    if response.get("ok"):
-        if response.get("watched_channel"):
-            megatron_msg = MegatronMessage(
-                integration_msg_id=response["ts"],
-                customer_msg_id=request.data["ts"],
-                megatron_channel=megatron_channel,
-            )
-            megatron_msg.save()
 
-        return MegatronResponse({"ok": True, "track": True}, 200)
-    return MegatronResponse({"error": response.get("error"), "track": False}, 500)
+@api_view(http_method_names=["POST"])
+@permission_classes((IsAuthenticated,))
+def outgoing_batch(request) -> MegatronResponse:
+    def relay(items):
+        channels = _channels_by_user(item.get("user") for item in items)
+        for item in items:
+            channel = channels.get(item.get("user"))
+            yield _safe_relay(_relay_outgoing, item, channel)
+
+    return _relay_batch(request, relay)
 
 
 def test(request):
     return MegatronResponse({"ok": True}, 200)
 
 
+@api_view(http_method_names=["GET"])
+@permission_classes((IsAuthenticated,))
+def stats(request) -> MegatronResponse:
+    return MegatronResponse({"ok": True, "stats": metrics.snapshot()}, 200)
+
+
 @api_view(http_method_names=["POST"])
 def notify_user(request) -> MegatronResponse:
     msg = request.data["message"]
@@ -99,7 +227,7 @@ def notify_user(request) -> MegatronResponse:
     platform_type = request.data["platform_type"]
     request_data = RequestData(channel_id=channel_id, user_id=user_id, response_url="")
     platform_type = PlatformType[platform_type.capitalize()].value
-    megatron_channel = MegatronChannel.objects.get(
+    megatron_channel = MegatronChannel.objects.with_related().get(
         platform_channel_id=channel_id, workspace__platform_type=platform_type
     )
     connection = IntegrationService(
@@ -114,7 +242,6 @@ def notify_user(request) -> MegatronResponse:
 @api_view(http_method_names=["POST"])
 @permission_classes((IsAuthenticated,))
 def broadcast(request) -> MegatronResponse:
-    warnings: list = []
     required_params = ["text", "broadcasts"]
     for param in required_params:
         if param not in request.data:
@@ -122,7 +249,7 @@ def broadcast(request) -> MegatronResponse:
                 {"error": f"Missing required param '{param}'."}, 400
             )
     text = request.data.get("text")
-    broadcasts = request.data.get("broadcasts")
+    broadcast_list = request.data.get("broadcasts")
 
     try:
         message = json.loads(text)
@@ -136,31 +263,20 @@ def broadcast(request) -> MegatronResponse:
     except KeyError:
         capture_feedback = False
 
-    org_errors = {}
-    for broadcast in broadcasts:
-        bot_type = BotType[broadcast["platform_type"]]
-        org_platform_id = broadcast["org_id"]
-        user_ids = broadcast["user_ids"]
-        connection = bot_type.get_bot_connection_from_platform_id(org_platform_id)
-        # deepcopy prevents direct mutation of original broadcast
-        action = Action(
-            ActionType.BROADCAST,
-            {
-                "broadcast": deepcopy(message),
-                "user_ids": user_ids,
-                "capture_feedback": capture_feedback,
-            },
-        )
-        response = connection.take_action(action)
-        if not response.get("ok"):
-            org_errors.update({org_platform_id: response.get("errors")})
-
-    if org_errors:
-        return MegatronResponse({"errors": org_errors}, 200)
-    elif warnings:
-        return MegatronResponse({"ok": True, "warnings": warnings}, 200)
-    else:
-        return OK_RESPONSE
+    job = broadcasts.create_broadcast(message, broadcast_list, capture_feedback)
+    broadcasts.deliver_broadcast.delay(job.id)
+    return MegatronResponse({"ok": True, "broadcast_id": job.id}, 200)
+
+
+@api_view(http_method_names=["GET"])
+@permission_classes((IsAuthenticated,))
+def broadcast_status(request, broadcast_id) -> MegatronResponse:
+    try:
+        job = Broadcast.objects.get(id=int(broadcast_id))
+    except Broadcast.DoesNotExist:
+        return MegatronResponse({"error": "Broadcast not found."}, 404)
+    progress = broadcasts.get_progress(job)
+    return MegatronResponse({"ok": True, **progress}, 200)
 
 
 @api_view(http_method_names=["POST"])
@@ -177,7 +293,10 @@ def message(request, user_id) -> MegatronResponse:
         )
     organization = user.profile.organization
     connection = bot_type.get_bot_connection(organization)
-    response = connection.dm_user(user.slackuser.slack_id, msg)
+    try:
+        response = connection.dm_user(user.slackuser.slack_id, msg)
+    except MegatronTransientError as exc:
+        return MegatronResponse(exc.platform_message, 503)
     if response.get("ok"):
         return OK_RESPONSE
     return MegatronResponse(response.get("error"), response.get("status"))
@@ -198,7 +317,7 @@ def edit(request):
             pass
 
     try:
-        megatron_channel = MegatronChannel.objects.get(
+        megatron_channel = MegatronChannel.objects.with_related().get(
             platform_user_id=data["message"]["user"]
         )
         existing_message = MegatronMessage.objects.get(
@@ -1,17 +1,28 @@
 from enum import Enum, auto
 import logging
+import os
+import threading
+import time
 import uuid
-from typing import Optional
+from typing import Iterable, Iterator, Optional
 import json
 
 import boto3
 import botocore
+import requests
 from botocore.client import Config
 from django.conf import settings
 from social_core.utils import slugify
 
+from megatron import metrics
+from megatron.caching import TwoTierCache
+
 
 LOGGER = logging.getLogger(__name__)
+STATS = metrics.counters("s3")
+PRESIGNED_URLS = TwoTierCache(
+    "presigned_urls", ttl=settings.S3_PRESIGNED_URL_EXPIRY // 2
+)
 
 
 class S3Folders(Enum):
@@ -21,46 +32,172 @@ class S3Folders(Enum):
 S3FoldersNames = {S3Folders.TEMP: "temp"}
 
 
+class S3ClientFactory:
+    """
+    Hands out one S3 client per process. Clients are thread-safe and keep a
+    pool of connections, but building one is slow and not thread-safe.
+
+    Like the HTTP session pool, the client is rebuilt when the process id
+    changes so forked workers never share connections with their parent.
+    """
+
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self._client = None
+        self._pid = os.getpid()
+
+    def get(self):
+        with self._lock:
+            if self._client is None or self._pid != os.getpid():
+                self._client = self._build_client()
+                self._pid = os.getpid()
+            return self._client
+
+    @staticmethod
+    def _build_client():
+        return boto3.session.Session().client(
+            "s3",
+            aws_access_key_id=settings.AWS_ACCESS_KEY,
+            aws_secret_access_key=settings.AWS_SECRET_KEY,
+            region_name="us-east-2",
+            endpoint_url=settings.AWS_S3_ENDPOINT_URL,
+            config=Config(
+                signature_version="s3v4",
+                max_pool_connections=settings.S3_MAX_POOL_CONNECTIONS,
+            ),
+        )
+
+
+S3_CLIENTS = S3ClientFactory()
+
+
+def s3_client():
+    return S3_CLIENTS.get()
+
+
+def _uploaded_bytes_per_second() -> float:
+    seconds = STATS.timings().get("upload_seconds", {}).get("total")
+    if not seconds:
+        return 0.0
+    return round(STATS.counts().get("uploaded_bytes", 0) / seconds, 1)
+
+
+STATS.gauge("bytes_per_second", _uploaded_bytes_per_second)
+
+
+def _record_upload(size: int, started: float) -> None:
+    STATS.incr("uploads")
+    STATS.incr("uploaded_bytes", size)
+    STATS.timing("upload_seconds", time.perf_counter() - started)
+
+
 def upload_to_s3(data, file_name, folder: S3Folders = S3Folders.TEMP) -> bool:
     """
     Uploads a file to S3 at a given folder path
     """
     key = S3FoldersNames[folder] + "/" + file_name
 
-    s3 = boto3.resource(
-        "s3",
-        aws_access_key_id=settings.AWS_ACCESS_KEY,
-        aws_secret_access_key=settings.AWS_SECRET_KEY,
-        region_name="us-east-2",
-        config=Config(signature_version="s3v4"),
-    )
-
+    started = time.perf_counter()
     try:
-        s3.Bucket(settings.AWS_S3_BUCKET).put_object(Key=key, Body=data)
+        s3_client().put_object(Bucket=settings.AWS_S3_BUCKET, Key=key, Body=data)
     except botocore.exceptions.ClientError:
         LOGGER.exception("Error uploading files to s3")
+        STATS.incr("failed")
         return False
 
+    _record_upload(len(data), started)
+    return True
+
+
+def _parts(chunks: Iterable[bytes], part_size: int) -> Iterator[bytes]:
+    """
+    Groups chunks into parts of at least `part_size` bytes, only the last one
+    may be smaller.
+    """
+    part = bytearray()
+    for chunk in chunks:
+        part += chunk
+        if len(part) >= part_size:
+            yield bytes(part)
+            part = bytearray()
+    if part:
+        yield bytes(part)
+
+
+def stream_to_s3(
+    chunks: Iterable[bytes], file_name, folder: S3Folders = S3Folders.TEMP
+) -> bool:
+    """
+    Uploads a file to S3 as it is read, holding about one part of
+    S3_UPLOAD_PART_SIZE bytes in memory. Files that fit in a single part are
+    sent with a plain put.
+    """
+    key = S3FoldersNames[folder] + "/" + file_name
+    bucket = settings.AWS_S3_BUCKET
+    s3 = s3_client()
+    parts = _parts(chunks, settings.S3_UPLOAD_PART_SIZE)
+
+    started = time.perf_counter()
+    upload_id = None
+    try:
+        first_part = next(parts, b"")
+        size = len(first_part)
+        if size < settings.S3_UPLOAD_PART_SIZE:
+            s3.put_object(Bucket=bucket, Key=key, Body=first_part)
+            _record_upload(size, started)
+            return True
+
+        upload_id = s3.create_multipart_upload(Bucket=bucket, Key=key)["UploadId"]
+        uploaded = []
+        part_number = 1
+        part = first_part
+        while part:
+            response = s3.upload_part(
+                Bucket=bucket,
+                Key=key,
+                UploadId=upload_id,
+                PartNumber=part_number,
+                Body=part,
+            )
+            uploaded.append({"ETag": response["ETag"], "PartNumber": part_number})
+            part_number += 1
+            part = next(parts, b"")
+            size += len(part)
+        s3.complete_multipart_upload(
+            Bucket=bucket,
+            Key=key,
+            UploadId=upload_id,
+            MultipartUpload={"Parts": uploaded},
+        )
+    except (botocore.exceptions.ClientError, requests.RequestException):
+        LOGGER.exception("Error streaming file to s3")
+        STATS.incr("failed")
+        if upload_id:
+            s3.abort_multipart_upload(Bucket=bucket, Key=key, UploadId=upload_id)
+        return False
+
+    _record_upload(size, started)
     return True
 
 
 def generate_presigned_url(file_name, folder: S3Folders = S3Folders.TEMP) -> str:
     """
-    Generates a download link for a file stored in S3
+    Generates a download link for a file stored in S3. Links are reused for
+    the first half of their lifetime, so a link handed out is always valid
+    for at least S3_PRESIGNED_URL_EXPIRY / 2 seconds.
     """
     key = S3FoldersNames[folder] + "/" + file_name
 
-    s3 = boto3.client(
-        "s3",
-        aws_access_key_id=settings.AWS_ACCESS_KEY,
-        aws_secret_access_key=settings.AWS_SECRET_KEY,
-        region_name="us-east-2",
-        config=Config(signature_version="s3v4"),
-    )
+    url = PRESIGNED_URLS.get(key)
+    if url:
+        return url
 
-    url = s3.generate_presigned_url(
-        ClientMethod="get_object", Params={"Bucket": settings.AWS_S3_BUCKET, "Key": key}
+    url = s3_client().generate_presigned_url(
+        ClientMethod="get_object",
+        Params={"Bucket": settings.AWS_S3_BUCKET, "Key": key},
+        ExpiresIn=settings.S3_PRESIGNED_URL_EXPIRY,
     )
+    PRESIGNED_URLS.set(key, url)
 
     return url
 
@@ -73,3 +210,13 @@ def upload_temp_image(image: bytes, extension: str) -> Optional[str]:
         LOGGER.error(f"Error uploading the image to S3 with key", extra={"Key": key})
         return None
     return key
+
+
+def stream_temp_image(chunks: Iterable[bytes], extension: str) -> Optional[str]:
+    key = slugify(f"{uuid.uuid4()}") + extension
+    success = stream_to_s3(chunks, key, S3Folders.TEMP)
+
+    if not success:
+        LOGGER.error(f"Error uploading the image to S3 with key", extra={"Key": key})
+        return None
+    return key
@@ -0,0 +1,188 @@
+import json
+import logging
+from datetime import datetime, timedelta
+from itertools import groupby
+from typing import List
+
+from celery import shared_task
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Count
+
+from megatron.bot_types import BotType
+from megatron.connections.actions import Action, ActionType
+from megatron.models import (
+    Broadcast,
+    BroadcastRecipient,
+    CustomerWorkspace,
+    DeliveryStatus,
+)
+
+
+LOGGER = logging.getLogger(__name__)
+
+# Recipients delivered between two progress updates of a broadcast. Small
+# enough that a chunk held back by the rate limits never looks stalled,
+# see resume_broadcasts.
+PROGRESS_BATCH_SIZE = 50
+
+
+def create_broadcast(
+    message: dict, broadcasts: List[dict], capture_feedback: bool
+) -> Broadcast:
+    broadcast = Broadcast.objects.create(
+        message=json.dumps(message), capture_feedback=capture_feedback
+    )
+    recipients = [
+        BroadcastRecipient(
+            broadcast=broadcast,
+            platform_type=org_broadcast["platform_type"],
+            org_id=org_broadcast["org_id"],
+            platform_user_id=user_id,
+        )
+        for org_broadcast in broadcasts
+        for user_id in org_broadcast["user_ids"]
+    ]
+    BroadcastRecipient.objects.bulk_create(
+        recipients, batch_size=settings.BROADCAST_CHUNK_SIZE, ignore_conflicts=True
+    )
+    return broadcast
+
+
+def get_progress(broadcast: Broadcast) -> dict:
+    counts = dict(
+        broadcast.recipients.values_list("status")
+        .annotate(count=Count("id"))
+        .order_by()
+    )
+    failed = broadcast.recipients.filter(status=DeliveryStatus.failed.value).order_by(
+        "id"
+    )
+    org_errors: dict = {}
+    for recipient in failed:
+        org_errors.setdefault(recipient.org_id, []).append(
+            {recipient.platform_user_id: recipient.error}
+        )
+    return {
+        "broadcast_id": broadcast.id,
+        "finished": broadcast.is_finished,
+        "sent": counts.get(DeliveryStatus.sent.value, 0),
+        "failed": counts.get(DeliveryStatus.failed.value, 0),
+        "pending": (
+            counts.get(DeliveryStatus.pending.value, 0)
+            + counts.get(DeliveryStatus.sending.value, 0)
+        ),
+        "errors": org_errors,
+    }
+
+
+@shared_task
+def deliver_broadcast(broadcast_id: int):
+    """
+    Delivers the next chunk of pending recipients, then queues itself again
+    until none are left. Recipients are marked `sending` before any message
+    goes out so an interrupted chunk is never delivered twice.
+    """
+    with transaction.atomic():
+        broadcast = Broadcast.objects.select_for_update().get(id=broadcast_id)
+        if broadcast.is_finished:
+            return
+        chunk = list(
+            broadcast.recipients.filter(status=DeliveryStatus.pending.value).order_by(
+                "platform_type", "org_id", "id"
+            )[: settings.BROADCAST_CHUNK_SIZE]
+        )
+        if not chunk:
+            broadcast.is_finished = True
+            broadcast.save(update_fields=["is_finished", "updated_at"])
+            return
+        BroadcastRecipient.objects.filter(id__in=[r.id for r in chunk]).update(
+            status=DeliveryStatus.sending.value
+        )
+        broadcast.save(update_fields=["updated_at"])
+
+    def org_key(recipient):
+        return recipient.platform_type, recipient.org_id
+
+    for (platform_type, org_id), grouped in groupby(chunk, key=org_key):
+        org_recipients = list(grouped)
+        for start in range(0, len(org_recipients), PROGRESS_BATCH_SIZE):
+            batch = org_recipients[start : start + PROGRESS_BATCH_SIZE]
+            _deliver_to_org(broadcast, platform_type, org_id, batch)
+            Broadcast.objects.filter(id=broadcast_id).update(updated_at=datetime.now())
+
+    deliver_broadcast.delay(broadcast_id)
+
+
+def _deliver_to_org(broadcast, platform_type, org_id, recipients):
+    try:
+        bot_type = BotType[platform_type]
+        connection = bot_type.get_bot_connection_from_platform_id(org_id)
+    except (KeyError, CustomerWorkspace.DoesNotExist):
+        LOGGER.warning(
+            "Unable to broadcast to unknown organization.",
+            extra={"org_id": org_id, "platform_type": platform_type},
+        )
+        _mark(recipients, DeliveryStatus.failed, "Unknown organization.")
+        return
+
+    action = Action(
+        ActionType.BROADCAST,
+        {
+            "broadcast": json.loads(broadcast.message),
+            "user_ids": [r.platform_user_id for r in recipients],
+            "capture_feedback": broadcast.capture_feedback,
+        },
+    )
+    response = connection.take_action(action)
+    errors = {}
+    for error in response.get("errors") or []:
+        errors.update(error)
+    for recipient in recipients:
+        if recipient.platform_user_id in errors:
+            recipient.error = errors[recipient.platform_user_id]
+            recipient.status = DeliveryStatus.failed.value
+        else:
+            recipient.status = DeliveryStatus.sent.value
+    BroadcastRecipient.objects.bulk_update(recipients, ["status", "error"])
+
+
+def _mark(recipients, status: DeliveryStatus, error: str = None):
+    BroadcastRecipient.objects.filter(id__in=[r.id for r in recipients]).update(
+        status=status.value, error=error
+    )
+
+
+@shared_task
+def resume_broadcasts():
+    """
+    Picks up broadcasts whose delivery chain stopped, e.g. after a worker was
+    killed. Recipients caught mid-send may or may not have been messaged, so
+    they are marked failed rather than sent again. Should the chain turn out
+    to be alive after all, the outcome it records replaces that mark.
+    """
+    stalled_before = datetime.now() - timedelta(
+        minutes=settings.BROADCAST_STALL_MINUTES
+    )
+    stalled = list(
+        Broadcast.objects.filter(
+            is_finished=False, updated_at__lte=stalled_before
+        ).values_list("id", flat=True)
+    )
+    if not stalled:
+        return
+    # Checks the stall again, a chain that reported progress since is spared.
+    BroadcastRecipient.objects.filter(
+        broadcast_id__in=stalled,
+        broadcast__updated_at__lte=stalled_before,
+        status=DeliveryStatus.sending.value,
+    ).update(status=DeliveryStatus.failed.value, error="Delivery was interrupted.")
+    stalled = list(
+        Broadcast.objects.filter(
+            id__in=stalled, is_finished=False, updated_at__lte=stalled_before
+        ).values_list("id", flat=True)
+    )
+    Broadcast.objects.filter(id__in=stalled).update(updated_at=datetime.now())
+    for broadcast_id in stalled:
+        LOGGER.warning("Resuming stalled broadcast.", extra={"broadcast": broadcast_id})
+        deliver_broadcast.delay(broadcast_id)
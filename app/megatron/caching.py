@@ -0,0 +1,221 @@
+import hashlib
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from typing import Any, Callable, Dict, Hashable, List, Optional, Tuple
+
+from django.core.cache import cache
+
+from megatron import metrics
+
+
+class LRUCache:
+    """
+    Thread-safe, size-bounded, in-process cache with per-entry expiry.
+    """
+
+    def __init__(self, maxsize: int, ttl: float) -> None:
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._data: "OrderedDict[Hashable, Tuple[float, Any]]" = OrderedDict()
+
+    def get(self, key: Hashable) -> Optional[Any]:
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None:
+                return None
+            expires, value = entry
+            if expires < time.monotonic():
+                del self._data[key]
+                return None
+            self._data.move_to_end(key)
+            return value
+
+    def set(self, key: Hashable, value: Any, ttl: float = None) -> None:
+        expires = time.monotonic() + (self.ttl if ttl is None else ttl)
+        with self._lock:
+            self._data[key] = (expires, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def delete(self, key: Hashable) -> None:
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._data.clear()
+
+
+class TwoTierCache:
+    """
+    An in-process LRU in front of the shared (redis) django cache.
+
+    Lookups try the local LRU first, then redis, and only report a miss when
+    both are empty. Local entries live for at most `local_ttl` seconds so a
+    value invalidated by another process is not served for long.
+    """
+
+    def __init__(
+        self, name: str, ttl: int, maxsize: int = 10000, local_ttl: int = 300
+    ) -> None:
+        self.name = name
+        self.ttl = ttl
+        self.local = LRUCache(maxsize, min(ttl, local_ttl))
+        self.stats = metrics.counters(f"cache.{name}")
+        self.stats.gauge("hit_rate", self.hit_rate)
+        _CACHES[name] = self
+
+    def _key(self, key: str) -> str:
+        return f"{self.name}:{key}"
+
+    def get(self, key: str) -> Optional[Any]:
+        value = self.local.get(key)
+        if value is not None:
+            self.stats.incr("local_hit")
+            return value
+        value = cache.get(self._key(key))
+        if value is not None:
+            self.stats.incr("shared_hit")
+            self.local.set(key, value)
+            return value
+        self.stats.incr("miss")
+        return None
+
+    def get_many(self, keys: List[str]) -> Dict[str, Any]:
+        found = {}
+        remote_keys = []
+        for key in keys:
+            value = self.local.get(key)
+            if value is None:
+                remote_keys.append(key)
+            else:
+                found[key] = value
+        self.stats.incr("local_hit", len(found))
+        if remote_keys:
+            remote = cache.get_many([self._key(key) for key in remote_keys])
+            for key in remote_keys:
+                value = remote.get(self._key(key))
+                if value is not None:
+                    found[key] = value
+                    self.local.set(key, value)
+                    self.stats.incr("shared_hit")
+                else:
+                    self.stats.incr("miss")
+        return found
+
+    def set(self, key: str, value: Any) -> None:
+        self.local.set(key, value)
+        cache.set(self._key(key), value, self.ttl)
+
+    def delete(self, key: str) -> None:
+        self.local.delete(key)
+        cache.delete(self._key(key))
+        self.stats.incr("invalidated")
+
+    def hit_rate(self) -> float:
+        counts = self.stats.counts()
+        hits = counts.get("local_hit", 0) + counts.get("shared_hit", 0)
+        total = hits + counts.get("miss", 0)
+        return round(hits / total, 4) if total else 0.0
+
+
+_CACHES: Dict[str, TwoTierCache] = {}
+
+
+class _Call:
+    def __init__(self) -> None:
+        self.done = threading.Event()
+        self.result: Any = None
+        self.error: Optional[BaseException] = None
+
+
+class SingleFlight:
+    """
+    Runs one call at a time per key, concurrent callers share its result.
+
+    Threads of a process wait for the call their process already has in
+    flight. Across processes a redis lock picks the caller that runs it,
+    the others poll `lookup`, usually a read of the cache or table the call
+    fills, until it answers. Should the lock holder fail or take longer
+    than `wait` seconds, waiting callers make the call themselves. Without
+    redis only threads are coalesced.
+    """
+
+    def __init__(self, name: str, wait: float, poll: float = 0.05) -> None:
+        self.name = name
+        self.wait = wait
+        self.poll = poll
+        self.stats = metrics.counters(f"single_flight.{name}")
+        self._lock = threading.Lock()
+        self._calls: Dict[str, _Call] = {}
+
+    def do(
+        self, key: str, func: Callable[[], Any], lookup: Callable[[], Any] = None
+    ) -> Any:
+        with self._lock:
+            leader = key not in self._calls
+            if leader:
+                self._calls[key] = _Call()
+            call = self._calls[key]
+        if not leader:
+            self.stats.incr("shared_local")
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result
+
+        try:
+            call.result = self._do_shared(key, func, lookup)
+            return call.result
+        except BaseException as exc:
+            call.error = exc
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+
+    def _do_shared(self, key: str, func: Callable[[], Any], lookup) -> Any:
+        lock_key = f"single_flight:{self.name}:{key}"
+        token = uuid.uuid4().hex
+        deadline = time.monotonic() + self.wait
+        while cache.add(lock_key, token, self.wait) is False:
+            if lookup is not None:
+                result = lookup()
+                if result is not None:
+                    self.stats.incr("shared_remote")
+                    return result
+            if time.monotonic() > deadline:
+                self.stats.incr("lock_timeout")
+                return func()
+            time.sleep(self.poll)
+
+        # The previous holder may have finished between our lookup and add.
+        if lookup is not None:
+            result = lookup()
+            if result is not None:
+                cache.delete(lock_key)
+                self.stats.incr("shared_remote")
+                return result
+        self.stats.incr("calls")
+        try:
+            return func()
+        finally:
+            if cache.get(lock_key) == token:
+                cache.delete(lock_key)
+
+
+def clear_local_caches() -> None:
+    for two_tier_cache in _CACHES.values():
+        two_tier_cache.local.clear()
+
+
+def token_key(token: str) -> str:
+    """
+    Keys must not contain raw Slack tokens, they end up in redis.
+    """
+    return hashlib.sha1(token.encode()).hexdigest()[:16]
@@ -6,6 +6,17 @@ os.environ.setdefault("DJANGO_SETTINGS_MODULE", "megatron.settings")
 worker_mode = os.environ.get("WORKER_MODE", "non-celery")
 REDIS_URL = os.environ["REDIS_URL"]
 
+# Lanes in the order a worker consuming several of them drains them: a
+# live conversation first, bulk and maintenance work last. "megatron"
+# catches whatever isn't routed elsewhere.
+QUEUES = (
+    "megatron-live",
+    "megatron-events",
+    "megatron-commands",
+    "megatron-bulk",
+    "megatron",
+)
+
 
 class Config:
     broker_url = REDIS_URL
@@ -15,9 +26,39 @@ class Config:
     result_serializer = "json"
     enable_utc = True
     # BEWARE: Manually importing tasks
-    imports = ["megatron.scheduled_tasks"]
+    imports = [
+        "megatron.scheduled_tasks",
+        "megatron.broadcasts",
+        "megatron.interpreters.slack.api",
+        "megatron.delivery",
+        "megatron.activity",
+        "megatron.task_limits",
+    ]
     ignore_result = True
-    task_routes = ([("megatron.*", {"queue": "megatron"})],)
+    task_routes = (
+        [
+            (
+                "megatron.interpreters.slack.api.process_event",
+                {"queue": "megatron-events"},
+            ),
+            (
+                "megatron.commands.command_actions.forward_message",
+                {"queue": "megatron-live"},
+            ),
+            ("megatron.delivery.*", {"queue": "megatron-live"}),
+            ("megatron.commands.command_actions.*", {"queue": "megatron-commands"}),
+            # Due within a minute of the agent's last message, it mustn't wait
+            # behind the bulk tasks.
+            (
+                "megatron.scheduled_tasks.send_unpause_reminder",
+                {"queue": "megatron-commands"},
+            ),
+            ("megatron.scheduled_tasks.*", {"queue": "megatron-bulk"}),
+            ("megatron.broadcasts.*", {"queue": "megatron-bulk"}),
+            ("megatron.activity.*", {"queue": "megatron-bulk"}),
+            ("megatron.*", {"queue": "megatron"}),
+        ],
+    )
 
 
 app = Celery("megatron")
@@ -25,7 +66,12 @@ app.config_from_object(Config)
 
 # THIS MUST BE SET TO THE MAXIMUM DELAY AMOUNT THAT WILL EVER HAPPEN
 # VIA CELERY
-app.conf.broker_transport_options = {"visibility_timeout": (60 * 60 * 24 * 14) + 1}
+app.conf.broker_transport_options = {
+    "visibility_timeout": (60 * 60 * 24 * 14) + 1,
+    # Polls a worker's queues in the order of its -Q option rather than in
+    # turn, see QUEUES.
+    "queue_order_strategy": "priority",
+}
 
 CRONTABS = {
     "minutely": crontab(),
@@ -45,20 +91,32 @@ CRONTABS = {
 
 @app.on_after_configure.connect
 def setup_periodic_tasks(sender, **kwargs):
+    from django.conf import settings
+
     app.conf.beat_schedule = {
         "Refresh Platform User Data": {
             "task": "megatron.scheduled_tasks.refresh_platform_user_data",
             "schedule": CRONTABS["daily"],
-            "options": {"queue": "megatron"},
+            "options": {"queue": "megatron-bulk"},
         },
         "Remind Unpause Channel": {
             "task": "megatron.scheduled_tasks.unpause_reminder",
             "schedule": CRONTABS["minutely"],
-            "options": {"queue": "megatron"},
+            "options": {"queue": "megatron-bulk"},
         },
         "Archive Channels": {
             "task": "megatron.scheduled_tasks.archive_channels",
             "schedule": CRONTABS["daily"],
-            "options": {"queue": "megatron"},
+            "options": {"queue": "megatron-bulk"},
+        },
+        "Flush Channel Activity": {
+            "task": "megatron.activity.flush_activity",
+            "schedule": settings.ACTIVITY_FLUSH_INTERVAL,
+            "options": {"queue": "megatron-bulk"},
+        },
+        "Resume Broadcasts": {
+            "task": "megatron.broadcasts.resume_broadcasts",
+            "schedule": CRONTABS["five-minute-ly"],
+            "options": {"queue": "megatron-bulk"},
         },
     }
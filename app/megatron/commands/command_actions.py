@@ -1,13 +1,13 @@
 import logging
 import re
 from typing import Tuple
-from datetime import datetime, timezone, timedelta
+from datetime import datetime, timedelta
 
 import requests
-from celery import shared_task
 
 from django.conf import settings
 
+from megatron import activity
 from megatron.interpreters.slack import formatting
 from megatron.models import (
     MegatronChannel,
@@ -16,6 +16,8 @@ from megatron.models import (
     PlatformUser,
     CustomerWorkspace,
 )
+from megatron.retries import raise_for_transient, run_once, slack_task
+from megatron.scheduled_tasks import schedule_unpause_reminder
 from megatron.services import (
     IntegrationService,
     WorkspaceService,
@@ -27,7 +29,7 @@ from megatron.statics import RequestData
 LOGGER = logging.getLogger(__name__)
 
 
-@shared_task
+@slack_task
 def open_channel(
     megatron_user_id: int, serialized_request_data: dict, arguments: dict
 ) -> dict:
@@ -69,7 +71,7 @@ def open_channel(
     return response
 
 
-@shared_task
+@slack_task
 def close_channel(
     megatron_user_id: int, serialized_request_data: dict, arguments: dict
 ) -> dict:
@@ -93,20 +95,10 @@ def close_channel(
         as_user=False
     )
 
-    workspace = platform_user.workspace
-    megatron_channel = MegatronChannel.objects.get(
-        workspace=workspace, platform_user_id=platform_user.platform_id
-    )
-    if megatron_channel.is_paused:
-        response = _change_pause_state(
-            megatron_user, platform_user, request_data, False
-        )
-        if not response.get("ok"):
-            return response
-
     try:
-        megatron_channel = MegatronChannel.objects.get(
-            platform_user_id=platform_user.platform_id
+        megatron_channel = MegatronChannel.objects.with_related().get(
+            workspace=platform_user.workspace,
+            platform_user_id=platform_user.platform_id,
         )
     except MegatronChannel.DoesNotExist:
         new_msg = formatting.error_ephemeral(
@@ -116,6 +108,13 @@ def close_channel(
         integration_connection.respond_to_url(request_data.response_url, new_msg)
         return {"ok": False, "error": "Channel not found"}
 
+    if megatron_channel.is_paused:
+        response = _change_pause_state(
+            megatron_user, platform_user, request_data, False, megatron_channel
+        )
+        if not response.get("ok"):
+            return response
+
     response = MegatronChannelService(megatron_channel).archive()
 
     if response.get("ok"):
@@ -133,8 +132,10 @@ def close_channel(
 
 # TODO Clear this function and adequate it to sync execution, return of ephemeral messages and call parameter from
 #  the commands
-@shared_task
-def forward_message(channel: str, msg: dict, from_user: dict = None) -> dict:
+@slack_task
+def forward_message(
+    channel: str, msg: dict, from_user: dict = None, delivery_id: str = None
+) -> dict:
     engagement_channel = _check_channel(channel)
     if not engagement_channel:
         return {"ok": False, "error": f"Channel {channel} not found."}
@@ -144,10 +145,23 @@ def forward_message(channel: str, msg: dict, from_user: dict = None) -> dict:
     connection = WorkspaceService(workspace).get_connection()
     if from_user:
         msg = connection.add_forward_footer(msg, from_user)
-    response = connection.dm_user(platform_user_id, msg)
+    # Called from a drain, the message's delivery id stands in for the task id.
+    response = run_once(
+        forward_message,
+        "dm_user",
+        lambda: raise_for_transient(connection.dm_user(platform_user_id, msg)),
+        run_id=delivery_id,
+    )
+    if not response.get("ok"):
+        LOGGER.warning(
+            "Could not forward message to user.",
+            extra={"channel": channel, "error": response.get("error")},
+        )
+        return {"ok": False, "error": response.get("error")}
 
-    engagement_channel.last_message_sent = datetime.now(timezone.utc)
-    engagement_channel.save()
+    activity.touch(engagement_channel)
+    if engagement_channel.is_paused:
+        schedule_unpause_reminder(engagement_channel)
 
     megatron_msg, _ = MegatronMessage.objects.exclude(
         integration_msg_id__isnull=True
@@ -160,7 +174,7 @@ def forward_message(channel: str, msg: dict, from_user: dict = None) -> dict:
     return {"ok": True, "response": response}
 
 
-@shared_task
+@slack_task
 def pause_channel(
     megatron_user_id: int, serialized_request_data: dict, arguments: dict
 ) -> dict:
@@ -197,7 +211,7 @@ def pause_channel(
     return response
 
 
-@shared_task
+@slack_task
 def unpause_channel(
     megatron_user_id: int, serialized_request_data: dict, arguments: dict
 ) -> dict:
@@ -234,7 +248,7 @@ def unpause_channel(
     return response
 
 
-@shared_task
+@slack_task
 def clear_context(
     megatron_user_id: int, serialized_request_data: dict, arguments: dict
 ) -> dict:
@@ -287,12 +301,12 @@ def clear_context(
 
 
 # TODO Clear this function and adequate it to both sync execution and return of ephemeral messages
-@shared_task
+@slack_task
 def do(megatron_user_id: int, serialized_request_data: dict, arguments: dict) -> dict:
     request_data = RequestData(**serialized_request_data)
     megatron_user = MegatronUser.objects.get(id=megatron_user_id)
     try:
-        channel = MegatronChannel.objects.get(
+        channel = MegatronChannel.objects.with_related().get(
             platform_channel_id=request_data.channel_id
         )
     except MegatronChannel.DoesNotExist:
@@ -324,11 +338,12 @@ def _update_channel_link(
     integration_connection = IntegrationService(integration).get_connection(
         as_user=False
     )
-    megatron_user = MegatronUser.objects.get(id=megatron_user_id)
 
-    megatron_channel = MegatronChannel.objects.filter(
-        platform_user_id=platform_user.platform_id
-    ).first()
+    megatron_channel = (
+        MegatronChannel.objects.with_related()
+        .filter(platform_user_id=platform_user.platform_id)
+        .first()
+    )
 
     if not megatron_channel:
         username = platform_user.username + "_" + platform_user.workspace.domain
@@ -364,7 +379,9 @@ def _update_channel_link(
 
 def _check_channel(platform_channel_id: str):
     try:
-        channel = MegatronChannel.objects.get(platform_channel_id=platform_channel_id)
+        channel = MegatronChannel.objects.with_related().get(
+            platform_channel_id=platform_channel_id
+        )
     except MegatronChannel.DoesNotExist:
         channel = None
     return channel
@@ -435,6 +452,7 @@ def _change_pause_state(
     platform_user: PlatformUser,
     request_data: RequestData,
     pause_state=False,
+    megatron_channel: MegatronChannel = None,
 ) -> dict:
     workspace = platform_user.workspace
     if not getattr(megatron_user, "command_url", None):
@@ -450,9 +468,10 @@ def _change_pause_state(
         }
     channel_id = response["channel"]["id"]
 
-    megatron_channel = MegatronChannel.objects.get(
-        workspace=workspace, platform_user_id=platform_user.platform_id
-    )
+    if megatron_channel is None:
+        megatron_channel = MegatronChannel.objects.with_related().get(
+            workspace=workspace, platform_user_id=platform_user.platform_id
+        )
     response = MegatronChannelService(megatron_channel).change_pause_state(
         pause_state=pause_state, user_channel_id=channel_id
     )
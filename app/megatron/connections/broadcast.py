@@ -0,0 +1,83 @@
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from logging import getLogger
+from typing import Dict, List, NamedTuple, Optional
+
+from django.conf import settings
+
+from megatron import metrics
+from megatron.connections import rate_limits
+from megatron.errors import MegatronException
+
+
+LOGGER = getLogger(__name__)
+STATS = metrics.counters("broadcasts")
+
+_TOKEN_SLOTS: Dict[str, threading.BoundedSemaphore] = {}
+_TOKEN_SLOTS_LOCK = threading.Lock()
+
+
+class BroadcastResult(NamedTuple):
+    user_id: str
+    ok: bool
+    error: Optional[str] = None
+
+
+def _token_slots(token: str) -> threading.BoundedSemaphore:
+    with _TOKEN_SLOTS_LOCK:
+        if token not in _TOKEN_SLOTS:
+            _TOKEN_SLOTS[token] = threading.BoundedSemaphore(
+                settings.SLACK_BROADCAST_WORKERS
+            )
+        return _TOKEN_SLOTS[token]
+
+
+class BroadcastEngine:
+    """
+    Sends one message to many users concurrently. Every user costs an
+    `im.open` and a `chat.postMessage`; each pair runs on a worker thread and
+    no more than SLACK_BROADCAST_WORKERS pairs are in flight per workspace
+    token, even across concurrent broadcasts. The broadcast goes to the
+    connection's `_post_to_user` as given, Slack passes a PreparedMessage
+    so it is not encoded again for every user. The worker threads wait for
+    the rate limits whenever the thread sending the broadcast may.
+    """
+
+    def __init__(self, connection) -> None:
+        self.connection = connection
+        self.slots = _token_slots(connection.token)
+
+    def send(self, broadcast, user_ids: List[str]) -> List[BroadcastResult]:
+        if not user_ids:
+            return []
+        workers = min(settings.SLACK_BROADCAST_WORKERS, len(user_ids))
+        may_wait = rate_limits.may_wait()
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = [
+                executor.submit(self._deliver, broadcast, user_id, may_wait)
+                for user_id in user_ids
+            ]
+            return [future.result() for future in futures]
+
+    def _deliver(self, broadcast, slack_id: str, may_wait: bool) -> BroadcastResult:
+        with self.slots, rate_limits.waiting(may_wait):
+            try:
+                post_response = self.connection._post_to_user(slack_id, broadcast)
+                if not post_response.get("ok"):
+                    raise MegatronException(
+                        "Could not post to DM channel with user: {}. Error: {}".format(
+                            slack_id, post_response.get("error")
+                        )
+                    )
+            except MegatronException as ex:
+                STATS.incr("failed")
+                return BroadcastResult(slack_id, False, str(ex))
+            except Exception as ex:
+                LOGGER.exception(
+                    "Unexpected error broadcasting to user.",
+                    extra={"slack_id": slack_id},
+                )
+                STATS.incr("failed")
+                return BroadcastResult(slack_id, False, str(ex))
+        STATS.incr("sent")
+        return BroadcastResult(slack_id, True)
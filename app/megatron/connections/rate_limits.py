@@ -0,0 +1,284 @@
+import logging
+import random
+import threading
+import time
+from contextlib import contextmanager
+from functools import partial
+from typing import Dict, Iterator, Optional, Set, Tuple
+from urllib.parse import urlsplit
+
+from celery import current_task
+from django.conf import settings
+from django.core.cache import cache
+
+from megatron import metrics
+from megatron.caching import token_key
+
+
+LOGGER = logging.getLogger(__name__)
+STATS = metrics.counters("slack_rate_limits")
+
+# Requests per minute for each of Slack's documented rate tiers.
+# https://api.slack.com/docs/rate-limits
+# Special methods are limited per channel, about one message a second, which
+# a per-token budget can't follow. They are only held back after a 429.
+TIER_LIMITS: Dict[str, Optional[int]] = {
+    "tier1": 1,
+    "tier2": 20,
+    "tier3": 50,
+    "tier4": 100,
+    "special": None,
+}
+DEFAULT_TIER = "tier3"
+WINDOW_SECONDS = 60
+
+METHOD_TIERS = {
+    "channels.list": "tier2",
+    "chat.postEphemeral": "special",
+    "chat.postMessage": "special",
+    "chat.update": "tier3",
+    "conversations.archive": "tier2",
+    "conversations.create": "tier2",
+    "conversations.unarchive": "tier2",
+    "im.history": "tier3",
+    "im.open": "tier3",
+    "users.info": "tier4",
+    "users.list": "tier2",
+}
+
+
+def method_for_url(url: str) -> str:
+    return urlsplit(url).path.rstrip("/").rsplit("/", 1)[-1]
+
+
+def tier_for_method(method: str) -> str:
+    return METHOD_TIERS.get(method, DEFAULT_TIER)
+
+
+# Set on threads working for a task, which celery doesn't know about.
+_WAITING = threading.local()
+
+
+def may_wait() -> bool:
+    """
+    Only celery workers sleep until the rate limits allow a call. Web
+    requests, and tasks run eagerly inside them, fail fast instead.
+    """
+    allowed = getattr(_WAITING, "allowed", None)
+    if allowed is not None:
+        return allowed
+    return bool(current_task) and not current_task.request.is_eager
+
+
+@contextmanager
+def waiting(allowed: bool) -> Iterator[None]:
+    """
+    Lets the current thread wait for the rate limits, or not, whatever
+    task it runs. Pass it `may_wait()` of the thread handing out the work.
+    """
+    previous = getattr(_WAITING, "allowed", None)
+    _WAITING.allowed = allowed
+    try:
+        yield
+    finally:
+        _WAITING.allowed = previous
+
+
+def _token_from_request(kwargs: dict) -> Optional[str]:
+    for field in ("params", "data", "json"):
+        payload = kwargs.get(field)
+        if isinstance(payload, dict) and payload.get("token"):
+            return payload["token"]
+    authorization = (kwargs.get("headers") or {}).get("Authorization", "")
+    if authorization.startswith("Bearer "):
+        return authorization[len("Bearer ") :]
+    return None
+
+
+class SharedRateLimiter:
+    """
+    Paces Slack calls per (token, tier) across every web and celery process.
+
+    Each minute gets a request counter in the shared (redis) django cache,
+    created with `add` and bumped with `incr`, both atomic in redis. A call
+    is allowed while the calls of the last 60 seconds, estimated from the
+    current and the previous minute's counters, fit in the tier's budget.
+    Callers over it sleep for about the time one call takes to free up,
+    spread at random so they don't all wake at once. A 429 pauses the
+    (token, tier) pair for everybody until its Retry-After has passed. If
+    redis is unavailable requests go through unpaced rather than being
+    held up.
+    """
+
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self._gauges: Set[Tuple[str, str]] = set()
+
+    @property
+    def retries(self) -> int:
+        if not settings.SLACK_RATE_LIMIT_ENABLED:
+            return 0
+        return settings.SLACK_RATE_LIMIT_RETRIES
+
+    def _key(self, tkey: str, tier: str) -> str:
+        return f"ratelimit:{tkey}:{tier}"
+
+    def _window_key(self, tkey: str, tier: str, window: int) -> str:
+        return f"{self._key(tkey, tier)}:{window}"
+
+    def _track(self, tkey: str, tier: str) -> None:
+        with self._lock:
+            if (tkey, tier) in self._gauges:
+                return
+            self._gauges.add((tkey, tier))
+        STATS.gauge(f"{tkey}:{tier}:fill", partial(self.fill, tkey, tier))
+
+    def _recent(self, tkey: str, tier: str, now: float, used: int) -> float:
+        """
+        Calls of the last 60 seconds: `used` in the current minute and the
+        share of the previous minute that is still inside that span.
+        """
+        window, offset = divmod(now, WINDOW_SECONDS)
+        previous = cache.get(self._window_key(tkey, tier, int(window) - 1)) or 0
+        return previous * (1 - offset / WINDOW_SECONDS) + used
+
+    def fill(self, tkey: str, tier: str) -> float:
+        """
+        Share of the budget used over the last 60 seconds.
+        """
+        if cache.get(f"{self._key(tkey, tier)}:paused"):
+            return 1.0
+        limit = TIER_LIMITS[tier]
+        if not limit:
+            return 0.0
+        now = time.time()
+        used = cache.get(self._window_key(tkey, tier, int(now // WINDOW_SECONDS)))
+        recent = self._recent(tkey, tier, now, used or 0)
+        return round(min(recent / limit, 1.0), 4)
+
+    def _reserve(self, tkey: str, tier: str) -> float:
+        """
+        Takes a slot in the current window, returns 0 on success or the
+        seconds to sleep before trying again.
+        """
+        now = time.time()
+        paused_until = cache.get(f"{self._key(tkey, tier)}:paused")
+        if paused_until and paused_until > now:
+            return paused_until - now
+        limit = TIER_LIMITS[tier]
+        if not limit:
+            return 0.0
+
+        key = self._window_key(tkey, tier, int(now // WINDOW_SECONDS))
+        cache.add(key, 0, WINDOW_SECONDS * 2)
+        try:
+            used = cache.incr(key)
+        except ValueError:
+            # The window expired between add and incr.
+            return 0.0
+        # The redis cache answers None when unreachable.
+        if used is None or self._recent(tkey, tier, now, used) <= limit:
+            return 0.0
+        try:
+            cache.decr(key)
+        except ValueError:
+            pass
+        return WINDOW_SECONDS / limit * (1 + random.random())
+
+    def try_acquire(self, token: str, method: str) -> float:
+        """
+        Takes a slot for `token` to call `method` if one is free. Returns 0
+        when it did, otherwise about the seconds until one frees up.
+        """
+        if not settings.SLACK_RATE_LIMIT_ENABLED:
+            return 0.0
+        tkey = token_key(token)
+        tier = tier_for_method(method)
+        self._track(tkey, tier)
+        delay = self._reserve(tkey, tier)
+        if delay:
+            STATS.incr("rejected")
+            STATS.incr(f"{tkey}:rejected")
+        return delay
+
+    def acquire(self, token: str, method: str) -> float:
+        """
+        Blocks until `token` may call `method`, returns the seconds spent
+        waiting.
+        """
+        if not settings.SLACK_RATE_LIMIT_ENABLED:
+            return 0.0
+        tkey = token_key(token)
+        tier = tier_for_method(method)
+        self._track(tkey, tier)
+        waited = 0.0
+        while True:
+            delay = self._reserve(tkey, tier)
+            if not delay:
+                break
+            time.sleep(delay)
+            waited += delay
+        if waited:
+            STATS.incr("throttled")
+            STATS.incr(f"{tkey}:throttled")
+            STATS.timing("wait_seconds", waited)
+            STATS.timing(f"{tkey}:wait_seconds", waited)
+        return waited
+
+    def pause(self, token: str, method: str, seconds: float) -> None:
+        """
+        Holds back every caller of `method`'s tier with `token` for `seconds`.
+        """
+        tkey = token_key(token)
+        tier = tier_for_method(method)
+        cache.set(
+            f"{self._key(tkey, tier)}:paused",
+            time.time() + seconds,
+            max(int(seconds), 1),
+        )
+        STATS.incr("rate_limited")
+        STATS.incr(f"{tkey}:rate_limited")
+
+    def before_request(self, url: str, kwargs: dict) -> float:
+        """
+        Waits for a slot inside celery workers. Elsewhere returns the seconds
+        the request would have to wait, 0 when it may go right away.
+        """
+        token = self._slack_token(url, kwargs)
+        if not token:
+            return 0.0
+        if may_wait():
+            self.acquire(token, method_for_url(url))
+            return 0.0
+        return self.try_acquire(token, method_for_url(url))
+
+    def rate_limited(self, url: str, kwargs: dict, response) -> bool:
+        """
+        Pauses the token when Slack answered with a 429. Returns whether
+        the request should be retried.
+        """
+        if response.status_code != 429:
+            return False
+        token = self._slack_token(url, kwargs)
+        if not token or not settings.SLACK_RATE_LIMIT_ENABLED:
+            return False
+        try:
+            retry_after = float(response.headers.get("Retry-After", ""))
+        except ValueError:
+            retry_after = float(WINDOW_SECONDS)
+        LOGGER.warning(
+            "Rate limited by Slack.",
+            extra={"method": method_for_url(url), "retry_after": retry_after},
+        )
+        self.pause(token, method_for_url(url), retry_after)
+        return True
+
+    def _slack_token(self, url: str, kwargs: dict) -> Optional[str]:
+        if not settings.SLACK_RATE_LIMIT_ENABLED:
+            return None
+        if not url.startswith(settings.SLACK_API_URL):
+            return None
+        return _token_from_request(kwargs)
+
+
+LIMITER = SharedRateLimiter()
@@ -1,28 +1,68 @@
+import time
 import requests
 from logging import getLogger
 
 from megatron.responses import MegatronResponse
+from megatron.connections.sessions import SESSIONS
 
 
 LOGGER = getLogger(__name__)
 
 
 class SafeRequest:
-    def __init__(self, response_verification, get_response_data):
+    """
+    Sends requests with a timeout, rate limiting and logging of failed
+    answers. With a `response_class`, e.g. SlackResponse, responses are
+    wrapped in it, through its `from_response`, before anything reads
+    their body. Outside of celery workers, requests the rate limits would
+    hold up are answered right away with Slack's "ratelimited" error.
+    """
+
+    def __init__(
+        self,
+        response_verification,
+        get_response_data,
+        rate_limiter=None,
+        response_class=None,
+    ):
         self.response_verification = response_verification
         self.get_response_data = get_response_data
+        self.rate_limiter = rate_limiter
+        self.response_class = response_class
 
     def safe_requests(self, method, url, *args, **kwargs):
-        if not kwargs.get("timeout"):
-            timeout = 10
-        else:
-            timeout = kwargs.get("timeout")
-        try:
-            response = requests.request(method, url, *args, **kwargs, timeout=timeout)
-        except requests.Timeout:
-            LOGGER.exception("Megatron request timed out.")
-            return MegatronResponse({"ok": False, "error": "Timeout error"}, 500)
+        timeout = kwargs.pop("timeout", None) or 10
+        retries = self.rate_limiter.retries if self.rate_limiter else 0
+        for attempt in range(retries + 1):
+            started = time.perf_counter()
+            if self.rate_limiter:
+                delay = self.rate_limiter.before_request(url, kwargs)
+                if delay:
+                    return self._rate_limited(url, delay)
+            try:
+                session = SESSIONS.get(url)
+                response = session.request(
+                    method, url, *args, **kwargs, timeout=timeout
+                )
+            except requests.Timeout:
+                LOGGER.exception("Megatron request timed out.")
+                error = {"ok": False, "error": "Timeout error"}
+                if self.response_class:
+                    return self.response_class(
+                        error, 500, latency=time.perf_counter() - started
+                    )
+                return MegatronResponse(error, 500)
+            if not self.rate_limiter:
+                break
+            if not self.rate_limiter.rate_limited(url, kwargs, response):
+                break
+            if attempt == retries:
+                break
 
+        if self.response_class:
+            response = self.response_class.from_response(
+                response, time.perf_counter() - started
+            )
         try:
             verified = self.response_verification(response)
             response_data = self.get_response_data(response)
@@ -38,6 +78,18 @@ class SafeRequest:
 
         return response
 
+    def _rate_limited(self, url, delay):
+        LOGGER.warning(
+            "Request held back by the rate limits.",
+            extra={"url": url, "retry_after": round(delay, 2)},
+        )
+        error = {"ok": False, "error": "ratelimited"}
+        if self.response_class:
+            return self.response_class(
+                error, 429, headers={"Retry-After": str(int(delay) + 1)}
+            )
+        return MegatronResponse(error, 429)
+
     def post(self, url, data=None, json=None, **kwargs):
         return self.safe_requests("post", url, data=data, json=json, **kwargs)
 
@@ -0,0 +1,81 @@
+import os
+import threading
+from logging import getLogger
+from typing import Dict
+from urllib.parse import urlsplit
+
+import requests
+from django.conf import settings
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+from megatron import metrics
+
+
+LOGGER = getLogger(__name__)
+STATS = metrics.counters("http_sessions")
+
+# Only idempotent methods are retried on these statuses, a retried
+# `chat.postMessage` would post the message twice.
+RETRY_STATUSES = (502, 503, 504)
+RETRY_METHODS = frozenset(["GET", "HEAD", "OPTIONS"])
+
+
+class SessionPool:
+    """
+    Per-process pool of keep-alive sessions, one per host.
+
+    The pool is discarded when the process id changes so that forked workers
+    (celery prefork, gunicorn) never share sockets with their parent.
+    """
+
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self._sessions: Dict[str, requests.Session] = {}
+        self._pid = os.getpid()
+
+    def get(self, url: str) -> requests.Session:
+        host = urlsplit(url).netloc
+        with self._lock:
+            if self._pid != os.getpid():
+                self._sessions = {}
+                self._pid = os.getpid()
+            session = self._sessions.get(host)
+            if session is None:
+                session = self._build_session()
+                self._sessions[host] = session
+                STATS.incr("miss")
+            else:
+                STATS.incr("hit")
+        return session
+
+    def close(self) -> None:
+        with self._lock:
+            for session in self._sessions.values():
+                session.close()
+            self._sessions = {}
+
+    @staticmethod
+    def _build_session() -> requests.Session:
+        retries = Retry(
+            total=settings.HTTP_MAX_RETRIES,
+            read=0,
+            status_forcelist=RETRY_STATUSES,
+            allowed_methods=RETRY_METHODS,
+            backoff_factor=0.3,
+            raise_on_status=False,
+        )
+        adapter = HTTPAdapter(
+            pool_connections=settings.HTTP_POOL_CONNECTIONS,
+            pool_maxsize=settings.HTTP_POOL_MAXSIZE,
+            max_retries=retries,
+        )
+        session = requests.Session()
+        session.mount("https://", adapter)
+        session.mount("http://", adapter)
+        if not settings.HTTP_KEEP_ALIVE:
+            session.headers["Connection"] = "close"
+        return session
+
+
+SESSIONS = SessionPool()
@@ -1,9 +1,11 @@
 import logging
 import json
 import os
-import requests
-from typing import Tuple, List, Optional, Union
-from simplejson.scanner import JSONDecodeError
+from concurrent.futures import ThreadPoolExecutor
+from typing import Iterator, Tuple, List, NamedTuple, Optional, Union
+from urllib.parse import quote_plus, urlencode
+
+from django.conf import settings
 
 from megatron.connections.actions import ActionType, Action
 from .bot_connection import BotConnection
@@ -14,53 +16,103 @@ from megatron.models import (
     MegatronChannel,
     PlatformAgent,
 )
-from megatron.errors import catch_megatron_errors, MegatronException
+from megatron.errors import (
+    catch_megatron_errors,
+    MegatronException,
+    MegatronTransientError,
+)
 from megatron.connections.safe_requests import SafeRequest
-from megatron import aws
+from megatron.responses import SlackResponse
+from megatron.connections.broadcast import BroadcastEngine
+from megatron.connections.rate_limits import LIMITER
+from megatron import aws, retries
+from megatron.caching import SingleFlight, TwoTierCache, token_key
 
 
 LOGGER = logging.getLogger(__name__)
-OPEN_IM_URL = "https://slack.com/api/im.open"
-IM_HISTORY_URL = "https://slack.com/api/im.history"
+SLACK_API_URL = settings.SLACK_API_URL
 
-CHAT_POST_URL = "https://slack.com/api/chat.postMessage"
-CHAT_POST_EPHEMERAL_URL = "https://slack.com/api/chat.postEphemeral"
-CHAT_UPDATE_URL = "https://slack.com/api/chat.update"
+OPEN_IM_URL = f"{SLACK_API_URL}/im.open"
+IM_HISTORY_URL = f"{SLACK_API_URL}/im.history"
 
-JOIN_CHANNEL_URL = "https://slack.com/api/channels.join"
-CHANNELS_LIST_URL = "https://slack.com/api/channels.list"
+CHAT_POST_URL = f"{SLACK_API_URL}/chat.postMessage"
+CHAT_POST_EPHEMERAL_URL = f"{SLACK_API_URL}/chat.postEphemeral"
+CHAT_UPDATE_URL = f"{SLACK_API_URL}/chat.update"
 
-GET_USER_INFO_URL = "https://slack.com/api/users.info"
+JOIN_CHANNEL_URL = f"{SLACK_API_URL}/channels.join"
+CHANNELS_LIST_URL = f"{SLACK_API_URL}/channels.list"
 
-CONVERSATION_CREATE_URL = "https://slack.com/api/conversations.create"
-CONVERSATION_JOIN_URL = "https://slack.com/api/conversations.join"
-CONVERSATION_ARCHIVE_URL = "https://slack.com/api/conversations.archive"
-CONVERSATION_UNARCHIVE_URL = "https://slack.com/api/conversations.unarchive"
+GET_USER_INFO_URL = f"{SLACK_API_URL}/users.info"
+USERS_LIST_URL = f"{SLACK_API_URL}/users.list"
+USERS_LIST_PAGE_SIZE = 200
+
+CONVERSATION_CREATE_URL = f"{SLACK_API_URL}/conversations.create"
+CONVERSATION_JOIN_URL = f"{SLACK_API_URL}/conversations.join"
+CONVERSATION_ARCHIVE_URL = f"{SLACK_API_URL}/conversations.archive"
+CONVERSATION_UNARCHIVE_URL = f"{SLACK_API_URL}/conversations.unarchive"
 
 BOTNAME = "Teampay"
 
+# DM channel ids per (token, user), they practically never change.
+IM_CHANNELS = TwoTierCache(
+    "im_channels", ttl=settings.SLACK_IM_CACHE_TTL, maxsize=settings.SLACK_IM_CACHE_SIZE
+)
+IM_OPENS = SingleFlight("im_open", wait=settings.SLACK_LOOKUP_WAIT)
+
+FORM_CONTENT_TYPE = "application/x-www-form-urlencoded"
 
-def response_verification(response):
-    if response.text == "ok":
-        return True
-    try:
-        json_data = response.json()
-        if not json_data.get("ok") or json_data.get("error"):
-            return False
-    except JSONDecodeError:
-        pass
-    return True
 
+def response_verification(response: SlackResponse) -> bool:
+    return response.ok and not response.get("error")
+
+
+def get_response_data(response: SlackResponse) -> dict:
+    return dict(response, latency=response.latency)
+
+
+# Slack answers are parsed once, into a SlackResponse, which every
+# SlackConnection method returns.
+safe_requests = SafeRequest(
+    response_verification, get_response_data, LIMITER, response_class=SlackResponse
+)
+# File downloads are streamed, their bodies must not be read to verify them.
+download_safe_requests = SafeRequest(
+    lambda response: response.status_code == 200,
+    lambda response: {"status_code": response.status_code},
+)
 
-def get_response_data(response):
+DOWNLOAD_CHUNK_SIZE = 64 * 1024
+
+
+def _iter_and_close(response) -> Iterator[bytes]:
     try:
-        response_data = response.json()
-    except ValueError:
-        response_data = {"error": "Could not decode response body."}
-    return response_data
+        yield from response.iter_content(DOWNLOAD_CHUNK_SIZE)
+    finally:
+        response.close()
+
 
+class PreparedMessage(NamedTuple):
+    """
+    A chat.postMessage form body encoded once, for posting the same message
+    to many channels. Only the channel differs between posts, it is
+    appended to the body, and the token goes in the Authorization header.
+    """
 
-safe_requests = SafeRequest(response_verification, get_response_data)
+    body: bytes
+
+    @classmethod
+    def prepare(cls, msg: dict, as_user: bool) -> "PreparedMessage":
+        fields = {"as_user": as_user, "text": ""}
+        fields.update(msg)
+        fields["attachments"] = json.dumps(msg.get("attachments", []))
+        fields.pop("channel", None)
+        fields.pop("token", None)
+        # Left out like requests does, rather than sent as "None".
+        fields = {name: value for name, value in fields.items() if value is not None}
+        return cls(urlencode(fields, doseq=True).encode())
+
+    def for_channel(self, channel: str) -> bytes:
+        return self.body + b"&channel=" + quote_plus(channel).encode()
 
 
 class SlackConnection(BotConnection):
@@ -87,124 +139,140 @@ class SlackConnection(BotConnection):
         elif capture_feedback:
             broadcast["attachments"] = [self._build_feedback_attach()]
 
-        errors = []
-        for slack_id in user_ids:
-            try:
-                response = self.open_im(slack_id)
-                channel_id = response["channel"]["id"]
-            except MegatronException as ex:
-                error = {slack_id: str(ex)}
-                errors.append(error)
-                continue
-
-            try:
-                self._post_to_channel(channel_id, broadcast)
-            except MegatronException as ex:
-                error = {slack_id: str(ex)}
-                errors.append(error)
-                continue
+        message = PreparedMessage.prepare(broadcast, self.as_user)
+        results = BroadcastEngine(self).send(message, user_ids)
+        errors = [{result.user_id: result.error} for result in results if not result.ok]
         if errors:
             return {"ok": False, "errors": errors}
         else:
             return {"ok": True}
 
     @catch_megatron_errors
-    def _post_message(self, message: dict, channel: str) -> dict:
-        response = self._post_to_channel(channel, message)
-        return response.json()
+    def _post_message(self, message: dict, channel: str) -> SlackResponse:
+        return self._post_to_channel(channel, message)
 
     @catch_megatron_errors
-    def _get_user_info(self, user_id: str) -> dict:
-        # TODO: IMPORTANT `safe_requests.get` seems to be borked
-        response = requests.get(
-            GET_USER_INFO_URL, {"token": self.token, "user": user_id}
+    def _get_user_info(self, user_id: str) -> SlackResponse:
+        response = safe_requests.get(
+            GET_USER_INFO_URL, params={"token": self.token, "user": user_id}
         )
 
-        response_json = response.json()
-        if not response_json.get("ok", False):
-            if response_json.get("error") == "invalid_auth":
+        if not response.ok:
+            if response.get("error") == "invalid_auth":
                 self._refresh_access_token(user_id)
-                response = requests.get(
-                    GET_USER_INFO_URL, {"token": self.token, "user": user_id}
+                response = safe_requests.get(
+                    GET_USER_INFO_URL, params={"token": self.token, "user": user_id}
                 )
 
-        return response.json()
+        return response
+
+    def list_users(self) -> Iterator[dict]:
+        """
+        Yields every member of the workspace, following users.list cursors.
+        Stops early, after logging the error, if Slack refuses a page.
+        """
+        cursor = ""
+        while True:
+            response = safe_requests.get(
+                USERS_LIST_URL,
+                params={
+                    "token": self.token,
+                    "limit": USERS_LIST_PAGE_SIZE,
+                    "cursor": cursor,
+                },
+            )
+            if not response.get("ok"):
+                LOGGER.warning(
+                    "Failed to list workspace users.",
+                    extra={"error": response.get("error")},
+                )
+                return
+            yield from response.get("members", [])
+            cursor = response.get("response_metadata", {}).get("next_cursor")
+            if not cursor:
+                return
 
     @catch_megatron_errors
-    def respond_to_url(self, response_url: str, msg: dict) -> dict:
+    def respond_to_url(self, response_url: str, msg: dict) -> SlackResponse:
+        # When responding to slash commands, slack returns a text response,
+        # SlackResponse reads a plain "ok" as {"ok": True}.
         response = self._post_to_response_url(response_url, msg)
-        # When responding to slash commands, slack returns a text response
-        # This mimics the dict that would be returned by response.json()
-        try:
-            response_data = response.json()
-        except JSONDecodeError:
-            if response.text == "ok":
-                response_data = {"ok": True}
-            else:
-                response_data = {"ok": False}
-        if not response_data.get("ok"):
+        if not response.ok:
             LOGGER.error(
                 f"Problem updating slack message",
-                extra={"Error Message": response["error"]},
+                extra={"Error Message": response.get("error")},
             )
-        return response_data
+        return response
 
     @catch_megatron_errors
-    def ephemeral_message(self, request_data, msg: dict) -> dict:
-        response = self._post_ephemeral_message(request_data, msg)
-        return response.json()
+    def ephemeral_message(self, request_data, msg: dict) -> SlackResponse:
+        return self._post_ephemeral_message(request_data, msg)
 
     @catch_megatron_errors
-    def dm_user(self, slack_id: str, msg: dict) -> dict:
-        open_response = self.open_im(slack_id)
-
-        channel = open_response["channel"]["id"]
-        response = self._post_to_channel(channel, msg)
-
-        return response.json()
+    def dm_user(self, slack_id: str, msg: dict) -> SlackResponse:
+        return self._post_to_user(slack_id, msg)
 
     @catch_megatron_errors
-    def message(self, channel: str, msg: dict):
-        response = self._post_to_channel(channel, msg)
-        return response.json()
+    def message(self, channel: str, msg: dict) -> SlackResponse:
+        return self._post_to_channel(channel, msg)
+
+    def open_im(self, slack_user_id: str) -> SlackResponse:
+        cache_key = f"{token_key(self.token)}:{slack_user_id}"
+        channel_id = IM_CHANNELS.get(cache_key)
+        if channel_id:
+            return SlackResponse({"ok": True, "channel": {"id": channel_id}})
+
+        def cached_im():
+            channel_id = IM_CHANNELS.get(cache_key)
+            if channel_id:
+                return SlackResponse({"ok": True, "channel": {"id": channel_id}})
+            return None
+
+        return IM_OPENS.do(
+            cache_key, lambda: self._open_im(slack_user_id, cache_key), cached_im
+        )
 
-    def open_im(self, slack_user_id: str):
+    def _open_im(self, slack_user_id: str, cache_key: str) -> SlackResponse:
         open_im_data = {"token": self.token, "user": slack_user_id}
         open_response = safe_requests.post(OPEN_IM_URL, open_im_data)
-        open_response_data = open_response.json()
-        if not open_response_data["ok"]:
-            raise MegatronException(
+        if not open_response.ok:
+            error = MegatronException
+            if retries.is_transient(open_response):
+                error = MegatronTransientError
+            raise error(
                 "Could not open DM channel with user: {}.  Error: {}".format(
-                    slack_user_id, open_response_data["error"]
+                    slack_user_id, open_response.get("error")
                 )
             )
-        return open_response_data
+        IM_CHANNELS.set(cache_key, open_response["channel"]["id"])
+        return open_response
+
+    def forget_im(self, slack_user_id: str):
+        IM_CHANNELS.delete(f"{token_key(self.token)}:{slack_user_id}")
 
     @catch_megatron_errors
-    def im_history(self, channel_id: str, count: int):
+    def im_history(self, channel_id: str, count: int) -> SlackResponse:
         im_history_data = {"token": self.token, "channel": channel_id, "count": count}
         response = safe_requests.post(IM_HISTORY_URL, im_history_data)
-        response_data = response.json()
-        if not response_data["ok"]:
+        if not response.ok:
             raise MegatronException(
                 ("Could not retrieve history for DM channel: {}. Error: {}").format(
-                    channel_id, response_data["error"]
+                    channel_id, response.get("error")
                 )
             )
-        return response_data
+        return response
 
     @catch_megatron_errors
-    def create_channel(self, channel_name: str) -> Optional[dict]:
+    def create_channel(self, channel_name: str) -> Optional[SlackResponse]:
         data = {"token": self.token, "name": channel_name[:21]}
         response = safe_requests.post(CONVERSATION_CREATE_URL, data)
-        response_data = response.json()
-        if not response_data["ok"]:
-            LOGGER.error("Unable to create channel.", extra={"response": response_data})
+        if not response.ok:
+            LOGGER.error("Unable to create channel.", extra={"response": response})
             return None
-        return response_data
+        return response
 
     @catch_megatron_errors
-    def archive_channel(self, channel_id: str) -> dict:
+    def archive_channel(self, channel_id: str) -> SlackResponse:
         data = {"token": self.token, "channel": channel_id}
 
         def archive_response_verification(resp):
@@ -213,19 +281,20 @@ class SlackConnection(BotConnection):
             return False
 
         archive_safe_requests = SafeRequest(
-            archive_response_verification, get_response_data
+            archive_response_verification,
+            get_response_data,
+            LIMITER,
+            response_class=SlackResponse,
         )
-        response = archive_safe_requests.post(CONVERSATION_ARCHIVE_URL, data)
-        return response.json()
+        return archive_safe_requests.post(CONVERSATION_ARCHIVE_URL, data)
 
     @catch_megatron_errors
-    def unarchive_channel(self, channel_id: str) -> dict:
+    def unarchive_channel(self, channel_id: str) -> SlackResponse:
         data = {"token": self.token, "channel": channel_id}
-        response = safe_requests.post(CONVERSATION_UNARCHIVE_URL, data)
-        return response.json()
+        return safe_requests.post(CONVERSATION_UNARCHIVE_URL, data)
 
     @catch_megatron_errors
-    def _update_msg(self, new_msg: dict, old_msg: dict) -> dict:
+    def _update_msg(self, new_msg: dict, old_msg: dict) -> SlackResponse:
         new_msg["attachments"] = json.dumps(new_msg.get("attachments", []))
         headers = {"Authorization": f"Bearer {self.token}"}
         data = {
@@ -236,49 +305,50 @@ class SlackConnection(BotConnection):
             "as_user": self.as_user,
         }
         data.update(new_msg)
-        response = safe_requests.post(CHAT_UPDATE_URL, headers=headers, json=data)
-        return json.loads(response.text)
+        return safe_requests.post(CHAT_UPDATE_URL, headers=headers, json=data)
 
     @catch_megatron_errors
-    def get_image(self, file_data: dict) -> Optional[Tuple[bytes, str]]:
+    def get_image(self, file_data: dict) -> Optional[Tuple[Iterator[bytes], str]]:
+        """
+        Starts downloading a file, the content is read in chunks as the
+        returned iterator is consumed.
+        """
         url = file_data["url_private"]
-        response = safe_requests.get(
-            url, headers={"Authorization": f"Bearer {self.token}"}
+        response = download_safe_requests.get(
+            url, headers={"Authorization": f"Bearer {self.token}"}, stream=True
         )
-        if response.status_code == 200:
-            image = response.content
-        else:
+        if response.status_code != 200:
             LOGGER.error(
                 f"Error downloading image from Slack:",
-                extra={"Error Message": response.text},
+                extra={"status_code": response.status_code},
             )
+            response.close()
             return None
 
         _, extension = os.path.splitext(url)
 
-        return image, extension
+        return _iter_and_close(response), extension
 
     def get_channel_by_name(self, channel_name) -> Optional["dict"]:
         data = {"token": self.token, "exclude_members": True}
         response = safe_requests.post(CHANNELS_LIST_URL, data)
-        response_data = response.json()
-        if not response_data["ok"]:
+        if not response.ok:
             return None
-        for channel in response_data["channels"]:
+        for channel in response["channels"]:
             formatted_channel_name = channel_name.replace("@", "_")
             if formatted_channel_name.startswith(channel["name"]):
                 selected_channel = channel
                 return selected_channel
         return None
 
-    def _post_to_response_url(self, response_url: str, msg: dict):
+    def _post_to_response_url(self, response_url: str, msg: dict) -> SlackResponse:
         post_msg_data = {"token": self.token, "as_user": self.as_user}
         post_msg_data["text"] = msg.get("text", "")
         post_msg_data["attachments"] = msg.get("attachments", [])
         post_msg_response = safe_requests.post(response_url, json=post_msg_data)
         return post_msg_response
 
-    def _post_to_channel(self, channel: str, msg: dict):
+    def _post_to_channel(self, channel: str, msg: dict) -> SlackResponse:
         msg["attachments"] = json.dumps(msg.get("attachments", []))
         post_msg_data = {
             "token": self.token,
@@ -291,7 +361,33 @@ class SlackConnection(BotConnection):
         post_msg_response = safe_requests.post(CHAT_POST_URL, post_msg_data)
         return post_msg_response
 
-    def _post_ephemeral_message(self, request_data, msg: dict):
+    def _post_prepared(self, channel: str, message: PreparedMessage) -> SlackResponse:
+        headers = {
+            "Authorization": f"Bearer {self.token}",
+            "Content-Type": FORM_CONTENT_TYPE,
+        }
+        return safe_requests.post(
+            CHAT_POST_URL, data=message.for_channel(channel), headers=headers
+        )
+
+    def _post_to_user(
+        self, slack_id: str, msg: Union[dict, PreparedMessage]
+    ) -> SlackResponse:
+        """
+        Posts to the user's DM channel. A cached channel id can go stale,
+        in which case it is dropped and the channel opened again.
+        """
+        if not isinstance(msg, PreparedMessage):
+            msg = PreparedMessage.prepare(msg, self.as_user)
+        channel = self.open_im(slack_id)["channel"]["id"]
+        response = self._post_prepared(channel, msg)
+        if response.get("error") == "channel_not_found":
+            self.forget_im(slack_id)
+            channel = self.open_im(slack_id)["channel"]["id"]
+            response = self._post_prepared(channel, msg)
+        return response
+
+    def _post_ephemeral_message(self, request_data, msg: dict) -> SlackResponse:
         msg["attachments"] = json.dumps(msg.get("attachments", []))
         post_msg_data = {
             "token": self.token,
@@ -336,12 +432,11 @@ class SlackConnection(BotConnection):
         return attach
 
     def build_img_attach(self, msg, user: Union[PlatformUser, PlatformAgent]) -> dict:
-        attachments = []
-        for file_data in msg["files"]:
-            image, extension = self.get_image(file_data)
-            key = aws.upload_temp_image(image, extension)
-            img_url = aws.generate_presigned_url(key, aws.S3Folders.TEMP)
-            attachments.append({"text": "", "image_url": img_url})
+        files = msg["files"]
+        workers = max(1, min(settings.S3_UPLOAD_CONCURRENCY, len(files)))
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            img_urls = list(executor.map(self._pass_image_through, files))
+        attachments = [{"text": "", "image_url": url} for url in img_urls if url]
         msg = {
             "username": user.username,
             "icon_url": user.profile_image,
@@ -350,6 +445,16 @@ class SlackConnection(BotConnection):
         }
         return msg
 
+    def _pass_image_through(self, file_data: dict) -> Optional[str]:
+        image = self.get_image(file_data)
+        if not image:
+            return None
+        chunks, extension = image
+        key = aws.stream_temp_image(chunks, extension)
+        if not key:
+            return None
+        return aws.generate_presigned_url(key, aws.S3Folders.TEMP)
+
     def add_forward_footer(self, msg, user_data):
         footer_attach = {
             "text": "",
@@ -390,9 +495,8 @@ class SlackConnection(BotConnection):
                 "workspace_platform_id": workspace.platform_id,
             },
         )
-        response_json = response.json()
-        if response_json["ok"]:
-            data = response_json["data"]
+        if response.ok:
+            data = response["data"]
             workspace.name = data["name"]
             workspace.domain = data["domain"]
             workspace.connection_token = data["connection_token"]
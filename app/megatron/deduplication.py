@@ -0,0 +1,46 @@
+import logging
+from typing import Optional
+
+from django.conf import settings
+from django.core.cache import cache
+
+from megatron import metrics
+
+
+LOGGER = logging.getLogger(__name__)
+STATS = metrics.counters("dedupe")
+
+
+def _key(source: str, channel_id: str, ts: str) -> str:
+    return f"dedupe:{source}:{channel_id}:{ts}"
+
+
+def first_delivery(source: str, channel_id: str, ts: Optional[str]) -> bool:
+    """
+    Atomically records a message (SET NX EX in redis) and reports whether this
+    is the first time it was seen within DEDUPE_RETENTION seconds.
+    """
+    if not ts:
+        return True
+    added = cache.add(_key(source, channel_id, ts), 1, settings.DEDUPE_RETENTION)
+    # The redis cache answers None instead of raising when it is unreachable,
+    # deliver the message rather than drop it in that case.
+    if added is False:
+        STATS.incr("duplicate")
+        LOGGER.warning(
+            "Discarding duplicate message.",
+            extra={"source": source, "channel_id": channel_id, "ts": ts},
+        )
+        return False
+    STATS.incr("first")
+    return True
+
+
+def forget_delivery(source: str, channel_id: str, ts: Optional[str]) -> None:
+    """
+    Drops the record of a message that could not be delivered, so the
+    sender's retry goes through.
+    """
+    if ts:
+        cache.delete(_key(source, channel_id, ts))
+        STATS.incr("forgotten")
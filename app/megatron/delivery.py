@@ -0,0 +1,205 @@
+import logging
+import time
+import uuid
+from typing import Optional
+
+from django.conf import settings
+from django.core.cache import cache
+
+from megatron import metrics, retries
+from megatron.commands.commands import Command
+from megatron.errors import MegatronException
+
+
+LOGGER = logging.getLogger(__name__)
+STATS = metrics.counters("ordered_delivery")
+
+# How long a drain waits for a message whose sequence number was handed out
+# but that isn't stored yet, before skipping it.
+MISSING_MESSAGE_WAIT = 2.0
+MISSING_MESSAGE_POLL = 0.05
+
+FORWARD_TASK = "megatron.commands.command_actions.forward_message"
+
+# Placeholders for a reserved sequence number: its message is still being
+# prepared, or won't come.
+RESERVED = "reserved"
+SKIPPED = "skipped"
+# How long a drain holds a channel's queue for a reserved message.
+RESERVATION_TTL = 5 * 60
+
+
+def _seq_key(channel_id: str) -> str:
+    return f"delivery:{channel_id}:seq"
+
+
+def _next_key(channel_id: str) -> str:
+    return f"delivery:{channel_id}:next"
+
+
+def _lock_key(channel_id: str) -> str:
+    return f"delivery:{channel_id}:lock"
+
+
+def _message_key(channel_id: str, seq: int) -> str:
+    return f"delivery:{channel_id}:{seq}"
+
+
+def _next_sequence(channel_id: str) -> Optional[int]:
+    """
+    Hands out the channel's next sequence number, or None when redis is
+    unavailable.
+    """
+    key = _seq_key(channel_id)
+    cache.add(key, 0, None)
+    try:
+        return cache.incr(key)
+    except ValueError:
+        return None
+
+
+def reserve_sequence(channel_id: str) -> Optional[int]:
+    """
+    Takes the channel's next place in the delivery queue for a message
+    that isn't ready yet, e.g. an event processed by another worker. Pass
+    the sequence number to `forward_in_order`, or to `release_sequence`
+    if there is nothing to forward after all.
+    """
+    if not settings.ORDERED_DELIVERY:
+        return None
+    seq = _next_sequence(channel_id)
+    if seq is not None:
+        cache.set(_message_key(channel_id, seq), RESERVED, RESERVATION_TTL)
+    return seq
+
+
+def release_sequence(channel_id: str, seq: Optional[int]) -> None:
+    if seq is None:
+        return
+    key = _message_key(channel_id, seq)
+    # Already replaced by its message.
+    if cache.get(key) != RESERVED:
+        return
+    cache.set(key, SKIPPED, settings.DELIVERY_TTL)
+    drain_channel.delay(channel_id)
+
+
+def forward_in_order(
+    channel_id: str, msg: dict, from_user: dict = None, seq: int = None
+) -> None:
+    """
+    Queues a message for the customer behind the ones already queued for
+    the same channel, or at the place `seq` reserved.
+
+    Messages get a per-channel sequence number and wait in the cache until
+    a `drain_channel` task, holding the channel's lock, forwards them in
+    sequence. Any worker can drain any channel, so channels are delivered
+    in parallel but a conversation is never reordered. Without redis the
+    message is forwarded right away, unordered.
+    """
+    forward = Command.get_command("forward").action
+    if not settings.ORDERED_DELIVERY:
+        forward.delay(channel_id, msg, from_user)
+        return
+    if seq is None:
+        seq = _next_sequence(channel_id)
+    if seq is None:
+        STATS.incr("unordered")
+        forward.delay(channel_id, msg, from_user)
+        return
+    # The delivery id keeps a retried drain from sending the message twice.
+    queued = (msg, from_user, uuid.uuid4().hex)
+    cache.set(_message_key(channel_id, seq), queued, settings.DELIVERY_TTL)
+    STATS.incr("queued")
+    drain_channel.delay(channel_id)
+
+
+def _pending(channel_id: str) -> bool:
+    next_seq = cache.get(_next_key(channel_id)) or 1
+    return next_seq <= (cache.get(_seq_key(channel_id)) or 0)
+
+
+def _wait_for_message(key: str) -> Optional[tuple]:
+    deadline = time.monotonic() + MISSING_MESSAGE_WAIT
+    queued = cache.get(key)
+    while queued is None and time.monotonic() < deadline:
+        time.sleep(MISSING_MESSAGE_POLL)
+        queued = cache.get(key)
+    return queued
+
+
+def _head_reserved(channel_id: str) -> bool:
+    seq = cache.get(_next_key(channel_id)) or 1
+    return cache.get(_message_key(channel_id, seq)) == RESERVED
+
+
+def _drain(channel_id: str) -> None:
+    forward = Command.get_command("forward").action
+    while _pending(channel_id):
+        seq = cache.get(_next_key(channel_id)) or 1
+        key = _message_key(channel_id, seq)
+        queued = _wait_for_message(key)
+        if queued == RESERVED:
+            # Whoever reserved it drains the channel once it is stored.
+            STATS.incr("reserved")
+            return
+        if queued == SKIPPED:
+            pass
+        elif queued is None:
+            LOGGER.warning(
+                "Skipping message missing from the delivery queue.",
+                extra={"channel_id": channel_id, "seq": seq},
+            )
+            STATS.incr("missing")
+        else:
+            msg, from_user, *rest = queued
+            # Messages queued before delivery ids existed fall back to their place.
+            delivery_id = rest[0] if rest else f"{channel_id}:{seq}"
+            try:
+                response = forward(channel_id, msg, from_user, delivery_id=delivery_id)
+                if not response.get("ok"):
+                    raise MegatronException(response.get("error"))
+            except retries.RETRYABLE_ERRORS:
+                # Left at the head of the queue, the retried drain picks it up.
+                raise
+            except Exception as exc:
+                LOGGER.exception(
+                    "Failed to forward message, skipping it.",
+                    extra={"channel_id": channel_id, "seq": seq},
+                )
+                STATS.incr("failed")
+                retries.store_dead_letter(
+                    FORWARD_TASK,
+                    str(uuid.uuid4()),
+                    [channel_id, msg, from_user],
+                    {},
+                    exc,
+                )
+            else:
+                STATS.incr("delivered")
+        cache.set(_next_key(channel_id), seq + 1, None)
+        cache.delete(key)
+        cache.touch(_lock_key(channel_id), settings.DELIVERY_LOCK_TIMEOUT)
+
+
+@retries.slack_task
+def drain_channel(channel_id: str) -> None:
+    """
+    Forwards the channel's queued messages in order. Returns right away if
+    another worker is already draining the channel, it will deliver the
+    message this task was queued for.
+    """
+    lock_key = _lock_key(channel_id)
+    token = uuid.uuid4().hex
+    if cache.add(lock_key, token, settings.DELIVERY_LOCK_TIMEOUT) is False:
+        STATS.incr("busy")
+        return
+    try:
+        _drain(channel_id)
+    finally:
+        if cache.get(lock_key) == token:
+            cache.delete(lock_key)
+    # A message queued while the lock was being released would be stuck
+    # until the channel's next message otherwise.
+    if _pending(channel_id) and not _head_reserved(channel_id):
+        drain_channel.delay(channel_id)
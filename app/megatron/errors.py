@@ -20,6 +20,13 @@ class MegatronException(Exception):
         self.platform_message = platform_message
 
 
+class MegatronTransientError(MegatronException):
+    """
+    A failure that is likely to go away on its own, e.g. a Slack outage or
+    timeout. Celery tasks retry these with backoff.
+    """
+
+
 class ErrorResponse(Response):
     def __init__(
         self, error: MegatronError, status: status = status.HTTP_200_OK, *args, **kwargs
@@ -53,6 +60,9 @@ def catch_megatron_errors(func):
     def wrapper(*args, **kwargs):
         try:
             response = func(*args, **kwargs)
+        except MegatronTransientError:
+            # Left to the caller, celery tasks retry it.
+            raise
         except MegatronException as exc:
             LOGGER.exception(exc)
             return {"ok": False, "error": "Unrecognized error.", "status": 500}
@@ -0,0 +1,47 @@
+"""
+Entry point of celery workers running tasks on green threads:
+
+    celery -A megatron.green worker -P gevent -c 100 -Q megatron
+
+Nearly every task waits on Slack or the command url, so one process can
+run many of them at once. Loading the app through this module patches the
+standard library, so sockets, locks and sleeps yield to the other
+greenlets, and makes psycopg2 wait for postgres the same way.
+
+Django keeps a database connection per thread, which here means per
+greenlet, and the gevent pool spawns a greenlet per task. Connections are
+therefore closed when their task ends, whatever CONN_MAX_AGE says, and a
+worker holds at most its concurrency in connections.
+"""
+from gevent import monkey
+
+monkey.patch_all()
+
+# The imports below must not run before the patching.
+from celery.signals import task_postrun  # noqa: E402
+from django.db import connections  # noqa: E402
+from gevent.socket import wait_read, wait_write  # noqa: E402
+from psycopg2 import extensions, OperationalError  # noqa: E402
+
+from megatron.celery import app  # noqa: E402,F401
+
+
+def _wait_for_postgres(conn, timeout=None):
+    while True:
+        state = conn.poll()
+        if state == extensions.POLL_OK:
+            return
+        elif state == extensions.POLL_READ:
+            wait_read(conn.fileno(), timeout=timeout)
+        elif state == extensions.POLL_WRITE:
+            wait_write(conn.fileno(), timeout=timeout)
+        else:
+            raise OperationalError(f"Bad result from poll: {state}")
+
+
+extensions.set_wait_callback(_wait_for_postgres)
+
+
+@task_postrun.connect
+def close_task_connections(**kwargs):
+    connections.close_all()
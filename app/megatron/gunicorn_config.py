@@ -0,0 +1,23 @@
+"""
+Gunicorn settings of the production server, see start.sh.
+
+The relay views spend nearly all their time waiting on Slack, so each
+worker process serves many requests at once from a pool of threads
+(gthread) rather than one at a time. Set GUNICORN_WORKER_CLASS to "sync"
+for the old behaviour.
+"""
+import os
+
+bind = f"0.0.0.0:{os.environ.get('DJANGO_PORT', '8002')}"
+worker_class = os.environ.get("GUNICORN_WORKER_CLASS", "gthread")
+workers = int(os.environ.get("GUNICORN_WORKERS", 4))
+# Gunicorn turns sync workers with more than one thread into gthread ones.
+threads = (
+    int(os.environ.get("GUNICORN_THREADS", 16)) if worker_class == "gthread" else 1
+)
+timeout = int(os.environ.get("GUNICORN_TIMEOUT", 60))
+errorlog = "-"
+
+# Any thread may be waiting on Slack, give each one a keep-alive connection
+# rather than opening and dropping extra ones past the pool size.
+os.environ.setdefault("HTTP_POOL_MAXSIZE", str(threads))
@@ -2,14 +2,17 @@ import json
 import logging
 from json import JSONDecodeError
 
+from celery import shared_task
+from django.conf import settings
 from django.views.decorators.csrf import csrf_exempt
 from django.http import HttpResponse, JsonResponse, HttpResponseForbidden
 from django.core.cache import cache
-from django.db.utils import IntegrityError
 from kombu.utils import json as kombu_json
 from datetime import datetime
 
 from megatron.authentication import validate_slack_token
+from megatron import delivery
+from megatron.deduplication import first_delivery
 from megatron.models import (
     MegatronChannel,
     MegatronUser,
@@ -28,6 +31,8 @@ from megatron.interpreters.slack import formatting
 
 BOTNAME = "Teampay"
 LOGGER = logging.getLogger(__name__)
+# Event subtypes that are forwarded to the customer; None is a plain message.
+FORWARDED_SUBTYPES = (None, "file_share")
 
 
 @catch_megatron_errors
@@ -187,30 +192,66 @@ def event(request):
     if event.get("message") and event["message"].get("subtype") == "bot_message":
         return HttpResponse(b"")
 
-    subtype = event.get("subtype")
-    channel_id = event.get("channel")
-    user_id = event.get("user")
-    if subtype == "message_changed":
-        user_id = event["message"].get("user")
+    if not first_delivery("event", event.get("channel"), event["event_ts"]):
+        return HttpResponse(b"")
 
     try:
-        tracked_channel = MegatronChannel.objects.get(platform_channel_id=channel_id)
+        tracked_channel = MegatronChannel.objects.with_related().get(
+            platform_channel_id=event.get("channel")
+        )
     except MegatronChannel.DoesNotExist:
         return HttpResponse(b"")
 
+    if settings.SLACK_EVENTS_DEFERRED:
+        # Numbered now, in the order Slack sent them, rather than in
+        # whatever order the workers get through them.
+        seq = None
+        if event.get("subtype") in FORWARDED_SUBTYPES:
+            seq = delivery.reserve_sequence(tracked_channel.platform_channel_id)
+        process_event.delay(event, tracked_channel.id, seq)
+    else:
+        _process_event(event, tracked_channel)
+    return HttpResponse(b"")
+
+
+@shared_task
+def process_event(event: dict, tracked_channel_id: int, seq: int = None):
+    """
+    Handles a message event after Slack has been answered, see
+    SLACK_EVENTS_DEFERRED. `seq` is the delivery sequence number reserved
+    for the message when the event came in.
+    """
     try:
-        MegatronMessage.objects.create(
-            megatron_channel=tracked_channel, integration_msg_id=event["event_ts"]
+        tracked_channel = MegatronChannel.objects.with_related().get(
+            id=tracked_channel_id
         )
-    except IntegrityError:
-        LOGGER.warning("Discarding duplicate event.", extra={"received_msg": data})
-        return HttpResponse(b"")
+    except MegatronChannel.DoesNotExist:
+        LOGGER.warning(
+            "Dropping event for deleted channel.",
+            extra={"channel_id": tracked_channel_id},
+        )
+        delivery.release_sequence(event["channel"], seq)
+        return
+    try:
+        _process_event(event, tracked_channel, seq)
+    except Exception:
+        # Don't hold up the channel's later messages.
+        delivery.release_sequence(tracked_channel.platform_channel_id, seq)
+        raise
+
+
+def _process_event(event: dict, tracked_channel: MegatronChannel, seq: int = None):
+    subtype = event.get("subtype")
+    channel_id = tracked_channel.platform_channel_id
+    user_id = event.get("user", "")
+    if subtype == "message_changed":
+        user_id = event["message"].get("user", "")
 
-    from_user = _get_slack_user_data(channel_id, user_id)
+    from_user = _get_slack_user_data(tracked_channel, user_id)
     if subtype:
         if subtype == "file_share":
-            msg = _image_passthrough_message(event)
-            Command.get_command("forward").action.delay(channel_id, msg, from_user)
+            msg = _image_passthrough_message(event, tracked_channel)
+            delivery.forward_in_order(channel_id, msg, from_user, seq)
 
         elif subtype == "message_changed":
             # Was changed by bot
@@ -220,7 +261,7 @@ def event(request):
                     megatron_channel=tracked_channel,
                 )
             except MegatronMessage.DoesNotExist:
-                return HttpResponse(b"")
+                return
 
             workspace_connection = WorkspaceService(
                 tracked_channel.workspace
@@ -243,6 +284,8 @@ def event(request):
 
             update_action = Action(ActionType.UPDATE_MESSAGE, params)
             response = workspace_connection.take_action(update_action)
+            if response.get("error") == "channel_not_found":
+                workspace_connection.forget_im(tracked_channel.platform_user_id)
 
             existing_message.integration_msg_id = event["message"]["ts"]
             existing_message.customer_msg_id = response["ts"]
@@ -255,15 +298,10 @@ def event(request):
             "attachments": event.get("attachments"),
             "ts": event.get("ts"),
         }
-        Command.get_command("forward").action.delay(channel_id, msg, from_user)
-
-    return HttpResponse(b"")
+        delivery.forward_in_order(channel_id, msg, from_user, seq)
 
 
-def _image_passthrough_message(event):
-    tracked_channel = MegatronChannel.objects.filter(
-        platform_channel_id=event["channel"]
-    ).first()
+def _image_passthrough_message(event: dict, tracked_channel: MegatronChannel):
     integration_service = IntegrationService(tracked_channel.megatron_integration)
     integration_connection = integration_service.get_connection(as_user=False)
     platform_agent = integration_service.get_or_create_user_by_id(event["user"])
@@ -275,18 +313,15 @@ def _image_passthrough_message(event):
     return msg
 
 
-def _get_slack_user_data(channel_id, slack_id):
-    # TODO: Verify responses/that user exists
-    incoming_channel = MegatronChannel.objects.get(platform_channel_id=channel_id)
-    integration_connection = IntegrationService(
-        incoming_channel.megatron_integration
-    ).get_connection()
-    action = Action(ActionType.GET_USER_INFO, {"user_id": slack_id})
-    response = integration_connection.take_action(action)
-    user_data = response["user"]
+def _get_slack_user_data(tracked_channel: MegatronChannel, slack_id: str) -> dict:
+    platform_agent = IntegrationService(
+        tracked_channel.megatron_integration
+    ).get_or_create_user_by_id(slack_id)
+    if not platform_agent:
+        return {"user_name": BOTNAME, "user_icon_url": ""}
     from_user = {
-        "user_name": user_data["profile"]["real_name"],
-        "user_icon_url": user_data["profile"]["image_24"],
+        "user_name": platform_agent.real_name or platform_agent.get_display_name(),
+        "user_icon_url": platform_agent.profile_image,
     }
     return from_user
 
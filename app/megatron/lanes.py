@@ -0,0 +1,65 @@
+import logging
+import time
+from typing import Dict, Optional
+
+from celery.signals import before_task_publish, task_prerun
+from celery.utils.iso8601 import parse_iso8601
+from kombu.exceptions import ChannelError
+
+from megatron import metrics
+from megatron.celery import QUEUES, app
+
+
+LOGGER = logging.getLogger(__name__)
+STATS = metrics.counters("queues")
+
+PUBLISHED_HEADER = "megatron_published_at"
+
+
+def depths() -> Optional[Dict[str, int]]:
+    """
+    Messages waiting in each queue, or None when the broker can't be reached.
+    """
+    waiting = {}
+    try:
+        with app.pool.acquire(block=True) as conn:
+            # Fails right away rather than retrying like a worker would.
+            conn.ensure_connection(max_retries=1, interval_start=0)
+            for queue in QUEUES:
+                try:
+                    waiting[queue] = conn.default_channel.queue_declare(
+                        queue=queue, passive=True
+                    ).message_count
+                except ChannelError:
+                    # Nothing was ever published to it.
+                    waiting[queue] = 0
+    except Exception:
+        LOGGER.warning("Could not read queue depths.")
+        return None
+    return waiting
+
+
+STATS.gauge("depth", depths)
+
+
+@before_task_publish.connect
+def stamp_published_at(headers=None, **kwargs):
+    headers[PUBLISHED_HEADER] = time.time()
+
+
+@task_prerun.connect
+def record_wait(task=None, **kwargs):
+    """
+    Counts the tasks started from each queue and how long they waited
+    there. Tasks given an eta or countdown are timed from that moment.
+    """
+    request = task.request
+    published_at = getattr(request, PUBLISHED_HEADER, None)
+    if request.is_eager or published_at is None:
+        return
+    queue = (request.delivery_info or {}).get("routing_key") or "unknown"
+    ready_at = published_at
+    if request.eta:
+        ready_at = max(ready_at, parse_iso8601(request.eta).timestamp())
+    STATS.incr(f"{queue}:started")
+    STATS.timing(f"{queue}:wait_seconds", max(0.0, time.time() - ready_at))
@@ -0,0 +1,53 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from megatron import retries
+from megatron.models import DeadLetter
+
+
+class Command(BaseCommand):
+    help = "Lists, replays or deletes celery tasks that failed for good."
+
+    def add_arguments(self, parser):
+        parser.add_argument("action", choices=["list", "show", "replay", "delete"])
+        parser.add_argument("ids", nargs="*", type=int, help="Dead letter ids.")
+        parser.add_argument(
+            "--all",
+            action="store_true",
+            help="Act on every dead letter that hasn't been replayed yet.",
+        )
+        parser.add_argument("--task", help="Only dead letters of this task name.")
+
+    def handle(self, *args, **options):
+        dead_letters = DeadLetter.objects.order_by("id")
+        if options["task"]:
+            dead_letters = dead_letters.filter(task_name=options["task"])
+        if options["ids"]:
+            dead_letters = dead_letters.filter(id__in=options["ids"])
+        elif options["all"] or options["action"] == "list":
+            dead_letters = dead_letters.filter(replayed_at__isnull=True)
+        else:
+            raise CommandError("Pass dead letter ids or --all.")
+
+        action = options["action"]
+        for dead_letter in dead_letters:
+            if action == "list":
+                self.stdout.write(
+                    f"{dead_letter.id}\t{dead_letter.created_at:%Y-%m-%d %H:%M}"
+                    f"\t{dead_letter.task_name}\t{dead_letter.error[:80]}"
+                )
+            elif action == "show":
+                self.stdout.write(
+                    f"id: {dead_letter.id}\n"
+                    f"task: {dead_letter.task_name} ({dead_letter.task_id})\n"
+                    f"args: {dead_letter.args}\n"
+                    f"kwargs: {dead_letter.kwargs}\n"
+                    f"retries: {dead_letter.retries}\n"
+                    f"replayed at: {dead_letter.replayed_at}\n"
+                    f"error: {dead_letter.error}\n"
+                )
+            elif action == "replay":
+                retries.replay(dead_letter)
+                self.stdout.write(f"Replayed {dead_letter.id}.")
+            elif action == "delete":
+                dead_letter.delete()
+                self.stdout.write(f"Deleted {dead_letter.id}.")
@@ -0,0 +1,77 @@
+import threading
+from typing import Any, Callable, Dict
+
+
+class Counters:
+    """
+    Thread-safe, in-process counters and timings for a single component.
+    Values are per process; they reset whenever a worker restarts.
+    """
+
+    def __init__(self, name: str) -> None:
+        self.name = name
+        self._lock = threading.Lock()
+        self._counts: Dict[str, int] = {}
+        self._timings: Dict[str, dict] = {}
+        self._gauges: Dict[str, Callable[[], Any]] = {}
+
+    def incr(self, key: str, amount: int = 1) -> None:
+        with self._lock:
+            self._counts[key] = self._counts.get(key, 0) + amount
+
+    def timing(self, key: str, value: float) -> None:
+        with self._lock:
+            timing = self._timings.setdefault(
+                key, {"count": 0, "total": 0.0, "max": 0.0}
+            )
+            timing["count"] += 1
+            timing["total"] += value
+            timing["max"] = max(timing["max"], value)
+
+    def counts(self) -> Dict[str, int]:
+        with self._lock:
+            return dict(self._counts)
+
+    def timings(self) -> Dict[str, dict]:
+        with self._lock:
+            return {key: dict(timing) for key, timing in self._timings.items()}
+
+    def gauge(self, key: str, read: Callable[[], Any]) -> None:
+        """
+        Registers a value that is computed every time a snapshot is taken.
+        """
+        with self._lock:
+            self._gauges[key] = read
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            data: dict = dict(self._counts)
+            for key, timing in self._timings.items():
+                data[key] = dict(timing)
+                data[key]["avg"] = timing["total"] / timing["count"]
+            gauges = list(self._gauges.items())
+        for key, read in gauges:
+            data[key] = read()
+        return data
+
+    def reset(self) -> None:
+        with self._lock:
+            self._counts = {}
+            self._timings = {}
+
+
+_REGISTRY: Dict[str, Counters] = {}
+_REGISTRY_LOCK = threading.Lock()
+
+
+def counters(name: str) -> Counters:
+    with _REGISTRY_LOCK:
+        if name not in _REGISTRY:
+            _REGISTRY[name] = Counters(name)
+        return _REGISTRY[name]
+
+
+def snapshot() -> dict:
+    with _REGISTRY_LOCK:
+        registered = list(_REGISTRY.values())
+    return {counter.name: counter.snapshot() for counter in registered}
@@ -0,0 +1,45 @@
+# Generated by Django 2.2.28 on 2026-10-18 12:51
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('megatron', '0013_auto_20200414_1253'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Broadcast',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('message', models.TextField()),
+                ('capture_feedback', models.BooleanField(default=False)),
+                ('is_finished', models.BooleanField(default=False)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='BroadcastRecipient',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('platform_type', models.CharField(max_length=15)),
+                ('org_id', models.CharField(max_length=255)),
+                ('platform_user_id', models.CharField(max_length=127)),
+                ('status', models.CharField(choices=[('pending', 'Pending'), ('sending', 'Sending'), ('sent', 'Sent'), ('failed', 'Failed')], default='pending', max_length=15)),
+                ('error', models.TextField(blank=True, null=True)),
+                ('broadcast', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='recipients', to='megatron.Broadcast')),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name='broadcastrecipient',
+            index=models.Index(fields=['broadcast', 'status'], name='megatron_br_broadca_37a2f6_idx'),
+        ),
+        migrations.AlterUniqueTogether(
+            name='broadcastrecipient',
+            unique_together={('broadcast', 'org_id', 'platform_user_id')},
+        ),
+    ]
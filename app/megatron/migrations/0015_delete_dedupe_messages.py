@@ -0,0 +1,21 @@
+# Generated by Django 2.2.28 on 2026-10-18 14:02
+
+from django.db import migrations
+
+
+def delete_dedupe_messages(apps, schema_editor):
+    # Events used to be deduplicated by inserting a message row; rows that
+    # never got a customer message id only ever served that purpose.
+    MegatronMessage = apps.get_model("megatron", "MegatronMessage")
+    MegatronMessage.objects.filter(customer_msg_id__isnull=True).delete()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("megatron", "0014_broadcast"),
+    ]
+
+    operations = [
+        migrations.RunPython(delete_dedupe_messages, migrations.RunPython.noop),
+    ]
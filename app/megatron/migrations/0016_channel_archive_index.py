@@ -0,0 +1,17 @@
+# Generated by Django 2.2.28 on 2026-10-18 13:29
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('megatron', '0015_delete_dedupe_messages'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='megatronchannel',
+            index=models.Index(fields=['is_archived', 'last_message_sent'], name='megatron_me_is_arch_a72061_idx'),
+        ),
+    ]
@@ -0,0 +1,27 @@
+# Generated by Django 2.2.28 on 2026-10-18 13:34
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('megatron', '0016_channel_archive_index'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='DeadLetter',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('task_name', models.CharField(max_length=255)),
+                ('task_id', models.CharField(max_length=255, unique=True)),
+                ('args', models.TextField()),
+                ('kwargs', models.TextField()),
+                ('error', models.TextField()),
+                ('retries', models.IntegerField(default=0)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('replayed_at', models.DateTimeField(blank=True, null=True)),
+            ],
+        ),
+    ]
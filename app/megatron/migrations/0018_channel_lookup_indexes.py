@@ -0,0 +1,25 @@
+# Generated by Django 2.2.28 on 2026-10-18 13:57
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('megatron', '0017_dead_letter'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='megatronchannel',
+            index=models.Index(fields=['platform_user_id', 'id'], name='megatron_me_platfor_12a269_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='megatronchannel',
+            index=models.Index(fields=['platform_channel_id'], name='megatron_me_platfor_4e0725_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='megatronchannel',
+            index=models.Index(fields=['is_paused', 'is_archived', 'last_message_sent'], name='megatron_me_is_paus_a92cc0_idx'),
+        ),
+    ]
@@ -13,6 +13,13 @@ class PlatformType(enum.Enum):
     Slack = 1
 
 
+class DeliveryStatus(enum.Enum):
+    pending = "pending"
+    sending = "sending"
+    sent = "sent"
+    failed = "failed"
+
+
 class MegatronUser(AbstractBaseUser):
     access_level = (("admin", "Administrator"),)
     organization_name = models.CharField(max_length=255)
@@ -59,6 +66,15 @@ class CustomerWorkspace(models.Model):
         unique_together = ("platform_type", "platform_id")
 
 
+class MegatronChannelQuerySet(models.QuerySet):
+    def with_related(self):
+        """
+        Joins everything handling a channel's messages needs, so views and
+        tasks don't load each relation with a query of its own.
+        """
+        return self.select_related("megatron_user", "megatron_integration", "workspace")
+
+
 class MegatronChannel(models.Model):
     megatron_user = models.ForeignKey(MegatronUser, on_delete=models.CASCADE)
     name = models.CharField(max_length=255)
@@ -74,11 +90,21 @@ class MegatronChannel(models.Model):
     is_paused = models.BooleanField(default=False)
     is_archived = models.BooleanField(default=False)
 
+    objects = MegatronChannelQuerySet.as_manager()
+
     class Meta:
         unique_together = (
             ("workspace", "platform_channel_id"),
             ("workspace", "platform_user_id"),
         )
+        indexes = [
+            models.Index(fields=["is_archived", "last_message_sent"]),
+            # Lookups by customer or by channel alone can't use the unique
+            # constraints, they lead with the workspace.
+            models.Index(fields=["platform_user_id", "id"]),
+            models.Index(fields=["platform_channel_id"]),
+            models.Index(fields=["is_paused", "is_archived", "last_message_sent"]),
+        ]
 
 
 class MegatronMessage(models.Model):
@@ -151,3 +177,48 @@ class PlatformAgent(models.Model):
         elif self.real_name:
             return self.real_name
         return self.username
+
+
+class Broadcast(models.Model):
+    # JSON encoded message, decoded again for every delivered chunk
+    message = models.TextField()
+    capture_feedback = models.BooleanField(default=False)
+    is_finished = models.BooleanField(default=False)
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+
+class BroadcastRecipient(models.Model):
+    broadcast = models.ForeignKey(
+        Broadcast, on_delete=models.CASCADE, related_name="recipients"
+    )
+    platform_type = models.CharField(max_length=15)
+    org_id = models.CharField(max_length=255)
+    platform_user_id = models.CharField(max_length=127)
+    status = models.CharField(
+        max_length=15,
+        choices=((s.value, s.name.title()) for s in DeliveryStatus),
+        default=DeliveryStatus.pending.value,
+    )  # type: ignore
+    error = models.TextField(blank=True, null=True)
+
+    class Meta:
+        unique_together = ("broadcast", "org_id", "platform_user_id")
+        indexes = [models.Index(fields=["broadcast", "status"])]
+
+
+class DeadLetter(models.Model):
+    """
+    A celery task that failed for good, kept so it can be inspected and
+    replayed with the `dead_letters` management command.
+    """
+
+    task_name = models.CharField(max_length=255)
+    task_id = models.CharField(max_length=255, unique=True)
+    # JSON encoded, like the task message itself
+    args = models.TextField()
+    kwargs = models.TextField()
+    error = models.TextField()
+    retries = models.IntegerField(default=0)
+    created_at = models.DateTimeField(auto_now_add=True)
+    replayed_at = models.DateTimeField(blank=True, null=True)
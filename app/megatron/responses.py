@@ -1,5 +1,7 @@
 import json
+from typing import Mapping
 
+import simplejson
 from django.http import HttpResponse
 
 
@@ -10,5 +12,54 @@ class MegatronResponse(HttpResponse):
         self.status_code = status
         self.content_type = "application/json"
 
+    def json(self):
+        # Lets callers of SafeRequest treat these like a requests.Response.
+        return json.loads(self.content)
+
 
 OK_RESPONSE = MegatronResponse({"ok": True}, 200)
+
+
+class SlackResponse(dict):
+    """
+    A Slack API answer with its body decoded once.
+
+    The decoded body is the dict itself, so a SlackResponse goes wherever
+    that dict used to, `catch_megatron_errors` included. The HTTP side is
+    kept in `status_code`, `headers` and `latency`, in seconds. `json()`
+    returns the response itself for code written against
+    `requests.Response`.
+    """
+
+    def __init__(
+        self,
+        data: dict,
+        status_code: int = 200,
+        headers: Mapping[str, str] = None,
+        latency: float = 0.0,
+        text: str = "",
+    ) -> None:
+        super().__init__(data)
+        self.status_code = status_code
+        self.headers = headers or {}
+        self.latency = latency
+        self.text = text
+
+    @classmethod
+    def from_response(cls, response, latency: float = 0.0) -> "SlackResponse":
+        text = response.content.decode(response.encoding or "utf-8", "replace")
+        try:
+            data = simplejson.loads(text)
+        except ValueError:
+            # Response urls answer slash commands with a plain "ok".
+            data = {"ok": True} if text == "ok" else None
+        if not isinstance(data, dict):
+            data = {"ok": False, "error": "Could not decode response body."}
+        return cls(data, response.status_code, response.headers, latency, text)
+
+    @property
+    def ok(self) -> bool:
+        return bool(self.get("ok"))
+
+    def json(self) -> "SlackResponse":
+        return self
@@ -0,0 +1,154 @@
+import json
+import logging
+from typing import Any, Callable
+
+import requests
+from celery import Task, current_app, shared_task
+from django.conf import settings
+from django.core.cache import cache
+from django.utils import timezone
+
+from megatron import metrics
+from megatron.errors import MegatronTransientError
+from megatron.models import DeadLetter
+
+
+LOGGER = logging.getLogger(__name__)
+STATS = metrics.counters("task_retries")
+
+RETRYABLE_ERRORS = (MegatronTransientError, requests.ConnectionError, requests.Timeout)
+
+# Slack errors that say nothing about the request itself, trying again later
+# may well work. "Timeout error" is what SafeRequest answers on timeouts.
+# https://api.slack.com/web#errors
+TRANSIENT_SLACK_ERRORS = {
+    "Timeout error",
+    "fatal_error",
+    "internal_error",
+    "ratelimited",
+    "request_timeout",
+    "service_unavailable",
+}
+
+IDEMPOTENCY_PREFIX = "task_step:"
+
+
+def is_transient(response: dict) -> bool:
+    """
+    Whether a failed Slack response is worth retrying: a known transient
+    error, a 429 or a 5xx, whose HTML body Slack doesn't decode to an error.
+    """
+    if response.get("ok"):
+        return False
+    status_code = getattr(response, "status_code", 200)
+    return (
+        status_code == 429
+        or status_code >= 500
+        or response.get("error") in TRANSIENT_SLACK_ERRORS
+    )
+
+
+def raise_for_transient(response: dict) -> dict:
+    """
+    Raises MegatronTransientError for a failed Slack response that is worth
+    retrying, returns any other response as is.
+    """
+    if is_transient(response):
+        raise MegatronTransientError(response.get("error"))
+    return response
+
+
+def run_once(
+    task: Task, step: str, func: Callable, *args, run_id: str = None, **kwargs
+) -> Any:
+    """
+    Calls `func` once per task id: retries of the task get the result of
+    the first successful call instead of e.g. posting a message twice.
+    Direct, non celery, calls have no task id and always run `func`,
+    unless they pass a `run_id` of their own.
+    """
+    task_id = run_id or task.request.id
+    if not task_id:
+        return func(*args, **kwargs)
+    key = f"{IDEMPOTENCY_PREFIX}{task_id}:{step}"
+    result = cache.get(key)
+    if result is not None:
+        STATS.incr("skipped_steps")
+        return result
+    result = func(*args, **kwargs)
+    cache.set(key, result, settings.TASK_IDEMPOTENCY_TTL)
+    return result
+
+
+def store_dead_letter(
+    task_name: str, task_id: str, args, kwargs, exc: Exception, retries: int = 0
+) -> None:
+    try:
+        DeadLetter.objects.update_or_create(
+            task_id=task_id,
+            defaults={
+                "task_name": task_name,
+                "args": json.dumps(list(args or [])),
+                "kwargs": json.dumps(kwargs or {}),
+                "error": repr(exc),
+                "retries": retries,
+                "replayed_at": None,
+            },
+        )
+    except Exception:
+        LOGGER.exception("Could not store dead letter.", extra={"task_id": task_id})
+
+
+class SlackTask(Task):
+    """
+    Base for tasks that talk to Slack. Failures that outlive their retries,
+    or that aren't worth retrying, are stored as dead letters.
+    """
+
+    def on_retry(self, exc, task_id, args, kwargs, einfo):
+        STATS.incr("retried")
+        LOGGER.warning(
+            "Retrying task after transient error.",
+            extra={"task": self.name, "task_id": task_id, "error": str(exc)},
+        )
+
+    def on_failure(self, exc, task_id, args, kwargs, einfo):
+        STATS.incr("dead_letters")
+        LOGGER.error(
+            "Task failed, storing it as a dead letter.",
+            extra={"task": self.name, "task_id": task_id, "error": str(exc)},
+        )
+        store_dead_letter(
+            self.name, task_id, args, kwargs, exc, self.request.retries or 0
+        )
+
+
+def slack_task(func: Callable) -> Task:
+    """
+    `shared_task` with jittered exponential backoff on transient errors.
+    """
+    return shared_task(
+        base=SlackTask,
+        autoretry_for=RETRYABLE_ERRORS,
+        retry_backoff=settings.TASK_RETRY_BACKOFF,
+        retry_backoff_max=settings.TASK_RETRY_BACKOFF_MAX,
+        retry_jitter=True,
+        max_retries=settings.TASK_MAX_RETRIES,
+    )(func)
+
+
+def replay(dead_letter: DeadLetter) -> None:
+    """
+    Queues the dead letter's task again under its original id, so messages
+    it already sent are not sent twice. Should it fail again the dead
+    letter is updated rather than duplicated.
+    """
+    task = current_app.tasks[dead_letter.task_name]
+    dead_letter.replayed_at = timezone.now()
+    dead_letter.save(update_fields=["replayed_at"])
+    STATS.incr("replayed")
+    task.apply_async(
+        args=json.loads(dead_letter.args),
+        kwargs=json.loads(dead_letter.kwargs),
+        task_id=dead_letter.task_id,
+    )
@@ -1,8 +1,17 @@
+import logging
+import time
+import uuid
+from typing import List
+
 from celery import shared_task
+from django.conf import settings
+from django.core.cache import cache
+from django.db.models import Q
 
 from datetime import timedelta, datetime, timezone
 
-from megatron.models import MegatronChannel, MegatronIntegration, CustomerWorkspace
+from megatron import activity, metrics
+from megatron.models import MegatronChannel, CustomerWorkspace
 from megatron.services import (
     IntegrationService,
     MegatronChannelService,
@@ -10,43 +19,233 @@ from megatron.services import (
 )
 from megatron.interpreters.slack import formatting
 
+LOGGER = logging.getLogger(__name__)
+STATS = metrics.counters("archive_sweep")
+
 PAUSE_WARNING_START = timedelta(minutes=3)
 PAUSE_WARNING_STOP = PAUSE_WARNING_START + timedelta(minutes=1)
+REMINDER_TOKEN_PREFIX = "MEGATRON-UNPAUSE-REMINDER|"
+REMINDER_SENT_PREFIX = "MEGATRON-UNPAUSE-REMINDER-SENT|"
+REMINDER_TTL = int(PAUSE_WARNING_STOP.total_seconds()) * 2
 ARCHIVE_TIME = timedelta(hours=36)
+ARCHIVE_RUN_PREFIX = "MEGATRON-ARCHIVE-RUN|"
+ARCHIVE_RUN_TTL = 60 * 60 * 24
 
 
 @shared_task
 def refresh_platform_user_data():
-    for workspace in CustomerWorkspace.objects.all():
-        WorkspaceService(workspace).refresh_user_data()
+    workspace_ids = CustomerWorkspace.objects.values_list("id", flat=True)
+    for workspace_id in workspace_ids:
+        refresh_workspace_user_data.delay(workspace_id)
+
+
+@shared_task
+def refresh_workspace_user_data(workspace_id: int):
+    try:
+        workspace = CustomerWorkspace.objects.get(id=workspace_id)
+    except CustomerWorkspace.DoesNotExist:
+        return
+    updated = WorkspaceService(workspace).refresh_user_data()
+    LOGGER.info(
+        "Refreshed platform user data.",
+        extra={"workspace_id": workspace_id, "updated": updated},
+    )
+
+
+def _time_since(moment: datetime) -> timedelta:
+    now = datetime.now(timezone.utc) if moment.tzinfo else datetime.now()
+    return now - moment
+
+
+def schedule_unpause_reminder(channel: MegatronChannel):
+    """
+    Queues the pause warning for when PAUSE_WARNING_START has passed since
+    the last message. Scheduling again, e.g. because another message was
+    sent, supersedes the reminder that is already queued.
+    """
+    elapsed = _time_since(activity.last_active(channel))
+    if elapsed > PAUSE_WARNING_STOP:
+        return
+    token = uuid.uuid4().hex
+    cache.set(REMINDER_TOKEN_PREFIX + str(channel.id), token, REMINDER_TTL)
+    countdown = max(0, (PAUSE_WARNING_START - elapsed).total_seconds())
+    send_unpause_reminder.apply_async((channel.id, token), countdown=countdown)
+
+
+def cancel_unpause_reminder(channel: MegatronChannel):
+    cache.delete(REMINDER_TOKEN_PREFIX + str(channel.id))
+
+
+@shared_task
+def send_unpause_reminder(channel_id: int, token: str):
+    if cache.get(REMINDER_TOKEN_PREFIX + str(channel_id)) != token:
+        return
+    channel = (
+        MegatronChannel.objects.with_related()
+        .filter(id=channel_id, is_paused=True, is_archived=False)
+        .first()
+    )
+    if channel:
+        _send_unpause_reminder(channel, activity.last_active(channel))
 
 
 @shared_task
 def unpause_reminder():
-    channels = MegatronChannel.objects.all()
+    """
+    Fallback for reminders whose scheduled task was lost, e.g. when a worker
+    died. Only looks at paused channels inside the reminder window, by
+    their stored or their pending activity.
+    """
+    now = datetime.now()
+    in_window = Q(
+        last_message_sent__gt=now - PAUSE_WARNING_STOP,
+        last_message_sent__lte=now - PAUSE_WARNING_START,
+    )
+    channels = list(
+        MegatronChannel.objects.with_related()
+        .filter(is_paused=True, is_archived=False)
+        .filter(in_window | Q(id__in=activity.pending_channel_ids()))
+    )
+    pending = activity.pending_timestamps(channel.id for channel in channels)
     for channel in channels:
-        if not channel.is_paused or channel.is_archived:
-            continue
-        workspace_id = channel.workspace.platform_id
-        platform_user_id = channel.platform_user_id
-        time_since_last_message = datetime.now() - channel.last_message_sent
-        if PAUSE_WARNING_START < time_since_last_message <= PAUSE_WARNING_STOP:
-            integration = MegatronIntegration.objects.get(
-                megatron_user=channel.megatron_user
-            )
-            connection = IntegrationService(integration).get_connection(as_user=False)
-            msg = formatting.get_pause_warning(workspace_id, platform_user_id)
-            connection.message(channel.platform_channel_id, msg)
+        last_active = activity.last_active(channel, pending)
+        if PAUSE_WARNING_START <= _time_since(last_active) < PAUSE_WARNING_STOP:
+            _send_unpause_reminder(channel, last_active)
+
+
+def _send_unpause_reminder(channel: MegatronChannel, last_active: datetime):
+    # Both the scheduled task and the fallback sweep can get here, only the
+    # first one sends the warning for a given last message. When redis is
+    # unreachable `add` answers None, better to warn twice than not at all.
+    sent_key = f"{REMINDER_SENT_PREFIX}{channel.id}:{last_active.isoformat()}"
+    if cache.add(sent_key, 1, PAUSE_WARNING_STOP.total_seconds()) is False:
+        return
+    workspace_id = channel.workspace.platform_id
+    platform_user_id = channel.platform_user_id
+    connection = IntegrationService(channel.megatron_integration).get_connection(
+        as_user=False
+    )
+    msg = formatting.get_pause_warning(workspace_id, platform_user_id)
+    connection.message(channel.platform_channel_id, msg)
 
 
 @shared_task
 def archive_channels():
+    """
+    Archives channels without messages for ARCHIVE_TIME. Stale channels are
+    split into chunks of ARCHIVE_CHUNK_SIZE, grouped by integration, and
+    archived by concurrent archive_channel_chunk tasks. The last chunk to
+    finish logs a summary of the run.
+    """
     archive_time = datetime.now(timezone.utc) - ARCHIVE_TIME
-    channels = MegatronChannel.objects.filter(
-        is_archived=False, last_message_sent__lte=archive_time
+    channel_ids = list(
+        MegatronChannel.objects.filter(
+            is_archived=False, last_message_sent__lte=archive_time
+        )
+        .order_by("megatron_integration_id", "id")
+        .values_list("id", flat=True)
+    )
+    # Channels with a message since the last activity flush aren't stale.
+    stale_before = time.time() - ARCHIVE_TIME.total_seconds()
+    pending = activity.pending_timestamps(channel_ids)
+    channel_ids = [
+        channel_id
+        for channel_id in channel_ids
+        if pending.get(channel_id, 0) <= stale_before
+    ]
+    chunk_size = settings.ARCHIVE_CHUNK_SIZE
+    chunks = [
+        channel_ids[i : i + chunk_size] for i in range(0, len(channel_ids), chunk_size)
+    ]
+    if not chunks:
+        return
+
+    run_id = uuid.uuid4().hex
+    prefix = ARCHIVE_RUN_PREFIX + run_id
+    cache.set_many(
+        {
+            f"{prefix}|started": time.time(),
+            f"{prefix}|pending": len(chunks),
+            f"{prefix}|archived": 0,
+            f"{prefix}|failed": 0,
+            f"{prefix}|chunk_ms": 0,
+        },
+        ARCHIVE_RUN_TTL,
+    )
+    LOGGER.info(
+        "Archiving stale channels.",
+        extra={"run_id": run_id, "channels": len(channel_ids), "chunks": len(chunks)},
+    )
+    for chunk in chunks:
+        archive_channel_chunk.delay(run_id, chunk)
+
+
+@shared_task
+def archive_channel_chunk(run_id: str, channel_ids: List[int]):
+    started = time.monotonic()
+    archived = failed = 0
+    channels = MegatronChannel.objects.with_related().filter(
+        id__in=channel_ids, is_archived=False
     )
     for channel in channels:
         channel_service = MegatronChannelService(channel)
-        if channel.is_paused:
-            channel_service.change_pause_state(pause_state=False)
-        channel_service.archive()
+        try:
+            if channel.is_paused:
+                channel_service.change_pause_state(pause_state=False)
+            channel_service.archive()
+        except Exception:
+            LOGGER.exception(
+                "Failed to archive channel.", extra={"channel_id": channel.id}
+            )
+        if channel.is_archived:
+            archived += 1
+        else:
+            failed += 1
+
+    duration = time.monotonic() - started
+    STATS.incr("archived", archived)
+    STATS.incr("failed", failed)
+    STATS.timing("chunk_seconds", duration)
+    _finish_archive_chunk(run_id, archived, failed, duration)
+
+
+def _finish_archive_chunk(run_id: str, archived: int, failed: int, duration: float):
+    prefix = ARCHIVE_RUN_PREFIX + run_id
+    try:
+        cache.incr(f"{prefix}|archived", archived)
+        cache.incr(f"{prefix}|failed", failed)
+        cache.incr(f"{prefix}|chunk_ms", int(duration * 1000))
+        pending = cache.decr(f"{prefix}|pending")
+    except ValueError:
+        # The run's counters expired.
+        pending = None
+    # Ignoring its exceptions, the redis cache answers None when unreachable.
+    if pending is None:
+        # All that can be reported is this chunk.
+        LOGGER.info(
+            "Archived chunk of stale channels.",
+            extra={
+                "run_id": run_id,
+                "archived": archived,
+                "failed": failed,
+                "seconds": round(duration, 2),
+            },
+        )
+        return
+    if pending > 0:
+        return
+
+    keys = ["started", "archived", "failed", "chunk_ms"]
+    run = cache.get_many([f"{prefix}|{key}" for key in keys])
+    cache.delete_many([f"{prefix}|{key}" for key in keys + ["pending"]])
+    started = run.get(f"{prefix}|started")
+    LOGGER.info(
+        "Finished archiving stale channels.",
+        extra={
+            "run_id": run_id,
+            "archived": run.get(f"{prefix}|archived"),
+            "failed": run.get(f"{prefix}|failed"),
+            "seconds": round(time.time() - started, 2) if started else None,
+            "chunk_seconds": run.get(f"{prefix}|chunk_ms", 0) / 1000,
+        },
+    )
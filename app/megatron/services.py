@@ -5,6 +5,7 @@ from typing import Optional
 import requests
 
 from megatron import settings
+from megatron.caching import SingleFlight, TwoTierCache
 from megatron.connections.slack import SlackConnection
 from megatron.connections.actions import Action, ActionType
 from megatron.models import (
@@ -18,6 +19,36 @@ from megatron.models import (
 
 LOGGER = logging.getLogger(__name__)
 
+# Profiles only change when users edit them on Slack. Once the ttl runs out
+# agents are read from Slack again and customers' users from the database,
+# which refresh_user_data keeps current. Entries are dropped whenever a row
+# is updated.
+PROFILE_FIELDS = [
+    "id",
+    "platform_id",
+    "profile_image",
+    "username",
+    "display_name",
+    "real_name",
+]
+AGENT_PROFILES = TwoTierCache("agent_profiles", ttl=settings.PROFILE_CACHE_TTL)
+USER_PROFILES = TwoTierCache("user_profiles", ttl=settings.PROFILE_CACHE_TTL)
+PROFILE_LOOKUPS = SingleFlight("profiles", wait=settings.SLACK_LOOKUP_WAIT)
+
+
+def _cache_profile(profiles: TwoTierCache, key: str, instance, owner_field: str):
+    fields = PROFILE_FIELDS + [owner_field]
+    profiles.set(key, {field: getattr(instance, field) for field in fields})
+
+
+def _cached_profile(profiles: TwoTierCache, key: str, model):
+    data = profiles.get(key)
+    if data is None:
+        return None
+    # from_db expects values in the model's field order.
+    field_names = [f.attname for f in model._meta.concrete_fields if f.attname in data]
+    return model.from_db("default", field_names, [data[name] for name in field_names])
+
 
 class IntegrationService:
     def __init__(self, integration: MegatronIntegration) -> None:
@@ -33,30 +64,62 @@ class IntegrationService:
         return api
 
     def get_or_create_user_by_id(self, user_id: str) -> Optional[PlatformAgent]:
-        try:
-            platform_agent = PlatformAgent.objects.get(
-                platform_id=user_id, integration=self.integration
-            )
-        except PlatformAgent.DoesNotExist:
-            connection = self.get_connection()
-            action = Action(ActionType.GET_USER_INFO, {"user_id": user_id})
-            response = connection.take_action(action)
-            if response.get("ok"):
-                profile = response["user"]["profile"]
-                platform_agent = PlatformAgent.objects.create(
-                    platform_id=user_id,
-                    integration=self.integration,
-                    profile_image=profile["image_72"],
-                    username=response["user"]["name"],
-                    display_name=profile.get("display_name"),
-                    real_name=profile.get("real_name"),
-                )
-            else:
-                LOGGER.error(
-                    "Failed to obtain or create platform agent data.",
-                    extra={"platform_user_id": user_id, "error": response["error"]},
+        cache_key = f"{self.integration.id}:{user_id}"
+        platform_agent = _cached_profile(AGENT_PROFILES, cache_key, PlatformAgent)
+        if platform_agent:
+            return platform_agent
+        return PROFILE_LOOKUPS.do(
+            f"agent:{cache_key}",
+            lambda: self._load_user(user_id, cache_key),
+            lambda: _cached_profile(AGENT_PROFILES, cache_key, PlatformAgent),
+        )
+
+    def _load_user(self, user_id: str, cache_key: str) -> Optional[PlatformAgent]:
+        """
+        Reads the agent's profile from Slack every time its cache entry runs
+        out, so name and avatar changes reach the footers within
+        PROFILE_CACHE_TTL. The stored profile is used while Slack fails.
+        """
+        platform_agent = PlatformAgent.objects.filter(
+            platform_id=user_id, integration=self.integration
+        ).first()
+        connection = self.get_connection()
+        action = Action(ActionType.GET_USER_INFO, {"user_id": user_id})
+        response = connection.take_action(action)
+        if response.get("ok"):
+            profile = response["user"]["profile"]
+            fields = {
+                "profile_image": profile["image_72"],
+                "username": response["user"]["name"],
+                "display_name": profile.get("display_name"),
+                "real_name": profile.get("real_name"),
+            }
+            if not platform_agent:
+                # Another process may have stored the agent in the meantime.
+                platform_agent, _ = PlatformAgent.objects.get_or_create(
+                    platform_id=user_id, integration=self.integration, defaults=fields
                 )
-                platform_agent = None
+            changed = [
+                name
+                for name, value in fields.items()
+                if getattr(platform_agent, name) != value
+            ]
+            if changed:
+                for name in changed:
+                    setattr(platform_agent, name, fields[name])
+                platform_agent.save(update_fields=changed)
+        elif platform_agent:
+            LOGGER.warning(
+                "Could not refresh platform agent, using the stored profile.",
+                extra={"platform_user_id": user_id, "error": response.get("error")},
+            )
+        else:
+            LOGGER.error(
+                "Failed to obtain or create platform agent data.",
+                extra={"platform_user_id": user_id, "error": response["error"]},
+            )
+            return None
+        _cache_profile(AGENT_PROFILES, cache_key, platform_agent, "integration_id")
         return platform_agent
 
 
@@ -67,29 +130,59 @@ class WorkspaceService:
     def get_connection(self, as_user=True):
         return SlackConnection(self.workspace.connection_token, as_user=as_user)
 
-    def refresh_user_data(self):
-        for platform_user in self.workspace.platformuser_set.all():
-            connection = self.get_connection()
+    def refresh_user_data(self) -> int:
+        """
+        Updates stored users from one paginated users.list instead of a
+        users.info call per user, writing only rows that changed.
+        """
+        platform_users = {
+            platform_user.platform_id: platform_user
+            for platform_user in self.workspace.platformuser_set.all()
+        }
+        if not platform_users:
+            return 0
 
-            action = Action(
-                ActionType.GET_USER_INFO, {"user_id": platform_user.platform_id}
-            )
-            response = connection.take_action(action)
-            if response.get("ok"):
-                profile = response["user"]["profile"]
-                platform_user.profile_image = profile["image_72"]
-                platform_user.username = profile["display_name"]
-                platform_user.save()
-            else:
-                LOGGER.warning(
-                    "Failed to update platform user data.",
-                    extra={
-                        "platform_user_id": platform_user.id,
-                        "error": response["error"],
-                    },
-                )
+        changed = []
+        for member in self.get_connection().list_users():
+            platform_user = platform_users.get(member["id"])
+            if not platform_user:
+                continue
+            profile = member["profile"]
+            fresh = {
+                "profile_image": profile.get("image_72", ""),
+                "username": profile.get("display_name", ""),
+            }
+            if any(getattr(platform_user, f) != v for f, v in fresh.items()):
+                for field, value in fresh.items():
+                    setattr(platform_user, field, value)
+                changed.append(platform_user)
+
+        PlatformUser.objects.bulk_update(
+            changed,
+            ["profile_image", "username"],
+            batch_size=settings.USER_REFRESH_BATCH_SIZE,
+        )
+        for platform_user in changed:
+            USER_PROFILES.delete(f"{self.workspace.id}:{platform_user.platform_id}")
+        return len(changed)
 
     def get_or_create_user_by_id(self, user_id: str) -> Optional[PlatformUser]:
+        """
+        The workspace's user, fetched from Slack and stored the first time.
+        Concurrent calls for the same user, from any worker, share a single
+        users.info request.
+        """
+        cache_key = f"{self.workspace.id}:{user_id}"
+        platform_user = _cached_profile(USER_PROFILES, cache_key, PlatformUser)
+        if platform_user:
+            return platform_user
+        return PROFILE_LOOKUPS.do(
+            f"user:{cache_key}",
+            lambda: self._load_user(user_id, cache_key),
+            lambda: _cached_profile(USER_PROFILES, cache_key, PlatformUser),
+        )
+
+    def _load_user(self, user_id: str, cache_key: str) -> Optional[PlatformUser]:
         try:
             platform_user = PlatformUser.objects.get(
                 platform_id=user_id, workspace=self.workspace
@@ -100,13 +193,16 @@ class WorkspaceService:
             response = connection.take_action(action)
             if response.get("ok"):
                 profile = response["user"]["profile"]
-                platform_user = PlatformUser.objects.create(
+                # Another process may have stored the user in the meantime.
+                platform_user, _ = PlatformUser.objects.get_or_create(
                     platform_id=user_id,
                     workspace=self.workspace,
-                    profile_image=profile["image_72"],
-                    username=response["user"]["name"],
-                    display_name=profile.get("display_name"),
-                    real_name=profile.get("real_name"),
+                    defaults={
+                        "profile_image": profile["image_72"],
+                        "username": response["user"]["name"],
+                        "display_name": profile.get("display_name"),
+                        "real_name": profile.get("real_name"),
+                    },
                 )
             else:
                 LOGGER.exception(
@@ -114,6 +210,7 @@ class WorkspaceService:
                     extra={"platform_user_id": user_id, "error": response["error"]},
                 )
                 return None
+        _cache_profile(USER_PROFILES, cache_key, platform_user, "workspace_id")
         return platform_user
 
 
@@ -129,7 +226,7 @@ class MegatronChannelService:
         if response["ok"]:
             self.channel.last_message_sent = datetime.now(timezone.utc)
             self.channel.is_archived = False
-            self.channel.save()
+            self.channel.save(update_fields=["last_message_sent", "is_archived"])
         return response
 
     def archive(self):
@@ -139,10 +236,10 @@ class MegatronChannelService:
         response = connection.archive_channel(self.channel.platform_channel_id)
         if response["ok"]:
             self.channel.is_archived = True
-            self.channel.save()
+            self.channel.save(update_fields=["is_archived"])
         elif response["error"] == "already_archived":
             self.channel.is_archived = True
-            self.channel.save()
+            self.channel.save(update_fields=["is_archived"])
         return response
 
     def change_pause_state(self, pause_state, user_channel_id=None):
@@ -167,5 +264,12 @@ class MegatronChannelService:
         # TODO: This response is 200 even on failure to find user
         if response.status_code == 200:
             self.channel.is_paused = pause_state
-            self.channel.save()
+            self.channel.save(update_fields=["is_paused"])
+            # scheduled_tasks imports this module
+            from megatron import scheduled_tasks
+
+            if pause_state:
+                scheduled_tasks.schedule_unpause_reminder(self.channel)
+            else:
+                scheduled_tasks.cancel_unpause_reminder(self.channel)
         return response
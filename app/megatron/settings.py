@@ -27,6 +27,18 @@ STATIC_URL = "/static/"
 MEGATRON_VERIFICATION_TOKEN = os.environ["MEGATRON_VERIFICATION_TOKEN"]
 REDIS_URL = os.environ["REDIS_URL"]
 
+# Shared by every web and celery process. Cache failures are logged and
+# treated as misses so an unavailable redis only costs us the speedup.
+CACHES = {
+    "default": {
+        "BACKEND": "django_redis.cache.RedisCache",
+        "LOCATION": REDIS_URL,
+        "KEY_PREFIX": "megatron",
+        "OPTIONS": {"IGNORE_EXCEPTIONS": True},
+    }
+}
+DJANGO_REDIS_LOG_IGNORED_EXCEPTIONS = True
+
 REST_FRAMEWORK = {
     "DEFAULT_AUTHENTICATION_CLASSES": (
         "rest_framework.authentication.BasicAuthentication",
@@ -54,6 +66,72 @@ DATABASES = {"default": dj_database_url.config()}
 AWS_ACCESS_KEY = os.environ["S3_AWS_ACCESS_KEY_ID"]
 AWS_SECRET_KEY = os.environ["S3_AWS_SECRET_ACCESS_KEY"]
 AWS_S3_BUCKET = os.environ["AWS_S3_BUCKET"]
+AWS_S3_ENDPOINT_URL = os.environ.get("AWS_S3_ENDPOINT_URL") or None
+# S3 requires every part but the last to be at least 5MB.
+S3_UPLOAD_PART_SIZE = max(
+    int(os.environ.get("S3_UPLOAD_PART_SIZE", 8 * 1024 * 1024)), 5 * 1024 * 1024
+)
+S3_UPLOAD_CONCURRENCY = int(os.environ.get("S3_UPLOAD_CONCURRENCY", 4))
+S3_MAX_POOL_CONNECTIONS = int(os.environ.get("S3_MAX_POOL_CONNECTIONS", 20))
+S3_PRESIGNED_URL_EXPIRY = int(os.environ.get("S3_PRESIGNED_URL_EXPIRY", 60 * 60))
+
+# ==================== HTTP ========================
+HTTP_POOL_CONNECTIONS = int(os.environ.get("HTTP_POOL_CONNECTIONS", 10))
+HTTP_POOL_MAXSIZE = int(os.environ.get("HTTP_POOL_MAXSIZE", 20))
+HTTP_MAX_RETRIES = int(os.environ.get("HTTP_MAX_RETRIES", 3))
+HTTP_KEEP_ALIVE = os.environ.get("HTTP_KEEP_ALIVE", "true") == "true"
+
+# ==================== Slack ========================
+SLACK_API_URL = os.environ.get("SLACK_API_URL", "https://slack.com/api")
+SLACK_RATE_LIMIT_ENABLED = os.environ.get("SLACK_RATE_LIMIT_ENABLED", "true") == "true"
+SLACK_RATE_LIMIT_RETRIES = int(os.environ.get("SLACK_RATE_LIMIT_RETRIES", 2))
+SLACK_BROADCAST_WORKERS = int(os.environ.get("SLACK_BROADCAST_WORKERS", 8))
+SLACK_IM_CACHE_TTL = int(os.environ.get("SLACK_IM_CACHE_TTL", 60 * 60 * 24 * 7))
+SLACK_IM_CACHE_SIZE = int(os.environ.get("SLACK_IM_CACHE_SIZE", 10000))
+PROFILE_CACHE_TTL = int(os.environ.get("PROFILE_CACHE_TTL", 60 * 60))
+SLACK_LOOKUP_WAIT = int(os.environ.get("SLACK_LOOKUP_WAIT", 30))
+USER_REFRESH_BATCH_SIZE = int(os.environ.get("USER_REFRESH_BATCH_SIZE", 500))
+SLACK_EVENTS_DEFERRED = os.environ.get("SLACK_EVENTS_DEFERRED", "false") == "true"
+DEDUPE_RETENTION = int(os.environ.get("DEDUPE_RETENTION", 60 * 60 * 24))
+RELAY_BATCH_SIZE = int(os.environ.get("RELAY_BATCH_SIZE", 100))
+
+# ==================== Broadcasts ========================
+BROADCAST_CHUNK_SIZE = int(os.environ.get("BROADCAST_CHUNK_SIZE", 500))
+BROADCAST_STALL_MINUTES = int(os.environ.get("BROADCAST_STALL_MINUTES", 15))
+
+# ==================== Task retries ========================
+TASK_MAX_RETRIES = int(os.environ.get("TASK_MAX_RETRIES", 5))
+TASK_RETRY_BACKOFF = int(os.environ.get("TASK_RETRY_BACKOFF", 2))
+TASK_RETRY_BACKOFF_MAX = int(os.environ.get("TASK_RETRY_BACKOFF_MAX", 10 * 60))
+TASK_IDEMPOTENCY_TTL = int(os.environ.get("TASK_IDEMPOTENCY_TTL", 60 * 60 * 24))
+
+# ==================== Task concurrency ========================
+# "task name=limit" pairs, comma separated.
+TASK_CONCURRENCY_LIMITS = {
+    name.strip(): int(limit)
+    for name, limit in (
+        pair.split("=")
+        for pair in os.environ.get(
+            "TASK_CONCURRENCY_LIMITS",
+            "megatron.scheduled_tasks.archive_channel_chunk=4,"
+            "megatron.scheduled_tasks.refresh_workspace_user_data=2,"
+            "megatron.broadcasts.deliver_broadcast=4",
+        ).split(",")
+        if pair.strip()
+    )
+}
+
+# ==================== Ordered delivery ========================
+ORDERED_DELIVERY = os.environ.get("ORDERED_DELIVERY", "true") == "true"
+DELIVERY_TTL = int(os.environ.get("DELIVERY_TTL", 60 * 60 * 24))
+DELIVERY_LOCK_TIMEOUT = int(os.environ.get("DELIVERY_LOCK_TIMEOUT", 5 * 60))
+
+# ==================== Channel activity ========================
+ACTIVITY_FLUSH_INTERVAL = int(os.environ.get("ACTIVITY_FLUSH_INTERVAL", 10))
+ACTIVITY_TTL = int(os.environ.get("ACTIVITY_TTL", 60 * 60 * 24))
+
+# ==================== Channels archiving ========================
+ARCHIVE_CHUNK_SIZE = int(os.environ.get("ARCHIVE_CHUNK_SIZE", 50))
 
 
 # ==================== Channels ========================
@@ -0,0 +1,52 @@
+import threading
+import time
+from typing import Dict, Optional
+
+from celery.signals import task_postrun, task_prerun
+from django.conf import settings
+
+from megatron import metrics
+
+
+STATS = metrics.counters("task_limits")
+
+_SLOTS: Dict[str, threading.BoundedSemaphore] = {}
+_SLOTS_LOCK = threading.Lock()
+_HELD: Dict[str, threading.BoundedSemaphore] = {}
+
+
+def _slots(task_name: str) -> Optional[threading.BoundedSemaphore]:
+    limit = settings.TASK_CONCURRENCY_LIMITS.get(task_name)
+    if not limit:
+        return None
+    with _SLOTS_LOCK:
+        if task_name not in _SLOTS:
+            _SLOTS[task_name] = threading.BoundedSemaphore(limit)
+        return _SLOTS[task_name]
+
+
+@task_prerun.connect
+def acquire_slot(task_id=None, task=None, **kwargs):
+    """
+    Caps how many runs of a task one worker process executes at once, see
+    TASK_CONCURRENCY_LIMITS. Only pools running several tasks per process,
+    threads or gevent, ever wait here: a bulk task waiting for a slot
+    leaves the rest of the pool to the other tasks.
+    """
+    # Eager runs happen inside their caller, which may hold a slot already.
+    slots = None if task.request.is_eager else _slots(task.name)
+    if slots is None:
+        return
+    if not slots.acquire(blocking=False):
+        started = time.monotonic()
+        slots.acquire()
+        STATS.incr(f"{task.name}:waited")
+        STATS.timing(f"{task.name}:wait_seconds", time.monotonic() - started)
+    _HELD[task_id] = slots
+
+
+@task_postrun.connect
+def release_slot(task_id=None, **kwargs):
+    slots = _HELD.pop(task_id, None)
+    if slots is not None:
+        slots.release()
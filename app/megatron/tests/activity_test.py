@@ -0,0 +1,119 @@
+import time
+from datetime import datetime, timedelta
+
+import pytest
+
+from megatron import activity, scheduled_tasks
+from megatron.models import MegatronChannel
+from megatron.tests.factories.factories import (
+    CustomerWorkspaceFactory,
+    MegatronChannelFactory,
+    MegatronIntegrationFactory,
+)
+
+pytestmark = pytest.mark.django_db
+
+LONG_AGO = datetime(2020, 1, 1)
+
+
+@pytest.fixture
+def channels():
+    integration = MegatronIntegrationFactory()
+    workspace = CustomerWorkspaceFactory()
+    created = [
+        MegatronChannelFactory(
+            megatron_integration=integration,
+            workspace=workspace,
+            platform_channel_id=f"C{i}",
+            platform_user_id=f"U{i}",
+        )
+        for i in range(3)
+    ]
+    MegatronChannel.objects.update(last_message_sent=LONG_AGO)
+    for channel in created:
+        channel.refresh_from_db()
+    return created
+
+
+def stored(channel):
+    return MegatronChannel.objects.get(id=channel.id).last_message_sent
+
+
+def test_touches_are_coalesced_and_flushed_in_one_update(
+    channels, django_assert_num_queries
+):
+    with django_assert_num_queries(0):
+        for _ in range(5):
+            for channel in channels:
+                activity.touch(channel)
+
+    assert activity.STATS.counts()["coalesced"] >= 12
+    assert sorted(activity.pending_channel_ids()) == sorted(c.id for c in channels)
+    assert stored(channels[0]) == LONG_AGO
+
+    with django_assert_num_queries(1):
+        assert activity.flush_activity() == 3
+    for channel in channels:
+        assert stored(channel) == channel.last_message_sent
+    assert activity.pending_channel_ids() == []
+    assert activity.flush_activity() == 0
+
+
+def test_touch_after_flush_is_journaled_again(channels):
+    channel = channels[0]
+    activity.touch(channel)
+    activity.flush_activity()
+    activity.touch(channel)
+
+    assert activity.pending_channel_ids() == [channel.id]
+
+
+def test_flush_never_moves_activity_back(channels):
+    channel = channels[0]
+    activity.touch(channel)
+    newer = channel.last_message_sent + timedelta(minutes=5)
+    MegatronChannel.objects.filter(id=channel.id).update(last_message_sent=newer)
+
+    activity.flush_activity()
+
+    assert stored(channel) == newer
+
+
+def test_lost_journal_entry_is_skipped_on_the_second_flush(channels):
+    activity.touch(channels[0])
+    activity.cache.delete(activity._log_key(1))
+    activity.touch(channels[1])
+
+    assert activity.flush_activity() == 0
+    assert activity.flush_activity() == 1
+    assert stored(channels[1]) == channels[1].last_message_sent
+
+
+def test_touch_writes_through_without_redis(channels, monkeypatch):
+    monkeypatch.setattr(activity.cache, "add", lambda *args, **kwargs: None)
+    activity.touch(channels[0])
+
+    assert stored(channels[0]) == channels[0].last_message_sent
+
+
+def test_unpause_reminder_sees_pending_activity(channels, monkeypatch):
+    sent = []
+
+    class WarningConnection:
+        def message(self, channel_id, msg):
+            sent.append(channel_id)
+
+    monkeypatch.setattr(
+        scheduled_tasks.IntegrationService,
+        "get_connection",
+        lambda self, as_user=True: WarningConnection(),
+    )
+    MegatronChannel.objects.update(is_paused=True)
+    in_window, too_recent = channels[0], channels[1]
+    for channel in (in_window, too_recent):
+        activity.touch(channel)
+    activity.cache.set(activity._activity_key(in_window.id), time.time() - 210)
+
+    scheduled_tasks.unpause_reminder()
+
+    assert sent == [in_window.platform_channel_id]
@@ -1,12 +1,14 @@
 import json
 import pytest
+from datetime import datetime, timedelta
 
 from django.test import RequestFactory
 from django.contrib.auth.models import User
 from rest_framework.test import APIRequestFactory, force_authenticate
 from megatron.interpreters.slack import api as slack_api
 
-from megatron import api, models
+from megatron import api, broadcasts, models
+from megatron.tests.factories import factories
 
 pytestmark = pytest.mark.django_db
 RF = APIRequestFactory()
@@ -57,6 +59,61 @@ class TestBroadcast(object):
         assert response.status_code == 200
         assert json.loads(response.content)["ok"]
 
+        broadcast_id = json.loads(response.content)["broadcast_id"]
+        request = RF.get(f"/broadcast/{broadcast_id}/")
+        force_authenticate(request, models.MegatronUser.objects.first())
+        response = api.broadcast_status(request, str(broadcast_id))
+        progress = json.loads(response.content)
+        assert progress["finished"]
+        assert (progress["sent"], progress["failed"], progress["pending"]) == (3, 0, 0)
+
+    def test_broadcast_resumes_without_resending(self, broadcast_payload):
+        message = json.loads(broadcast_payload["text"])
+        job = broadcasts.create_broadcast(
+            message, broadcast_payload["broadcasts"], False
+        )
+        first, second, third = job.recipients.order_by("id")
+        first.status = models.DeliveryStatus.sent.value
+        first.save()
+        second.status = models.DeliveryStatus.sending.value
+        second.save()
+        models.Broadcast.objects.filter(id=job.id).update(
+            updated_at=datetime.now() - timedelta(hours=1)
+        )
+
+        broadcasts.resume_broadcasts()
+
+        job.refresh_from_db()
+        progress = broadcasts.get_progress(job)
+        assert progress["finished"]
+        assert (progress["sent"], progress["failed"], progress["pending"]) == (2, 1, 0)
+        assert progress["errors"] == {"9876": [{"asdf": "Delivery was interrupted."}]}
+
+    def test_broadcast_reports_progress_per_batch(self, broadcast_payload, monkeypatch):
+        message = json.loads(broadcast_payload["text"])
+        job = broadcasts.create_broadcast(
+            message, broadcast_payload["broadcasts"], False
+        )
+        models.Broadcast.objects.filter(id=job.id).update(
+            updated_at=datetime.now() - timedelta(hours=1)
+        )
+        seen = []
+        deliver_to_org = broadcasts._deliver_to_org
+
+        def record_progress(broadcast, platform_type, org_id, recipients):
+            seen.append(models.Broadcast.objects.get(id=job.id).updated_at)
+            deliver_to_org(broadcast, platform_type, org_id, recipients)
+
+        monkeypatch.setattr(broadcasts, "PROGRESS_BATCH_SIZE", 2)
+        monkeypatch.setattr(broadcasts, "_deliver_to_org", record_progress)
+
+        broadcasts.deliver_broadcast(job.id)
+
+        assert len(seen) == 2
+        assert seen[1] > seen[0]
+        progress = broadcasts.get_progress(job)
+        assert (progress["sent"], progress["failed"], progress["pending"]) == (3, 0, 0)
+
     @pytest.mark.parametrize("missing_param", [("broadcasts"), ("text")])
     def test_broadcast_error(self, broadcast_payload, missing_param):
         del broadcast_payload[missing_param]
@@ -89,6 +146,131 @@ class TestIncomingMessage(object):
         assert json.loads(response.content)["ok"]
 
 
+class TestRelayBatch(object):
+    @staticmethod
+    @pytest.fixture
+    def posted(monkeypatch):
+        posted = []
+
+        def fake_post(msg, channel):
+            posted.append((channel.platform_channel_id, msg["text"]))
+            if msg["text"] == "fail":
+                return {"ok": False, "error": "channel_not_found"}
+            return {"ok": True, "ts": f"{len(posted)}.0", "watched_channel": True}
+
+        monkeypatch.setattr(slack_api, "incoming", fake_post)
+        monkeypatch.setattr(slack_api, "outgoing", fake_post)
+        integration = factories.MegatronIntegrationFactory()
+        workspace = factories.CustomerWorkspaceFactory()
+        for i, is_archived in ((1, False), (2, False), (3, True)):
+            factories.MegatronChannelFactory(
+                megatron_user=integration.megatron_user,
+                megatron_integration=integration,
+                workspace=workspace,
+                platform_channel_id=f"C{i}",
+                platform_user_id=f"U{i}",
+                is_archived=is_archived,
+            )
+        return posted
+
+    def test_incoming_batch(self, posted):
+        messages = [
+            {"user": "U1", "text": "one", "ts": "100.1"},
+            {"user": "U2", "text": "fail", "ts": "100.2"},
+            {"user": "U3", "text": "archived", "ts": "100.3"},
+            {"user": "U1", "text": "two", "ts": "100.4"},
+            {"user": "U1", "text": "one", "ts": "100.1"},
+        ]
+        request = RF.post("/incoming/batch/", {"messages": messages}, format="json")
+        force_authenticate(request, models.MegatronUser.objects.first())
+
+        response = api.incoming_batch(request)
+
+        assert response.status_code == 200
+        assert json.loads(response.content)["results"] == [
+            {"ok": True, "track": True},
+            {"ok": False, "track": False, "error": "channel_not_found"},
+            {"ok": True, "track": False},
+            {"ok": True, "track": True},
+            {"ok": True, "track": True},
+        ]
+        assert posted == [("C1", "one"), ("C2", "fail"), ("C1", "two")]
+        links = models.MegatronMessage.objects.order_by("id")
+        assert [(m.integration_msg_id, m.customer_msg_id) for m in links] == [
+            ("1.0", "100.1"),
+            ("3.0", "100.4"),
+        ]
+
+    def test_conflicting_link_does_not_fail_batch(self, posted):
+        channel = models.MegatronChannel.objects.get(platform_channel_id="C1")
+        # Stored by an earlier attempt, under the ts the first post gets.
+        models.MegatronMessage.objects.create(
+            integration_msg_id="1.0", customer_msg_id="90.1", megatron_channel=channel
+        )
+        messages = [
+            {"user": "U1", "text": "one", "ts": "400.1"},
+            {"user": "U1", "text": "two", "ts": "400.2"},
+        ]
+        request = RF.post("/incoming/batch/", {"messages": messages}, format="json")
+        force_authenticate(request, models.MegatronUser.objects.first())
+
+        response = api.incoming_batch(request)
+
+        assert response.status_code == 200
+        links = models.MegatronMessage.objects.order_by("id")
+        assert [(m.integration_msg_id, m.customer_msg_id) for m in links] == [
+            ("1.0", "90.1"),
+            ("2.0", "400.2"),
+        ]
+
+    def test_failed_message_is_relayed_on_retry(self, posted, monkeypatch):
+        def relay(text):
+            request = RF.post(
+                "/incoming/batch/",
+                {"messages": [{"user": "U1", "text": text, "ts": "300.1"}]},
+                format="json",
+            )
+            force_authenticate(request, models.MegatronUser.objects.first())
+            return json.loads(api.incoming_batch(request).content)["results"]
+
+        assert relay("fail")[0]["ok"] is False
+        with monkeypatch.context() as patched:
+            patched.setattr(slack_api, "incoming", lambda msg, channel: 1 / 0)
+            assert relay("again")[0]["ok"] is False
+
+        assert relay("delivered") == [{"ok": True, "track": True}]
+        assert posted == [("C1", "fail"), ("C1", "delivered")]
+
+    def test_outgoing_batch(self, posted):
+        items = [
+            {
+                "user": "U2",
+                "ts": "200.1",
+                "message": {"text": "hi", "attachments": "[]"},
+            },
+            {"user": "U9", "ts": "200.2", "message": {"text": "nobody"}},
+            {"user": "U1", "ts": "200.3", "message": {"text": "hello"}},
+        ]
+        request = RF.post("/outgoing/batch/", {"messages": items}, format="json")
+
+        response = api.outgoing_batch(request)
+
+        assert json.loads(response.content)["results"] == [
+            {"ok": True, "track": True},
+            {"ok": True, "track": False},
+            {"ok": True, "track": True},
+        ]
+        assert posted == [("C2", "hi"), ("C1", "hello")]
+        assert models.MegatronMessage.objects.count() == 2
+
+    def test_batch_requires_messages(self):
+        request = RF.post("/outgoing/batch/", {"messages": "nope"}, format="json")
+
+        response = api.outgoing_batch(request)
+
+        assert response.status_code == 400
+
+
 class TestRegisterOrganization(object):
     @staticmethod
     @pytest.fixture
@@ -0,0 +1,85 @@
+import pytest
+
+from megatron import aws
+
+
+pytestmark = pytest.mark.django_db
+
+
+class FakeS3:
+    def __init__(self):
+        self.objects = {}
+        self.uploads = {}
+        self.signed = []
+
+    def generate_presigned_url(self, ClientMethod, Params, ExpiresIn):
+        self.signed.append(Params["Key"])
+        return f"https://s3.example.com/{Params['Key']}?expires={ExpiresIn}"
+
+    def put_object(self, Bucket, Key, Body):
+        self.objects[Key] = Body
+
+    def create_multipart_upload(self, Bucket, Key):
+        self.uploads["upload-1"] = {}
+        return {"UploadId": "upload-1"}
+
+    def upload_part(self, Bucket, Key, UploadId, PartNumber, Body):
+        self.uploads[UploadId][PartNumber] = Body
+        return {"ETag": f"etag-{PartNumber}"}
+
+    def complete_multipart_upload(self, Bucket, Key, UploadId, MultipartUpload):
+        parts = self.uploads.pop(UploadId)
+        numbers = [part["PartNumber"] for part in MultipartUpload["Parts"]]
+        self.objects[Key] = b"".join(parts[number] for number in numbers)
+
+
+@pytest.fixture
+def fake_s3(monkeypatch, settings):
+    settings.S3_UPLOAD_PART_SIZE = 10
+    s3 = FakeS3()
+    monkeypatch.setattr(aws, "s3_client", lambda: s3)
+    return s3
+
+
+def test_small_file_is_put_in_one_request(fake_s3):
+    assert aws.stream_to_s3(iter([b"abc", b"def"]), "small.png")
+    assert fake_s3.objects == {"temp/small.png": b"abcdef"}
+
+
+def test_large_file_is_uploaded_in_parts(fake_s3, monkeypatch):
+    sent_parts = []
+    upload_part = fake_s3.upload_part
+
+    def record_part(**kwargs):
+        sent_parts.append(len(kwargs["Body"]))
+        return upload_part(**kwargs)
+
+    monkeypatch.setattr(fake_s3, "upload_part", record_part)
+    chunks = [bytes([i]) * 4 for i in range(6)]
+
+    assert aws.stream_to_s3(iter(chunks), "large.png")
+    assert sent_parts == [12, 12]
+    assert fake_s3.objects["temp/large.png"] == b"".join(chunks)
+
+
+def test_upload_stats(fake_s3):
+    aws.STATS.reset()
+    aws.stream_to_s3(iter([b"abc", b"def"]), "small.png")
+
+    stats = aws.STATS.snapshot()
+    assert stats["uploads"] == 1
+    assert stats["uploaded_bytes"] == 6
+    assert stats["bytes_per_second"] > 0
+
+
+def test_presigned_urls_are_reused(fake_s3):
+    first = aws.generate_presigned_url("image.png")
+    second = aws.generate_presigned_url("image.png")
+
+    assert first == second
+    assert fake_s3.signed == ["temp/image.png"]
+
+
+def test_one_client_per_process():
+    factory = aws.S3ClientFactory()
+    assert factory.get() is factory.get()
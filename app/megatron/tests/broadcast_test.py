@@ -0,0 +1,116 @@
+import json
+import pytest
+from urllib.parse import parse_qsl
+from celery._state import _task_stack
+from requests.models import Response
+
+from megatron.broadcasts import deliver_broadcast
+from megatron.errors import MegatronException
+from megatron.connections import rate_limits, slack
+from megatron.responses import SlackResponse
+
+pytestmark = pytest.mark.django_db
+
+
+@pytest.fixture
+def connection(monkeypatch, settings):
+    settings.SLACK_RATE_LIMIT_ENABLED = False
+    posted = []
+
+    def fake_open_im(slack_id):
+        if slack_id.startswith("missing"):
+            raise MegatronException(f"Could not open DM channel with user: {slack_id}")
+        return {"ok": True, "channel": {"id": f"D{slack_id}"}}
+
+    def fake_post(url, data=None, json=None, **kwargs):
+        posted.append((data, kwargs["headers"]))
+        resp = Response()
+        resp.status_code = 200
+        resp._content = b'{"ok": true, "ts": "1234.5678"}'
+        return SlackResponse.from_response(resp)
+
+    connection = slack.SlackConnection("faketoken")
+    connection.posted = posted
+    monkeypatch.setattr(connection, "open_im", fake_open_im)
+    monkeypatch.setattr(slack.safe_requests, "post", fake_post)
+    return connection
+
+
+def test_broadcast_reports_errors_per_user(connection):
+    broadcast = {"text": "Hi!", "attachments": [{"text": "attached"}]}
+    user_ids = ["U1", "missing1", "U2", "missing2"]
+
+    response = connection._broadcast(broadcast, user_ids, capture_feedback=False)
+
+    assert response["ok"] is False
+    assert [list(error) for error in response["errors"]] == [["missing1"], ["missing2"]]
+    channels = [
+        dict(parse_qsl(body.decode()))["channel"] for body, _ in connection.posted
+    ]
+    assert sorted(channels) == ["DU1", "DU2"]
+
+
+def test_broadcast_is_encoded_once_for_all_recipients(connection, monkeypatch):
+    prepared = []
+    prepare = slack.PreparedMessage.prepare
+    monkeypatch.setattr(
+        slack.PreparedMessage,
+        "prepare",
+        lambda msg, as_user: prepared.append(msg) or prepare(msg, as_user),
+    )
+    broadcast = {"text": "Hi!", "attachments": [{"text": "attached"}]}
+    user_ids = [f"U{i}" for i in range(20)]
+
+    response = connection._broadcast(broadcast, user_ids, capture_feedback=False)
+
+    assert response == {"ok": True}
+    assert len(prepared) == 1
+    assert broadcast == {"text": "Hi!", "attachments": [{"text": "attached"}]}
+    for body, headers in connection.posted:
+        fields = dict(parse_qsl(body.decode()))
+        assert json.loads(fields["attachments"]) == [{"text": "attached"}]
+        assert "token" not in fields
+        assert headers["Authorization"] == "Bearer faketoken"
+
+
+@pytest.fixture
+def in_task():
+    # What a worker running deliver_broadcast looks like to celery.
+    deliver_broadcast.push_request(is_eager=False)
+    _task_stack.push(deliver_broadcast)
+    yield
+    _task_stack.pop()
+    deliver_broadcast.pop_request()
+
+
+def test_broadcast_threads_wait_for_rate_limits_in_tasks(
+    monkeypatch, settings, in_task
+):
+    settings.SLACK_RATE_LIMIT_ENABLED = True
+    monkeypatch.setitem(rate_limits.TIER_LIMITS, "tier3", 10)
+    # A one second window keeps the waits short.
+    monkeypatch.setattr(rate_limits, "WINDOW_SECONDS", 1)
+    opened = []
+
+    class FakeSession:
+        def request(self, method, url, **kwargs):
+            response = Response()
+            response.status_code = 200
+            if url == slack.OPEN_IM_URL:
+                opened.append(kwargs["data"]["user"])
+                response._content = b'{"ok": true, "channel": {"id": "D1"}}'
+            else:
+                response._content = b'{"ok": true, "ts": "1234.5678"}'
+            return response
+
+    monkeypatch.setattr(
+        "megatron.connections.safe_requests.SESSIONS.get", lambda url: FakeSession()
+    )
+    connection = slack.SlackConnection("faketoken")
+    user_ids = [f"U{i}" for i in range(25)]
+
+    response = connection._broadcast({"text": "Hi!"}, user_ids, capture_feedback=False)
+
+    assert response == {"ok": True}
+    assert sorted(opened) == sorted(user_ids)
+    assert rate_limits.STATS.counts()["throttled"] > 0
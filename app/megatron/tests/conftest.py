@@ -1,9 +1,27 @@
 import pytest
 import requests
-from requests.models import Response
 
-from megatron import models, bot_types, services
+from django.core.cache import cache
+
+from megatron import caching, models, bot_types, services
+from megatron.celery import app as celery_app
 from megatron.connections import slack
+from megatron.connections.actions import ActionType
+from megatron.responses import SlackResponse
+
+
+@pytest.fixture(autouse=True)
+def eager_celery_tasks(monkeypatch):
+    monkeypatch.setattr(celery_app.conf, "task_always_eager", True)
+
+
+@pytest.fixture(autouse=True)
+def local_cache(settings):
+    settings.CACHES = {
+        "default": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache"}
+    }
+    cache.clear()
+    caching.clear_local_caches()
 
 
 @pytest.fixture(autouse=True)
@@ -38,10 +56,7 @@ def fake_app_response(monkeypatch):
         }
 
     def fake_post(url, json, *args, **kwargs):
-        resp = Response()
-        resp.status_code = 200
-        resp.json = fake_resp
-        return resp
+        return SlackResponse(fake_resp(), 200)
 
     monkeypatch.setattr(slack.safe_requests, "post", fake_post)
     monkeypatch.setattr(requests, "post", fake_post)
@@ -51,6 +66,17 @@ def fake_app_response(monkeypatch):
 def no_bot_connections(monkeypatch):
     class FakeConnection:
         def take_action(self, action):
+            if action.type == ActionType.GET_USER_INFO:
+                return {
+                    "ok": True,
+                    "user": {
+                        "name": action.params["user_id"],
+                        "profile": {
+                            "image_72": "https://example.com/72.png",
+                            "real_name": "Fake Agent",
+                        },
+                    },
+                }
             return {"ok": True}
 
         def broadcast(self, text, user_id, capture_feedback):
@@ -74,6 +100,12 @@ def no_bot_connections(monkeypatch):
         def open_im(self, platform_user_id):
             return {"ok": True, "channel": {"id": "FAKEID"}}
 
+        def forget_im(self, platform_user_id):
+            pass
+
+        def list_users(self):
+            return iter([])
+
         def im_history(self, channel_id, num_messages):
             return {"ok": True, "messages": []}
 
@@ -0,0 +1,185 @@
+import queue
+import random
+import threading
+import time
+
+import pytest
+
+from megatron import delivery
+from megatron.commands.commands import Command
+from megatron.errors import MegatronTransientError
+from megatron.models import DeadLetter
+
+pytestmark = pytest.mark.django_db
+
+WORKERS = 16
+
+
+@pytest.fixture
+def delivered(monkeypatch):
+    delivered = {}
+    lock = threading.Lock()
+    state = {"in_flight": 0, "max_in_flight": 0}
+
+    def fake_forward(channel_id, msg, from_user=None, delivery_id=None):
+        with lock:
+            state["in_flight"] += 1
+            state["max_in_flight"] = max(state["max_in_flight"], state["in_flight"])
+        time.sleep(random.uniform(0, 0.003))
+        with lock:
+            delivered.setdefault(channel_id, []).append(msg["text"])
+            state["in_flight"] -= 1
+        return {"ok": True}
+
+    monkeypatch.setattr(Command.get_command("forward"), "action", fake_forward)
+    return delivered, state
+
+
+def test_messages_stay_in_order_per_channel_under_concurrent_workers(
+    monkeypatch, settings, delivered
+):
+    # Room for every queued message, locmem evicts past 300 entries.
+    settings.CACHES = {
+        "default": {
+            "BACKEND": "django.core.cache.backends.locmem.LocMemCache",
+            "OPTIONS": {"MAX_ENTRIES": 10000},
+        }
+    }
+    delivered, state = delivered
+    broker: queue.Queue = queue.Queue()
+    monkeypatch.setattr(delivery.drain_channel, "delay", broker.put)
+
+    def worker():
+        while True:
+            channel_id = broker.get()
+            if channel_id is None:
+                return
+            delivery.drain_channel(channel_id)
+
+    workers = [threading.Thread(target=worker) for _ in range(WORKERS)]
+    for thread in workers:
+        thread.start()
+
+    channels = [f"C{i}" for i in range(24)]
+    sent = {channel_id: [] for channel_id in channels}
+    for i in range(40):
+        for channel_id in random.sample(channels, len(channels)):
+            text = f"{channel_id} message {i}"
+            sent[channel_id].append(text)
+            delivery.forward_in_order(channel_id, {"text": text})
+
+    deadline = time.monotonic() + 30
+    while (
+        any(delivery._pending(channel_id) for channel_id in channels)
+        or not broker.empty()
+    ) and time.monotonic() < deadline:
+        time.sleep(0.05)
+    for _ in workers:
+        broker.put(None)
+    for thread in workers:
+        thread.join()
+
+    assert delivered == sent
+    assert state["max_in_flight"] > 1
+    assert delivery.STATS.counts()["busy"] > 0
+
+
+def test_transient_failure_keeps_message_at_head(monkeypatch, delivered):
+    delivered, _ = delivered
+    forward = Command.get_command("forward").action
+    failures = [MegatronTransientError("ratelimited")]
+
+    def flaky_forward(channel_id, msg, from_user=None, delivery_id=None):
+        if failures:
+            raise failures.pop()
+        return forward(channel_id, msg, from_user)
+
+    monkeypatch.setattr(Command.get_command("forward"), "action", flaky_forward)
+    # Eager retries only work for tasks run with apply in this celery version.
+    monkeypatch.setattr(
+        delivery.drain_channel,
+        "delay",
+        lambda channel_id: delivery.drain_channel.apply(args=(channel_id,)),
+    )
+
+    delivery.forward_in_order("C1", {"text": "first"})
+    delivery.forward_in_order("C1", {"text": "second"})
+
+    assert delivered == {"C1": ["first", "second"]}
+    assert not DeadLetter.objects.exists()
+
+
+def test_permanent_failure_is_skipped_and_dead_lettered(monkeypatch, delivered):
+    delivered, _ = delivered
+    forward = Command.get_command("forward").action
+
+    def broken_forward(channel_id, msg, from_user=None, delivery_id=None):
+        if msg["text"] == "broken":
+            raise KeyError("ts")
+        return forward(channel_id, msg, from_user)
+
+    monkeypatch.setattr(Command.get_command("forward"), "action", broken_forward)
+
+    delivery.forward_in_order("C1", {"text": "broken"})
+    delivery.forward_in_order("C1", {"text": "fine"})
+
+    assert delivered == {"C1": ["fine"]}
+    assert DeadLetter.objects.get().args == '["C1", {"text": "broken"}, null]'
+
+
+def test_unsuccessful_forward_is_dead_lettered(monkeypatch, delivered):
+    delivered, _ = delivered
+    forward = Command.get_command("forward").action
+
+    def refused_forward(channel_id, msg, from_user=None, delivery_id=None):
+        if msg["text"] == "refused":
+            return {"ok": False, "error": "Channel C1 not found."}
+        return forward(channel_id, msg, from_user)
+
+    monkeypatch.setattr(Command.get_command("forward"), "action", refused_forward)
+
+    delivery.forward_in_order("C1", {"text": "refused"})
+    delivery.forward_in_order("C1", {"text": "fine"})
+
+    assert delivered == {"C1": ["fine"]}
+    assert "Channel C1 not found." in DeadLetter.objects.get().error
+
+
+def test_retried_drain_reuses_delivery_id(monkeypatch):
+    delivery_ids = []
+    failures = [MegatronTransientError("ratelimited")]
+
+    def flaky_forward(channel_id, msg, from_user=None, delivery_id=None):
+        delivery_ids.append(delivery_id)
+        if failures:
+            raise failures.pop()
+        return {"ok": True}
+
+    monkeypatch.setattr(Command.get_command("forward"), "action", flaky_forward)
+    monkeypatch.setattr(
+        delivery.drain_channel,
+        "delay",
+        lambda channel_id: delivery.drain_channel.apply(args=(channel_id,)),
+    )
+
+    delivery.forward_in_order("C1", {"text": "first"})
+
+    assert len(delivery_ids) == 2
+    assert delivery_ids[0] and delivery_ids[0] == delivery_ids[1]
+
+
+def test_reserved_message_is_delivered_in_its_place(monkeypatch, delivered):
+    delivered, _ = delivered
+    monkeypatch.setattr(delivery.drain_channel, "delay", delivery.drain_channel)
+
+    first = delivery.reserve_sequence("C1")
+    skipped = delivery.reserve_sequence("C1")
+    delivery.forward_in_order("C1", {"text": "second"})
+    assert delivered == {}
+
+    delivery.release_sequence("C1", skipped)
+    assert delivered == {}
+    delivery.forward_in_order("C1", {"text": "first"}, seq=first)
+
+    assert delivered == {"C1": ["first", "second"]}
+    assert not delivery._pending("C1")
@@ -0,0 +1,72 @@
+from datetime import datetime, timedelta, timezone
+from types import SimpleNamespace
+
+import pytest
+
+from megatron import celery_app, lanes
+
+pytestmark = pytest.mark.django_db
+
+
+@pytest.fixture(autouse=True)
+def reset_stats():
+    lanes.STATS.reset()
+
+
+def _started(published_at, eta=None, queue="megatron-live"):
+    request = SimpleNamespace(
+        is_eager=False,
+        eta=eta,
+        delivery_info={"routing_key": queue},
+        **{lanes.PUBLISHED_HEADER: published_at},
+    )
+    lanes.record_wait(task=SimpleNamespace(request=request))
+
+
+@pytest.mark.parametrize(
+    "task_name, queue",
+    [
+        ("megatron.commands.command_actions.forward_message", "megatron-live"),
+        ("megatron.delivery.drain_channel", "megatron-live"),
+        ("megatron.interpreters.slack.api.process_event", "megatron-events"),
+        ("megatron.commands.command_actions.pause_channel", "megatron-commands"),
+        ("megatron.scheduled_tasks.send_unpause_reminder", "megatron-commands"),
+        ("megatron.scheduled_tasks.archive_channel_chunk", "megatron-bulk"),
+        ("megatron.broadcasts.deliver_broadcast", "megatron-bulk"),
+        ("megatron.activity.flush_activity", "megatron-bulk"),
+        ("megatron.retries.unrouted", "megatron"),
+    ],
+)
+def test_tasks_are_routed_to_their_lane(task_name, queue):
+    assert celery_app.amqp.router.route({}, task_name)["queue"].name == queue
+
+
+def test_wait_is_timed_per_queue_from_publish_or_eta():
+    headers = {}
+    lanes.stamp_published_at(headers=headers)
+    published_at = headers[lanes.PUBLISHED_HEADER]
+    eta = datetime.now(timezone.utc) + timedelta(minutes=5)
+
+    _started(published_at - 3)
+    _started(published_at - 600, eta=(eta - timedelta(minutes=10)).isoformat())
+    _started(published_at, eta=eta.isoformat(), queue="megatron-bulk")
+
+    assert lanes.STATS.counts() == {
+        "megatron-live:started": 2,
+        "megatron-bulk:started": 1,
+    }
+    timings = lanes.STATS.timings()
+    # 3 seconds since published, 5 minutes since its eta.
+    assert 303 <= timings["megatron-live:wait_seconds"]["total"] < 310
+    assert timings["megatron-bulk:wait_seconds"]["max"] == 0
+
+
+def test_eager_and_unstamped_runs_are_not_timed():
+    lanes.record_wait(
+        task=SimpleNamespace(
+            request=SimpleNamespace(is_eager=True, megatron_published_at=1.0)
+        )
+    )
+    lanes.record_wait(task=SimpleNamespace(request=SimpleNamespace(is_eager=False)))
+
+    assert lanes.STATS.counts() == {}
@@ -0,0 +1,451 @@
+"""
+Upper bounds on the queries of every API view and celery task. A failure
+here usually means a relation is loaded lazily, once per message or per
+channel, where it used to be joined or cached.
+"""
+import itertools
+import json
+from datetime import datetime, timedelta
+
+import pytest
+from django.contrib.auth.models import User
+from django.db import connection
+from django.test import RequestFactory
+from rest_framework.test import APIRequestFactory, force_authenticate
+
+from megatron import api, broadcasts, delivery, scheduled_tasks
+from megatron.commands import command_actions
+from megatron.interpreters.slack import api as slack_api
+from megatron.models import (
+    CustomerWorkspace,
+    MegatronChannel,
+    MegatronIntegration,
+    MegatronMessage,
+    MegatronUser,
+    PlatformAgent,
+    PlatformUser,
+)
+
+pytestmark = pytest.mark.django_db
+RF = APIRequestFactory()
+
+# SQLite, as used for local test runs, refuses the timezone aware datetimes
+# these tasks store when USE_TZ is off.
+writes_aware_datetimes = pytest.mark.skipif(
+    connection.vendor == "sqlite",
+    reason="SQLite rejects timezone aware datetimes without USE_TZ.",
+)
+
+
+@pytest.fixture(autouse=True)
+def conversation(monkeypatch, fake_app_response):
+    workspace = CustomerWorkspace.objects.first()
+    integration = MegatronIntegration.objects.first()
+    platform_user = PlatformUser.objects.create(
+        platform_id="UCUSTOMER", workspace=workspace, username="customer"
+    )
+    # The profile conftest's fake Slack returns, so reading it writes nothing.
+    agent = PlatformAgent.objects.create(
+        platform_id="UAGENT",
+        integration=integration,
+        username="UAGENT",
+        real_name="Fake Agent",
+        profile_image="https://example.com/72.png",
+    )
+    channel = MegatronChannel.objects.create(
+        megatron_user=integration.megatron_user,
+        megatron_integration=integration,
+        workspace=workspace,
+        name="zz-customer",
+        platform_channel_id="CCHANNEL",
+        platform_user_id=platform_user.platform_id,
+    )
+    monkeypatch.setattr(slack_api, "incoming", lambda msg, channel: _posted(msg["ts"]))
+    posted = itertools.count()
+    monkeypatch.setattr(
+        slack_api, "outgoing", lambda msg, channel: _posted(f"1.{next(posted)}")
+    )
+    return {"channel": channel, "platform_user": platform_user, "agent": agent}
+
+
+def _posted(ts):
+    return {"ok": True, "ts": f"{ts}.posted", "watched_channel": True}
+
+
+@pytest.fixture
+def api_user():
+    return User.objects.create_user("api", "api@example.com", "pw")
+
+
+def _post(path, data, user):
+    request = RF.post(path, data, format="json")
+    force_authenticate(request, user)
+    return request
+
+
+def _request_data(conversation):
+    return {
+        "channel_id": conversation["channel"].platform_channel_id,
+        "user_id": conversation["agent"].platform_id,
+        "response_url": "https://hooks.slack.com/commands/1",
+    }
+
+
+def _arguments(conversation):
+    return {
+        "targeted_platform_user_id": conversation["platform_user"].platform_id,
+        "targeted_platform_workspace_id": conversation[
+            "platform_user"
+        ].workspace.platform_id,
+    }
+
+
+class TestViews:
+    def test_incoming(self, django_assert_max_num_queries, api_user):
+        message = {"user": "UCUSTOMER", "text": "Hi", "ts": "100.1"}
+        request = _post("/incoming/", {"message": message}, api_user)
+        with django_assert_max_num_queries(2):
+            assert api.incoming(request).status_code == 200
+
+    def test_incoming_batch(self, django_assert_max_num_queries, api_user):
+        messages = [
+            {"user": "UCUSTOMER", "text": "Hi", "ts": f"100.{i}"} for i in range(20)
+        ]
+        request = _post("/incoming/batch/", {"messages": messages}, api_user)
+        with django_assert_max_num_queries(2):
+            assert api.incoming_batch(request).status_code == 200
+        assert MegatronMessage.objects.count() == 20
+
+    def test_outgoing(self, django_assert_max_num_queries, api_user):
+        data = {"user": "UCUSTOMER", "ts": "200.1", "message": {"text": "Hello"}}
+        request = _post("/outgoing/", data, api_user)
+        with django_assert_max_num_queries(2):
+            assert api.outgoing(request).status_code == 200
+
+    def test_outgoing_batch(self, django_assert_max_num_queries, api_user):
+        items = [
+            {"user": "UCUSTOMER", "ts": f"200.{i}", "message": {"text": "Hello"}}
+            for i in range(20)
+        ]
+        request = _post("/outgoing/batch/", {"messages": items}, api_user)
+        with django_assert_max_num_queries(2):
+            assert api.outgoing_batch(request).status_code == 200
+
+    def test_edit(
+        self, django_assert_max_num_queries, api_user, conversation, monkeypatch
+    ):
+        class UpdatingConnection:
+            def take_action(self, action):
+                return {"ok": True, "ts": "300.3"}
+
+        monkeypatch.setattr(
+            api.IntegrationService,
+            "get_connection",
+            lambda self, as_user=True: UpdatingConnection(),
+        )
+        MegatronMessage.objects.create(
+            integration_msg_id="300.0",
+            customer_msg_id="300.1",
+            megatron_channel=conversation["channel"],
+        )
+        data = {
+            "message": {"user": "UCUSTOMER", "text": "Edited", "ts": "300.2"},
+            "previous_message": {"ts": "300.1"},
+        }
+        request = RF.post("/edit/", json.dumps(data), content_type="application/json")
+        force_authenticate(request, api_user)
+        with django_assert_max_num_queries(3):
+            assert api.edit(request).status_code == 200
+
+    def test_notify_user(self, django_assert_max_num_queries, api_user):
+        data = {
+            "message": {"text": "Psst"},
+            "user_id": "UAGENT",
+            "channel_id": "CCHANNEL",
+            "platform_type": "slack",
+        }
+        request = _post("/notify-user/", data, api_user)
+        with django_assert_max_num_queries(1):
+            assert api.notify_user(request).status_code == 200
+
+    def test_get_a_human(self, django_assert_max_num_queries):
+        megatron_user = MegatronUser.objects.first()
+        data = {
+            "requesting_user": {"with_team_domain": "customer", "slack_id": "U1"},
+            "workspace_id": "9876",
+        }
+        request = RF.post(
+            "/get-a-human/", json.dumps(data), content_type="application/json"
+        )
+        force_authenticate(request, megatron_user)
+        with django_assert_max_num_queries(1):
+            assert api.get_a_human(request).status_code == 200
+
+    def test_register_workspace(self, django_assert_max_num_queries, api_user):
+        data = {
+            "platform_type": "slack",
+            "connection_token": "xoxb-new",
+            "platform_id": "TNEW",
+            "name": "New customer",
+            "domain": "new",
+        }
+        request = RF.post(
+            "/register-workspace/", json.dumps(data), content_type="application/json"
+        )
+        force_authenticate(request, api_user)
+        with django_assert_max_num_queries(4):
+            assert api.register_workspace(request).status_code == 200
+
+    def test_broadcast(self, django_assert_max_num_queries, api_user, monkeypatch):
+        monkeypatch.setattr(broadcasts.deliver_broadcast, "delay", lambda job_id: None)
+        data = {
+            "text": json.dumps({"text": "News"}),
+            "broadcasts": [
+                {
+                    "platform_type": "slack",
+                    "org_id": "9876",
+                    "user_ids": [f"U{i}" for i in range(50)],
+                }
+            ],
+        }
+        request = RF.post(
+            "/broadcast/", json.dumps(data), content_type="application/json"
+        )
+        force_authenticate(request, api_user)
+        with django_assert_max_num_queries(2):
+            assert api.broadcast(request).status_code == 200
+
+    def test_broadcast_status(self, django_assert_max_num_queries, api_user):
+        job = broadcasts.create_broadcast(
+            {"text": "News"},
+            [{"platform_type": "slack", "org_id": "9876", "user_ids": ["U1", "U2"]}],
+            False,
+        )
+        request = RF.get(f"/broadcast/{job.id}/")
+        force_authenticate(request, api_user)
+        with django_assert_max_num_queries(3):
+            assert api.broadcast_status(request, str(job.id)).status_code == 200
+
+    def test_stats(self, django_assert_max_num_queries, api_user):
+        request = RF.get("/stats/")
+        force_authenticate(request, api_user)
+        with django_assert_max_num_queries(0):
+            assert api.stats(request).status_code == 200
+
+    def test_slash_command(self, django_assert_max_num_queries, monkeypatch):
+        monkeypatch.setattr("megatron.authentication.VERIFICATION_TOKEN", "verify")
+        queued = []
+        monkeypatch.setattr(
+            command_actions.open_channel, "delay", lambda *args: queued.append(args)
+        )
+        data = {
+            "token": "verify",
+            "channel_id": "CCHANNEL",
+            "user_id": "UAGENT",
+            "response_url": "https://hooks.slack.com/commands/1",
+            "text": "open <@UCUSTOMER>",
+        }
+        request = RequestFactory().post("/slack/slash-command/", data)
+        with django_assert_max_num_queries(2):
+            assert slack_api.slash_command(request).status_code == 200
+
+    def test_interactive_message(self, django_assert_max_num_queries, monkeypatch):
+        queued = []
+        monkeypatch.setattr(
+            command_actions.open_channel, "delay", lambda *args: queued.append(args)
+        )
+        payload = {
+            "actions": [{"type": "button", "value": "9876-UCUSTOMER"}],
+            "callback_id": "open",
+            "team": {"id": "12345"},
+            "channel": {"id": "CCHANNEL"},
+            "user": {"id": "UAGENT"},
+            "response_url": "https://hooks.slack.com/actions/1",
+        }
+        request = RequestFactory().post(
+            "/slack/interactive-message/", {"payload": json.dumps(payload)}
+        )
+        with django_assert_max_num_queries(4):
+            assert slack_api.interactive_message(request).status_code == 200
+        assert len(queued) == 1
+
+    def test_event(self, django_assert_max_num_queries, monkeypatch):
+        forwarded = []
+        monkeypatch.setattr(
+            delivery, "forward_in_order", lambda *args: forwarded.append(args)
+        )
+        data = {
+            "type": "event_callback",
+            "event": {
+                "type": "message",
+                "channel": "CCHANNEL",
+                "user": "UAGENT",
+                "text": "Hi there",
+                "ts": "400.1",
+                "event_ts": "400.1",
+            },
+        }
+        request = RequestFactory().post(
+            "/slack/event/", json.dumps(data), content_type="application/json"
+        )
+        with django_assert_max_num_queries(2):
+            assert slack_api.event(request).status_code == 200
+        assert len(forwarded) == 1
+
+
+class TestTasks:
+    def test_open_channel(self, django_assert_max_num_queries, conversation):
+        with django_assert_max_num_queries(10):
+            response = command_actions.open_channel(
+                MegatronUser.objects.first().id,
+                _request_data(conversation),
+                _arguments(conversation),
+            )
+        assert response["ok"]
+
+    def test_close_channel(self, django_assert_max_num_queries, conversation):
+        with django_assert_max_num_queries(8):
+            command_actions.close_channel(
+                MegatronUser.objects.first().id,
+                _request_data(conversation),
+                _arguments(conversation),
+            )
+        assert MegatronChannel.objects.get().is_archived
+
+    def test_pause_channel(self, django_assert_max_num_queries, conversation):
+        with django_assert_max_num_queries(18):
+            command_actions.pause_channel(
+                MegatronUser.objects.first().id,
+                _request_data(conversation),
+                _arguments(conversation),
+            )
+
+    def test_unpause_channel(self, django_assert_max_num_queries, conversation):
+        with django_assert_max_num_queries(16):
+            command_actions.unpause_channel(
+                MegatronUser.objects.first().id,
+                _request_data(conversation),
+                _arguments(conversation),
+            )
+
+    def test_clear_context(self, django_assert_max_num_queries, conversation):
+        with django_assert_max_num_queries(5):
+            response = command_actions.clear_context(
+                MegatronUser.objects.first().id,
+                _request_data(conversation),
+                _arguments(conversation),
+            )
+        assert response["ok"]
+
+    def test_do(self, django_assert_max_num_queries, conversation):
+        with django_assert_max_num_queries(3):
+            response = command_actions.do(
+                MegatronUser.objects.first().id,
+                _request_data(conversation),
+                {"arguments": "check_balance"},
+            )
+        assert response["ok"]
+
+    def test_forward_message(self, django_assert_max_num_queries):
+        msg = {"text": "Hi", "attachments": [], "ts": "500.1"}
+        with django_assert_max_num_queries(7):
+            response = command_actions.forward_message("CCHANNEL", msg)
+        assert response["ok"]
+
+    def test_drain_channel(self, django_assert_max_num_queries, monkeypatch):
+        monkeypatch.setattr(
+            delivery.Command.get_command("forward"),
+            "action",
+            lambda channel_id, msg, from_user=None, delivery_id=None: {"ok": True},
+        )
+        monkeypatch.setattr(delivery.drain_channel, "delay", lambda channel_id: None)
+        for i in range(10):
+            delivery.forward_in_order("CCHANNEL", {"text": f"Message {i}"})
+        with django_assert_max_num_queries(0):
+            delivery.drain_channel("CCHANNEL")
+
+    def test_process_event(
+        self, django_assert_max_num_queries, conversation, monkeypatch
+    ):
+        monkeypatch.setattr(delivery, "forward_in_order", lambda *args: None)
+        event = {
+            "type": "message",
+            "channel": "CCHANNEL",
+            "user": "UAGENT",
+            "text": "Hi there",
+            "ts": "600.1",
+            "event_ts": "600.1",
+        }
+        with django_assert_max_num_queries(2):
+            slack_api.process_event(event, conversation["channel"].id)
+
+    def test_refresh_platform_user_data(self, django_assert_max_num_queries):
+        with django_assert_max_num_queries(3):
+            scheduled_tasks.refresh_platform_user_data()
+
+    def test_unpause_reminder(self, django_assert_max_num_queries, conversation):
+        channels = [conversation["channel"]]
+        for i in range(5):
+            channel = MegatronChannel.objects.create(
+                megatron_user=channels[0].megatron_user,
+                megatron_integration=channels[0].megatron_integration,
+                workspace=channels[0].workspace,
+                name=f"zz-paused-{i}",
+                platform_channel_id=f"CPAUSED{i}",
+                platform_user_id=f"UPAUSED{i}",
+                is_paused=True,
+            )
+            channels.append(channel)
+        MegatronChannel.objects.filter(is_paused=True).update(
+            last_message_sent=datetime.now() - timedelta(minutes=50)
+        )
+        with django_assert_max_num_queries(1):
+            scheduled_tasks.unpause_reminder()
+
+    @writes_aware_datetimes
+    def test_archive_channels(self, django_assert_max_num_queries, monkeypatch):
+        chunks = []
+        monkeypatch.setattr(
+            scheduled_tasks.archive_channel_chunk,
+            "delay",
+            lambda *args: chunks.append(args),
+        )
+        MegatronChannel.objects.update(last_message_sent=datetime(2000, 1, 1))
+        with django_assert_max_num_queries(1):
+            scheduled_tasks.archive_channels()
+        assert len(chunks) == 1
+
+    def test_archive_channel_chunk(self, django_assert_max_num_queries, conversation):
+        with django_assert_max_num_queries(2):
+            scheduled_tasks.archive_channel_chunk("run", [conversation["channel"].id])
+        assert MegatronChannel.objects.get().is_archived
+
+    def test_deliver_broadcast(self, django_assert_max_num_queries, monkeypatch):
+        job = broadcasts.create_broadcast(
+            {"text": "News"},
+            [
+                {
+                    "platform_type": "slack",
+                    "org_id": "9876",
+                    "user_ids": [f"U{i}" for i in range(50)],
+                }
+            ],
+            False,
+        )
+        monkeypatch.setattr(broadcasts.deliver_broadcast, "delay", lambda job_id: None)
+        with django_assert_max_num_queries(8):
+            broadcasts.deliver_broadcast(job.id)
+
+    def test_resume_broadcasts(self, django_assert_max_num_queries, monkeypatch):
+        monkeypatch.setattr(broadcasts.deliver_broadcast, "delay", lambda job_id: None)
+        for _ in range(3):
+            broadcasts.create_broadcast(
+                {"text": "News"},
+                [{"platform_type": "slack", "org_id": "9876", "user_ids": ["U1"]}],
+                False,
+            )
+        broadcasts.Broadcast.objects.update(
+            updated_at=datetime.now() - timedelta(hours=1)
+        )
+        with django_assert_max_num_queries(4):
+            broadcasts.resume_broadcasts()
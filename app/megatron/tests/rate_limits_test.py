@@ -0,0 +1,134 @@
+import pytest
+from requests.models import Response
+
+from megatron.caching import token_key
+from megatron.connections import rate_limits
+from megatron.connections.safe_requests import SafeRequest
+from megatron.responses import SlackResponse
+
+pytestmark = pytest.mark.django_db
+
+CHAT_POST_URL = "https://slack.com/api/chat.postMessage"
+
+
+@pytest.fixture
+def clock(monkeypatch, settings):
+    settings.SLACK_API_URL = "https://slack.com/api"
+    settings.SLACK_RATE_LIMIT_ENABLED = True
+    rate_limits.STATS.reset()
+    now = [6000.0]
+
+    def sleep(seconds):
+        now[0] += seconds
+
+    monkeypatch.setattr(rate_limits.time, "time", lambda: now[0])
+    monkeypatch.setattr(rate_limits.time, "sleep", sleep)
+    monkeypatch.setattr(rate_limits.random, "random", lambda: 0.0)
+    return now
+
+
+@pytest.fixture
+def in_worker(monkeypatch):
+    monkeypatch.setattr(rate_limits, "may_wait", lambda: True)
+
+
+def test_limiter_waits_until_the_last_minute_has_room(clock, monkeypatch):
+    monkeypatch.setitem(rate_limits.TIER_LIMITS, "tier2", 2)
+    limiter = rate_limits.SharedRateLimiter()
+
+    assert limiter.acquire("faketoken", "users.list") == 0
+    assert limiter.acquire("faketoken", "users.list") == 0
+    assert limiter.fill(token_key("faketoken"), "tier2") == 1.0
+    clock[0] += 15
+    # Tries every 30 seconds, the budget per call, until less than one
+    # call of the previous minute is left in the last 60 seconds.
+    assert limiter.acquire("faketoken", "users.list") == 90
+    assert limiter.acquire("othertoken", "users.list") == 0
+
+    stats = rate_limits.STATS.snapshot()
+    tkey = token_key("faketoken")
+    assert stats[f"{tkey}:throttled"] == 1
+    assert stats[f"{tkey}:wait_seconds"]["total"] == 90
+    assert stats[f"{tkey}:tier2:fill"] == 0.75
+
+
+def test_web_requests_fail_fast_instead_of_waiting(clock, monkeypatch):
+    monkeypatch.setitem(rate_limits.TIER_LIMITS, "tier3", 1)
+    kwargs = {"headers": {"Authorization": "Bearer faketoken"}}
+    limiter = rate_limits.SharedRateLimiter()
+
+    assert limiter.before_request("https://slack.com/api/im.open", kwargs) == 0
+    assert limiter.before_request("https://slack.com/api/im.open", kwargs) == 60
+    assert clock[0] == 6000.0
+    assert rate_limits.STATS.counts()["rejected"] == 1
+
+
+def test_messages_are_only_held_back_after_a_429(clock):
+    limiter = rate_limits.SharedRateLimiter()
+    for _ in range(500):
+        assert limiter.try_acquire("faketoken", "chat.postMessage") == 0
+
+    limiter.pause("faketoken", "chat.postMessage", 30)
+
+    assert limiter.try_acquire("faketoken", "chat.postMessage") == 30
+
+
+def test_rate_limited_request_pauses_token_and_retries(clock, monkeypatch, in_worker):
+    statuses = [429, 200]
+    sent = []
+
+    class FakeSession:
+        def request(self, method, url, **kwargs):
+            sent.append(clock[0])
+            response = Response()
+            response.status_code = statuses.pop(0)
+            response.headers["Retry-After"] = "30"
+            response._content = b'{"ok": true}'
+            return response
+
+    monkeypatch.setattr(
+        "megatron.connections.safe_requests.SESSIONS.get", lambda url: FakeSession()
+    )
+    limiter = rate_limits.SharedRateLimiter()
+    safe_requests = SafeRequest(lambda r: True, lambda r: {}, limiter)
+
+    response = safe_requests.post(CHAT_POST_URL, {"token": "faketoken"})
+
+    assert response.status_code == 200
+    assert sent == [6000.0, 6030.0]
+    assert rate_limits.STATS.counts()["rate_limited"] == 1
+
+
+def test_other_hosts_are_not_limited(clock):
+    kwargs = {"headers": {"Authorization": "Bearer faketoken"}}
+    limiter = rate_limits.SharedRateLimiter()
+
+    limiter.before_request("https://files.slack.com/files-pri/T1/image.png", kwargs)
+    limiter.before_request("https://slack.com/api/users.list", kwargs)
+
+    assert limiter.fill(token_key("faketoken"), "tier2") == round(1 / 20, 4)
+
+
+def test_rate_limited_web_request_is_not_retried(clock, monkeypatch):
+    sent = []
+
+    class FakeSession:
+        def request(self, method, url, **kwargs):
+            sent.append(clock[0])
+            response = Response()
+            response.status_code = 429
+            response.headers["Retry-After"] = "30"
+            return response
+
+    monkeypatch.setattr(
+        "megatron.connections.safe_requests.SESSIONS.get", lambda url: FakeSession()
+    )
+    safe_requests = SafeRequest(
+        lambda r: True, lambda r: {}, rate_limits.SharedRateLimiter(), SlackResponse
+    )
+
+    response = safe_requests.post(CHAT_POST_URL, {"token": "faketoken"})
+
+    assert sent == [6000.0]
+    assert response.status_code == 429
+    assert response["error"] == "ratelimited"
@@ -0,0 +1,83 @@
+import json
+
+import pytest
+from django.core.management import call_command
+
+from megatron import retries
+from megatron.errors import MegatronTransientError
+from megatron.models import DeadLetter
+from megatron.responses import SlackResponse
+
+pytestmark = pytest.mark.django_db
+
+CALLS = {"post": 0, "finish": 0}
+FAILURES = {"finish": 0}
+
+
+@retries.slack_task
+def post_then_finish(text: str) -> dict:
+    def post():
+        CALLS["post"] += 1
+        return {"ok": True, "ts": "1234.5678"}
+
+    response = retries.run_once(post_then_finish, "post", post)
+    CALLS["finish"] += 1
+    if FAILURES["finish"]:
+        FAILURES["finish"] -= 1
+        retries.raise_for_transient({"ok": False, "error": "ratelimited"})
+    return response
+
+
+@pytest.fixture(autouse=True)
+def calls():
+    CALLS.update(post=0, finish=0)
+    FAILURES.update(finish=0)
+    return CALLS
+
+
+def test_transient_errors_are_retried_without_posting_twice(calls):
+    FAILURES["finish"] = 2
+
+    post_then_finish.apply(args=("hi",))
+
+    assert calls == {"post": 1, "finish": 3}
+    assert not DeadLetter.objects.exists()
+
+
+def test_permanent_errors_are_not_retried():
+    assert retries.raise_for_transient({"ok": False, "error": "not_in_channel"})
+    with pytest.raises(MegatronTransientError):
+        retries.raise_for_transient({"ok": False, "error": "Timeout error"})
+
+
+def test_slack_5xx_and_429_are_transient():
+    # Slack's 5xx pages are HTML, they decode to no particular error.
+    unavailable = SlackResponse(
+        {"ok": False, "error": "Could not decode response body."}, 503
+    )
+    with pytest.raises(MegatronTransientError):
+        retries.raise_for_transient(unavailable)
+    with pytest.raises(MegatronTransientError):
+        retries.raise_for_transient(SlackResponse({"ok": False}, 429))
+    assert retries.raise_for_transient(
+        SlackResponse({"ok": False, "error": "not_in_channel"}, 200)
+    )
+
+
+def test_exhausted_tasks_become_dead_letters_and_can_be_replayed(calls):
+    FAILURES["finish"] = 100
+
+    post_then_finish.apply(args=("hi",))
+
+    dead_letter = DeadLetter.objects.get()
+    assert dead_letter.task_name == post_then_finish.name
+    assert json.loads(dead_letter.args) == ["hi"]
+    assert "ratelimited" in dead_letter.error
+    assert calls == {"post": 1, "finish": post_then_finish.max_retries + 1}
+
+    FAILURES["finish"] = 0
+    call_command("dead_letters", "replay", "--all")
+
+    dead_letter.refresh_from_db()
+    assert dead_letter.replayed_at is not None
+    assert calls == {"post": 1, "finish": post_then_finish.max_retries + 2}
@@ -0,0 +1,188 @@
+from types import SimpleNamespace
+
+import pytest
+from django.core.cache import cache
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+
+from megatron import caching, services
+from megatron.connections.actions import ActionType
+from megatron.models import (
+    CustomerWorkspace,
+    MegatronIntegration,
+    PlatformAgent,
+    PlatformUser,
+)
+
+
+pytestmark = pytest.mark.django_db
+
+
+@pytest.fixture
+def user_info_calls(monkeypatch):
+    calls = []
+
+    class UserInfoConnection:
+        def list_users(self):
+            yield {
+                "id": "U12345",
+                "profile": {"image_72": "https://example.com/new.png"},
+            }
+
+        def take_action(self, action):
+            assert action.type == ActionType.GET_USER_INFO
+            calls.append(action.params["user_id"])
+            return {
+                "ok": True,
+                "user": {
+                    "name": "starscream",
+                    "profile": {
+                        "image_72": "https://example.com/72.png",
+                        "display_name": "Screamer",
+                        "real_name": "Starscream",
+                    },
+                },
+            }
+
+    def get_connection(self, as_user=True):
+        return UserInfoConnection()
+
+    monkeypatch.setattr(services.IntegrationService, "get_connection", get_connection)
+    monkeypatch.setattr(services.WorkspaceService, "get_connection", get_connection)
+    return calls
+
+
+def test_known_agent_is_served_from_cache(user_info_calls):
+    service = services.IntegrationService(MegatronIntegration.objects.first())
+    agent = service.get_or_create_user_by_id("U12345")
+
+    with CaptureQueriesContext(connection) as queries:
+        cached = service.get_or_create_user_by_id("U12345")
+
+    assert len(queries) == 0
+    assert user_info_calls == ["U12345"]
+    assert cached.id == agent.id
+    assert cached.real_name == "Starscream"
+    assert cached.profile_image == "https://example.com/72.png"
+
+
+def test_agent_profile_is_refreshed_from_slack_when_it_expires(
+    user_info_calls, monkeypatch
+):
+    service = services.IntegrationService(MegatronIntegration.objects.first())
+    service.get_or_create_user_by_id("U12345")
+    PlatformAgent.objects.filter(platform_id="U12345").update(real_name="Old name")
+    cache.clear()
+    caching.clear_local_caches()
+
+    agent = service.get_or_create_user_by_id("U12345")
+
+    assert user_info_calls == ["U12345", "U12345"]
+    assert agent.real_name == "Starscream"
+    assert PlatformAgent.objects.get(platform_id="U12345").real_name == "Starscream"
+
+
+def test_stored_agent_is_used_while_slack_fails(user_info_calls, monkeypatch):
+    service = services.IntegrationService(MegatronIntegration.objects.first())
+    service.get_or_create_user_by_id("U12345")
+    cache.clear()
+    caching.clear_local_caches()
+    monkeypatch.setattr(
+        service,
+        "get_connection",
+        lambda: SimpleNamespace(
+            take_action=lambda action: {"ok": False, "error": "fatal_error"}
+        ),
+    )
+
+    agent = service.get_or_create_user_by_id("U12345")
+
+    assert agent.real_name == "Starscream"
+
+
+def test_known_user_is_served_from_cache(user_info_calls):
+    service = services.WorkspaceService(CustomerWorkspace.objects.first())
+    user = service.get_or_create_user_by_id("U12345")
+
+    with CaptureQueriesContext(connection) as queries:
+        cached = service.get_or_create_user_by_id("U12345")
+
+    assert len(queries) == 0
+    assert user_info_calls == ["U12345"]
+    assert cached.id == user.id
+    assert cached.workspace_id == user.workspace_id
+    assert cached.get_display_name() == "Screamer"
+
+
+def test_refreshed_user_is_dropped_from_cache(user_info_calls):
+    service = services.WorkspaceService(CustomerWorkspace.objects.first())
+    service.get_or_create_user_by_id("U12345")
+    service.refresh_user_data()
+
+    with CaptureQueriesContext(connection) as queries:
+        service.get_or_create_user_by_id("U12345")
+
+    assert len(queries) == 1
+
+
+def test_refresh_only_writes_changed_users(monkeypatch):
+    workspace = CustomerWorkspace.objects.first()
+    for platform_id in ("U1", "U2", "U3"):
+        PlatformUser.objects.create(
+            platform_id=platform_id,
+            workspace=workspace,
+            profile_image="old.png",
+            username="old",
+        )
+
+    class UsersListConnection:
+        def list_users(self):
+            yield {
+                "id": "U1",
+                "profile": {"image_72": "old.png", "display_name": "old"},
+            }
+            yield {
+                "id": "U2",
+                "profile": {"image_72": "new.png", "display_name": "new"},
+            }
+            yield {"id": "U9", "profile": {"image_72": "x.png", "display_name": "x"}}
+
+    monkeypatch.setattr(
+        services.WorkspaceService,
+        "get_connection",
+        lambda self, as_user=True: UsersListConnection(),
+    )
+
+    assert services.WorkspaceService(workspace).refresh_user_data() == 1
+    users = {u.platform_id: u for u in PlatformUser.objects.all()}
+    assert users["U1"].profile_image == "old.png"
+    assert users["U2"].profile_image == "new.png"
+    assert users["U2"].username == "new"
+    assert users["U3"].username == "old"
+    assert "U9" not in users
+
+
+def test_user_stored_by_another_worker_meanwhile_is_reused(monkeypatch):
+    workspace = CustomerWorkspace.objects.first()
+
+    class RacingConnection:
+        def take_action(self, action):
+            # Another worker stores the user while users.info is in flight.
+            PlatformUser.objects.create(
+                platform_id="U12345", workspace=workspace, username="first"
+            )
+            return {
+                "ok": True,
+                "user": {"name": "second", "profile": {"image_72": "x.png"}},
+            }
+
+    monkeypatch.setattr(
+        services.WorkspaceService,
+        "get_connection",
+        lambda self, as_user=True: RacingConnection(),
+    )
+
+    user = services.WorkspaceService(workspace).get_or_create_user_by_id("U12345")
+
+    assert user.username == "first"
+    assert PlatformUser.objects.count() == 1
@@ -0,0 +1,31 @@
+import pytest
+
+from megatron.connections import sessions
+
+pytestmark = pytest.mark.django_db
+
+
+@pytest.fixture
+def session_pool():
+    sessions.STATS.reset()
+    pool = sessions.SessionPool()
+    yield pool
+    pool.close()
+
+
+def test_sessions_are_reused_per_host(session_pool):
+    first = session_pool.get("https://slack.com/api/chat.postMessage")
+    second = session_pool.get("https://slack.com/api/im.open")
+    other_host = session_pool.get("https://files.slack.com/files-pri/T1/image.png")
+
+    assert first is second
+    assert first is not other_host
+    assert sessions.STATS.snapshot() == {"hit": 1, "miss": 2}
+
+
+def test_sessions_are_dropped_after_fork(session_pool, monkeypatch):
+    first = session_pool.get("https://slack.com/api/chat.postMessage")
+    monkeypatch.setattr(sessions.os, "getpid", lambda: -1)
+    second = session_pool.get("https://slack.com/api/chat.postMessage")
+
+    assert first is not second
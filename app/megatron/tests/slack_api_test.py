@@ -1,9 +1,11 @@
 import json
 import pytest
 
+from django.core.cache import cache
 from django.test import RequestFactory
 from rest_framework.test import force_authenticate
 
+from megatron import delivery
 from megatron.commands import command_actions
 from megatron.interpreters.slack import api as slack_api
 from megatron.models import (
@@ -12,6 +14,7 @@ from megatron.models import (
     MegatronChannel,
     MegatronUser,
     MegatronIntegration,
+    MegatronMessage,
     PlatformAgent,
 )
 
@@ -169,3 +172,100 @@ class TestEventIgnoredBotMessage:
         )
         response = slack_api.event(request)
         assert response.status_code == 200
+
+
+class TestDeferredEvent:
+    @staticmethod
+    @pytest.fixture
+    def tracked_channel():
+        return MegatronChannel.objects.create(
+            megatron_user=MegatronUser.objects.first(),
+            platform_channel_id="CB2JNGD5Y",
+            megatron_integration=MegatronIntegration.objects.first(),
+            workspace=CustomerWorkspace.objects.first(),
+            is_paused=True,
+        )
+
+    @staticmethod
+    @pytest.fixture
+    def fake_data():
+        return {
+            "type": "event_callback",
+            "event": {
+                "channel": "CB2JNGD5Y",
+                "event_ts": "1548042126.003600",
+                "ts": "1548042126.003600",
+                "type": "message",
+                "text": "Hello there",
+                "user": "UAGENT",
+            },
+        }
+
+    def test_event_is_queued(self, settings, monkeypatch, tracked_channel, fake_data):
+        settings.SLACK_EVENTS_DEFERRED = True
+        queued = []
+        monkeypatch.setattr(
+            slack_api.process_event, "delay", lambda *args: queued.append(args)
+        )
+        monkeypatch.setattr(
+            slack_api,
+            "_process_event",
+            lambda *args: pytest.fail("Event was processed before acking."),
+        )
+
+        request = factory.post(
+            "/slack/event/", content_type="application/json", data=fake_data
+        )
+        response = slack_api.event(request)
+
+        assert response.status_code == 200
+        assert queued == [(fake_data["event"], tracked_channel.id, 1)]
+        # Holds the message's place until the worker stores it.
+        assert cache.get(delivery._message_key("CB2JNGD5Y", 1)) == delivery.RESERVED
+
+    def test_failed_event_releases_its_place(
+        self, monkeypatch, tracked_channel, fake_data
+    ):
+        monkeypatch.setattr(delivery.drain_channel, "delay", lambda channel_id: None)
+        monkeypatch.setattr(slack_api, "_get_slack_user_data", lambda *args: 1 / 0)
+        seq = delivery.reserve_sequence("CB2JNGD5Y")
+
+        with pytest.raises(ZeroDivisionError):
+            slack_api.process_event(fake_data["event"], tracked_channel.id, seq)
+
+        assert cache.get(delivery._message_key("CB2JNGD5Y", seq)) == delivery.SKIPPED
+
+    def test_duplicate_event_is_dropped(self, monkeypatch, tracked_channel, fake_data):
+        processed = []
+        monkeypatch.setattr(
+            slack_api, "_process_event", lambda *args: processed.append(args)
+        )
+
+        for _ in range(2):
+            request = factory.post(
+                "/slack/event/", content_type="application/json", data=fake_data
+            )
+            assert slack_api.event(request).status_code == 200
+
+        assert len(processed) == 1
+        assert not MegatronMessage.objects.exists()
+
+    def test_queued_event_is_forwarded(self, monkeypatch, tracked_channel, fake_data):
+        PlatformAgent.objects.create(
+            platform_id="UAGENT",
+            integration=tracked_channel.megatron_integration,
+            real_name="Agent Smith",
+        )
+        forwarded = []
+        monkeypatch.setattr(
+            delivery, "forward_in_order", lambda *args: forwarded.append(args)
+        )
+
+        slack_api.process_event(fake_data["event"], tracked_channel.id, 3)
+
+        channel_id, msg, from_user, seq = forwarded[0]
+        assert channel_id == "CB2JNGD5Y"
+        assert msg["text"] == "Hello there"
+        assert seq == 3
+        # Read from Slack, where the agent changed their name.
+        assert from_user["user_name"] == "Fake Agent"
@@ -1,6 +1,16 @@
+import json as jsonlib
+import threading
+import time
+
 import pytest
+import simplejson
+from urllib.parse import parse_qsl
+from django.core.cache import cache
 from unittest.mock import MagicMock
+from requests.models import Response
 from megatron.connections import slack
+from megatron.errors import MegatronTransientError
+from megatron.responses import SlackResponse
 from megatron.tests.factories import factories
 
 
@@ -27,3 +37,193 @@ def test_customer_workspace_refresh(fake_app_response):
     assert workspace.name == "BORKBORK"
     assert workspace.domain == "BORKBORKBORK"
     assert workspace.connection_token == "BORK_BORK_BORK_BORK"
+
+
+@pytest.fixture
+def slack_calls(monkeypatch):
+    calls = []
+
+    def fake_post(url, data=None, json=None, **kwargs):
+        method = url.rsplit("/", 1)[-1]
+        if isinstance(data, bytes):
+            data = dict(parse_qsl(data.decode()))
+        calls.append((method, data))
+        resp = Response()
+        resp.status_code = 200
+        if method == "im.open":
+            body = {"ok": True, "channel": {"id": f"D{len(calls)}"}}
+        elif data["channel"] == "D1":
+            body = {"ok": False, "error": "channel_not_found"}
+        else:
+            body = {"ok": True, "ts": "1234.5678"}
+        resp._content = jsonlib.dumps(body).encode()
+        return SlackResponse.from_response(resp)
+
+    monkeypatch.setattr(slack.safe_requests, "post", fake_post)
+    return calls
+
+
+def test_open_im_is_cached(slack_calls):
+    connection = slack.SlackConnection("faketoken")
+    first = connection.open_im("U12345")
+    second = connection.open_im("U12345")
+
+    assert first["channel"]["id"] == second["channel"]["id"] == "D1"
+    assert [method for method, _ in slack_calls] == ["im.open"]
+
+
+def test_concurrent_open_im_share_one_request(slack_calls, monkeypatch):
+    fake_post = slack.safe_requests.post
+
+    def slow_post(*args, **kwargs):
+        time.sleep(0.05)
+        return fake_post(*args, **kwargs)
+
+    monkeypatch.setattr(slack.safe_requests, "post", slow_post)
+    connection = slack.SlackConnection("faketoken")
+    start = threading.Barrier(8)
+    channel_ids = []
+
+    def open_im():
+        start.wait()
+        channel_ids.append(connection.open_im("U12345")["channel"]["id"])
+
+    threads = [threading.Thread(target=open_im) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert channel_ids == ["D1"] * 8
+    assert [method for method, _ in slack_calls] == ["im.open"]
+
+
+def test_open_im_waits_for_other_process(slack_calls):
+    connection = slack.SlackConnection("faketoken")
+    cache_key = f"{slack.token_key('faketoken')}:U12345"
+    lock_key = f"single_flight:im_open:{cache_key}"
+    cache.add(lock_key, "other process", 10)
+
+    def other_process_done():
+        slack.IM_CHANNELS.set(cache_key, "DOTHER")
+        cache.delete(lock_key)
+
+    threading.Timer(0.1, other_process_done).start()
+
+    assert connection.open_im("U12345")["channel"]["id"] == "DOTHER"
+    assert slack_calls == []
+
+
+def test_dm_user_reopens_stale_channel(slack_calls):
+    connection = slack.SlackConnection("faketoken")
+    msg = {"text": "Hi!", "attachments": [{"text": "attached"}]}
+    response = connection.dm_user("U12345", msg)
+
+    assert response["ok"]
+    assert [method for method, _ in slack_calls] == [
+        "im.open",
+        "chat.postMessage",
+        "im.open",
+        "chat.postMessage",
+    ]
+    assert slack_calls[-1][1]["channel"] == "D3"
+    assert jsonlib.loads(slack_calls[-1][1]["attachments"]) == [{"text": "attached"}]
+    assert connection.open_im("U12345")["channel"]["id"] == "D3"
+
+
+def test_empty_fields_are_left_out_of_prepared_messages():
+    prepared = slack.PreparedMessage.prepare(
+        {"text": None, "ts": None, "attachments": None}, as_user=True
+    )
+
+    fields = dict(parse_qsl(prepared.for_channel("D1").decode()))
+    assert fields == {"as_user": "True", "attachments": "null", "channel": "D1"}
+
+
+def test_dm_user_raises_transient_im_open_failures(monkeypatch):
+    monkeypatch.setattr(
+        slack.safe_requests,
+        "post",
+        lambda url, data=None, **kwargs: SlackResponse(
+            {"ok": False, "error": "Timeout error"}, 500
+        ),
+    )
+    connection = slack.SlackConnection("faketoken")
+
+    with pytest.raises(MegatronTransientError):
+        connection.dm_user("U12345", {"text": "Hi!"})
+
+
+def test_list_users_follows_cursors(monkeypatch):
+    pages = {
+        "": {
+            "ok": True,
+            "members": [{"id": "U1"}, {"id": "U2"}],
+            "response_metadata": {"next_cursor": "page2"},
+        },
+        "page2": {
+            "ok": True,
+            "members": [{"id": "U3"}],
+            "response_metadata": {"next_cursor": ""},
+        },
+    }
+
+    def fake_get(url, params=None, **kwargs):
+        response = Response()
+        response.status_code = 200
+        response._content = jsonlib.dumps(pages[params["cursor"]]).encode()
+        return SlackResponse.from_response(response)
+
+    monkeypatch.setattr(slack.safe_requests, "get", fake_get)
+    connection = slack.SlackConnection("xoxb-token")
+
+    assert [m["id"] for m in connection.list_users()] == ["U1", "U2", "U3"]
+
+
+@pytest.fixture
+def slack_session(monkeypatch, settings):
+    settings.SLACK_RATE_LIMIT_ENABLED = False
+    bodies = []
+
+    class FakeSession:
+        def request(self, method, url, **kwargs):
+            response = Response()
+            response.status_code = 200
+            response.headers["X-Slack-Req-Id"] = "req-1"
+            response._content = bodies.pop(0)
+            return response
+
+    monkeypatch.setattr(
+        "megatron.connections.safe_requests.SESSIONS.get", lambda url: FakeSession()
+    )
+    return bodies
+
+
+def test_responses_are_decoded_once(slack_session, monkeypatch):
+    decoded = []
+    loads = simplejson.loads
+    monkeypatch.setattr(
+        "megatron.responses.simplejson.loads",
+        lambda text: decoded.append(text) or loads(text),
+    )
+    slack_session.append(b'{"ok": true, "ts": "1234.5678"}')
+
+    response = slack.SlackConnection("faketoken").message("C1", {"text": "hi"})
+
+    assert isinstance(response, SlackResponse)
+    assert response == {"ok": True, "ts": "1234.5678"}
+    assert response.status_code == 200
+    assert response.headers["X-Slack-Req-Id"] == "req-1"
+    assert response.latency >= 0
+    assert len(decoded) == 1
+
+
+def test_plain_text_and_unreadable_bodies(slack_session):
+    slack_session.extend([b"ok", b"<html>Bad Gateway</html>"])
+    connection = slack.SlackConnection("faketoken")
+
+    assert connection.respond_to_url("https://hooks.slack.com/x", {}) == {"ok": True}
+    assert connection.unarchive_channel("C1") == {
+        "ok": False,
+        "error": "Could not decode response body.",
+    }
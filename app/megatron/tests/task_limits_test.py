@@ -0,0 +1,48 @@
+import threading
+from types import SimpleNamespace
+
+import pytest
+
+from megatron import task_limits
+
+pytestmark = pytest.mark.django_db
+
+LIMITED = SimpleNamespace(
+    name="megatron.tests.limited", request=SimpleNamespace(is_eager=False)
+)
+
+
+@pytest.fixture(autouse=True)
+def limits(settings, monkeypatch):
+    settings.TASK_CONCURRENCY_LIMITS = {LIMITED.name: 2}
+    monkeypatch.setattr(task_limits, "_SLOTS", {})
+    monkeypatch.setattr(task_limits, "_HELD", {})
+    task_limits.STATS.reset()
+
+
+def test_runs_past_the_limit_wait_for_a_slot():
+    task_limits.acquire_slot(task_id="1", task=LIMITED)
+    task_limits.acquire_slot(task_id="2", task=LIMITED)
+    third = threading.Thread(
+        target=task_limits.acquire_slot, kwargs={"task_id": "3", "task": LIMITED}
+    )
+    third.start()
+    third.join(0.2)
+    assert third.is_alive()
+
+    task_limits.release_slot(task_id="1")
+    third.join(5)
+
+    assert not third.is_alive()
+    assert task_limits.STATS.counts() == {f"{LIMITED.name}:waited": 1}
+    assert sorted(task_limits._HELD) == ["2", "3"]
+
+
+def test_unlisted_and_eager_runs_are_not_limited():
+    unlisted = SimpleNamespace(name="megatron.tests.other", request=LIMITED.request)
+    eager = SimpleNamespace(name=LIMITED.name, request=SimpleNamespace(is_eager=True))
+    for task_id in range(5):
+        task_limits.acquire_slot(task_id=f"unlisted-{task_id}", task=unlisted)
+        task_limits.acquire_slot(task_id=f"eager-{task_id}", task=eager)
+
+    assert task_limits._HELD == {}
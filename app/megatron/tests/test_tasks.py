@@ -1,6 +1,11 @@
+import logging
+from datetime import timedelta
+
 import pytest
 from freezegun import freeze_time
 
+from megatron import scheduled_tasks
+from megatron.models import MegatronChannel
 from megatron.scheduled_tasks import archive_channels
 from megatron.tests.factories.factories import (
     MegatronChannelFactory,
@@ -11,6 +16,22 @@ from megatron.tests.factories.factories import (
 pytestmark = pytest.mark.django_db
 
 
+@pytest.fixture
+def warnings_sent(monkeypatch):
+    sent = []
+
+    class WarningConnection:
+        def message(self, channel_id, msg):
+            sent.append(channel_id)
+
+    monkeypatch.setattr(
+        scheduled_tasks.IntegrationService,
+        "get_connection",
+        lambda self, as_user=True: WarningConnection(),
+    )
+    return sent
+
+
 @freeze_time("2020-09-03")
 def test_archive_channels():
     """
@@ -77,3 +98,145 @@ def test_archive_channels():
     ch4.refresh_from_db()
     assert ch4.is_archived
     assert not ch4.is_paused
+
+
+@freeze_time("2020-09-03 12:00:00")
+def test_unpause_reminder_sweep(warnings_sent):
+    integration = MegatronIntegrationFactory()
+    workspace = CustomerWorkspaceFactory()
+    channels = {
+        "IN_WINDOW": dict(is_paused=True, last_message_sent="2020-09-03 11:56:30"),
+        "TOO_RECENT": dict(is_paused=True, last_message_sent="2020-09-03 11:58:00"),
+        "TOO_OLD": dict(is_paused=True, last_message_sent="2020-09-03 11:50:00"),
+        "NOT_PAUSED": dict(is_paused=False, last_message_sent="2020-09-03 11:56:30"),
+    }
+    for platform_channel_id, fields in channels.items():
+        MegatronChannelFactory(
+            megatron_integration=integration,
+            workspace=workspace,
+            platform_channel_id=platform_channel_id,
+            platform_user_id=platform_channel_id,
+            **fields,
+        )
+
+    scheduled_tasks.unpause_reminder()
+    scheduled_tasks.unpause_reminder()
+
+    assert warnings_sent == ["IN_WINDOW"]
+
+
+def test_scheduled_unpause_reminder_is_superseded(warnings_sent, monkeypatch):
+    channel = MegatronChannelFactory(is_paused=True)
+    queued = []
+    monkeypatch.setattr(
+        scheduled_tasks.send_unpause_reminder,
+        "apply_async",
+        lambda args, countdown: queued.append((args, countdown)),
+    )
+
+    scheduled_tasks.schedule_unpause_reminder(channel)
+    scheduled_tasks.schedule_unpause_reminder(channel)
+    (first_args, countdown), (second_args, _) = queued
+    assert 0 < countdown <= scheduled_tasks.PAUSE_WARNING_START.total_seconds()
+
+    scheduled_tasks.send_unpause_reminder(*first_args)
+    assert warnings_sent == []
+    scheduled_tasks.send_unpause_reminder(*second_args)
+    assert warnings_sent == [channel.platform_channel_id]
+
+
+def test_each_message_gets_its_reminder(warnings_sent, monkeypatch):
+    channel = MegatronChannelFactory(is_paused=True)
+    queued = []
+    monkeypatch.setattr(
+        scheduled_tasks.send_unpause_reminder,
+        "apply_async",
+        lambda args, countdown: queued.append(args),
+    )
+
+    scheduled_tasks.schedule_unpause_reminder(channel)
+    scheduled_tasks.send_unpause_reminder(*queued[-1])
+    MegatronChannel.objects.filter(id=channel.id).update(
+        last_message_sent=channel.last_message_sent + timedelta(seconds=30)
+    )
+    channel.refresh_from_db()
+    scheduled_tasks.schedule_unpause_reminder(channel)
+    scheduled_tasks.send_unpause_reminder(*queued[-1])
+
+    assert warnings_sent == [channel.platform_channel_id] * 2
+
+
+def test_cancelled_unpause_reminder_is_not_sent(warnings_sent, monkeypatch):
+    channel = MegatronChannelFactory(is_paused=True)
+    queued = []
+    monkeypatch.setattr(
+        scheduled_tasks.send_unpause_reminder,
+        "apply_async",
+        lambda args, countdown: queued.append(args),
+    )
+
+    scheduled_tasks.schedule_unpause_reminder(channel)
+    scheduled_tasks.cancel_unpause_reminder(channel)
+    scheduled_tasks.send_unpause_reminder(*queued[0])
+
+    assert warnings_sent == []
+
+
+def test_archive_chunks_log_run_summary(monkeypatch, caplog):
+    archived = []
+
+    class ArchiveConnection:
+        def archive_channel(self, channel_id):
+            archived.append(channel_id)
+            if channel_id == "FAILS":
+                return {"ok": False, "error": "not_authed"}
+            return {"ok": True}
+
+    monkeypatch.setattr(
+        scheduled_tasks.IntegrationService,
+        "get_connection",
+        lambda self, as_user=True: ArchiveConnection(),
+    )
+    integration = MegatronIntegrationFactory()
+    workspace = CustomerWorkspaceFactory()
+    channel_ids = [
+        MegatronChannelFactory(
+            megatron_integration=integration,
+            workspace=workspace,
+            platform_channel_id=platform_channel_id,
+            platform_user_id=platform_channel_id,
+        ).id
+        for platform_channel_id in ("CH1", "CH2", "FAILS")
+    ]
+    run_id = "run"
+    prefix = scheduled_tasks.ARCHIVE_RUN_PREFIX + run_id
+    scheduled_tasks.cache.set_many(
+        {
+            f"{prefix}|started": 0,
+            f"{prefix}|pending": 2,
+            f"{prefix}|archived": 0,
+            f"{prefix}|failed": 0,
+            f"{prefix}|chunk_ms": 0,
+        }
+    )
+
+    with caplog.at_level("INFO", logger="megatron.scheduled_tasks"):
+        scheduled_tasks.archive_channel_chunk(run_id, channel_ids[:2])
+        assert not caplog.records
+        scheduled_tasks.archive_channel_chunk(run_id, channel_ids[2:])
+
+    assert sorted(archived) == ["CH1", "CH2", "FAILS"]
+    summary = caplog.records[-1]
+    assert summary.msg == "Finished archiving stale channels."
+    assert summary.archived == 2
+    assert summary.failed == 1
+
+
+def test_archive_chunk_is_reported_alone_without_redis(monkeypatch, caplog):
+    caplog.set_level(logging.INFO, logger=scheduled_tasks.__name__)
+    monkeypatch.setattr(scheduled_tasks.cache, "incr", lambda key, delta=1: None)
+    monkeypatch.setattr(scheduled_tasks.cache, "decr", lambda key, delta=1: None)
+
+    scheduled_tasks._finish_archive_chunk("run", archived=3, failed=0, duration=1.0)
+
+    assert "Archived chunk of stale channels." in caplog.messages
@@ -7,8 +7,11 @@ from megatron.interpreters.slack import urls as slack_urls
 megatron_patterns = [
     url(r"^$", api.test),
     # API - Actions
+    url(r"incoming/batch/$", api.incoming_batch),
     url(r"incoming/", api.incoming),
+    url(r"outgoing/batch/$", api.outgoing_batch),
     url(r"outgoing/", api.outgoing),
+    url(r"broadcast/(?P<broadcast_id>[0-9]+)/$", api.broadcast_status),
     url(r"broadcast/", api.broadcast),
     url(r"edit/", api.edit),
     url(r"message/(?P<user_id>[0-9A-Za-z]+)/", api.message),
@@ -16,6 +19,7 @@ megatron_patterns = [
     url(r"get-a-human/$", api.get_a_human),
     # API - Maintenance
     url(r"register-workspace/$", api.register_workspace),
+    url(r"stats/$", api.stats),
 ]
 
 # TODO: Make dynamic for enabled interpreters
@@ -9,7 +9,7 @@ function start_development() {
 
 function start_production() {
     echo "Running production server..."
-    gunicorn megatron.wsgi -w 4 -b 0.0.0.0:8002 --log-file -
+    gunicorn megatron.wsgi -c megatron/gunicorn_config.py
 }
 
 if [ ${PRODUCTION} == "false" ]; then